@@ -0,0 +1,90 @@
+"""Compare the memory held by comment records as dicts and as MessageRecords.
+
+Usage: python benchmarks/bench_records.py [comment_count]
+"""
+
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.records import MessageRecord  # noqa: E402
+
+NAMES = [("Ivan", "Petrov", "ivanp"), ("Olena", None, "olena_k"), ("Max", "", None)]
+REACTIONS = ["👍", "❤", "🔥", "ReactionCustomEmoji"]
+
+
+def synthetic_comments(count, per_thread=200):
+    """Yield root records carrying ``per_thread`` comments each"""
+    next_id = 1
+    while next_id <= count:
+        root_id = next_id
+        comments = []
+        for i in range(min(per_thread, count - next_id + 1)):
+            first_name, last_name, username = NAMES[i % len(NAMES)]
+            # Strings are built per record, as they are when parsed from JSON
+            comment = {
+                "id": next_id + i,
+                "date": f"2024-03-{1 + i % 28:02d} 12:{i % 60:02d}:00",
+                "reply_to": root_id,
+                "sender_id": 100000 + i % 500,
+                "first_name": "".join(first_name),
+                "last_name": None if last_name is None else "".join(last_name),
+                "username": None if username is None else "".join(username),
+                "message": f"comment number {next_id + i}",
+                "reactions": [
+                    {"reaction": "".join(REACTIONS[(i + k) % len(REACTIONS)]), "count": k + 1}
+                    for k in range(i % 3)
+                ],
+            }
+            if i % 10 == 0:
+                comment["media"] = [f"media_comments/{root_id}_{i}.jpg"]
+                comment["reactions"].append(
+                    {"reaction": "".join("👍"), "count": 1, "is_from_creator": True}
+                )
+            comments.append(comment)
+        yield {
+            "id": root_id,
+            "date": "2024-03-01 12:00:00",
+            "message": "root",
+            "views": 1000,
+            "comments": comments,
+        }
+        next_id += len(comments)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = build()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, current, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    dicts, dict_bytes, dict_time = measure(lambda: list(synthetic_comments(count)))
+    print(f"dicts:          {dict_bytes / 2**20:8.1f} MiB  ({dict_time:.1f}s)")
+
+    compact, compact_bytes, compact_time = measure(
+        lambda: [MessageRecord.from_dict(r) for r in synthetic_comments(count)]
+    )
+    print(f"MessageRecord:  {compact_bytes / 2**20:8.1f} MiB  ({compact_time:.1f}s)")
+    print(f"reduction:      {1 - compact_bytes / dict_bytes:8.1%}")
+
+    # Compared as JSON so that key order is checked as well
+    restored = json.dumps([r.to_dict() for r in compact])
+    assert restored == json.dumps(dicts), "round trip changed a record"
+    print(f"round trip of {count} comments: ok")
+
+
+if __name__ == "__main__":
+    main()
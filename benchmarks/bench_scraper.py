@@ -0,0 +1,404 @@
+"""End-to-end throughput of the scraper against a fake Telegram client.
+
+Runs a historical sync of a synthetic channel (``fake_telegram``) through
+``HistoricalSyncMode`` and ``MessageProcessor``, reopens the archive to time
+startup, then pushes new posts through ``create_new_message_handler``. The
+only latency is the simulated one, as the request scheduler's rate limits are
+lifted unless ``--rate-limits`` is given. Reports messages/sec, save and
+commit latency, real-time latency, startup time and peak RSS.
+
+Usage:
+    python benchmarks/bench_scraper.py --posts 2000 --latency-ms 20
+    python benchmarks/bench_scraper.py --output before.json
+    python benchmarks/bench_scraper.py --baseline before.json  # exit 1 on regression
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telethon import events  # noqa: E402
+
+from fake_telegram import (  # noqa: E402
+    ChannelShape,
+    FakeTelegramClient,
+    Latency,
+    SyntheticChannel,
+)
+from src import globals as g  # noqa: E402
+from src.channels import Channel  # noqa: E402
+from src.event_handlers import create_new_message_handler  # noqa: E402
+from src.media_store import MediaStore  # noqa: E402
+from src.modes import HistoricalSyncMode  # noqa: E402
+from src.reaction_lookup import ReactionLookup  # noqa: E402
+from src.request_scheduler import DEFAULT_RATES, RequestScheduler  # noqa: E402
+from src.utils import setup_directories, setup_transliteration_schema  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+USERNAME = "bench_channel"
+UNLIMITED_RATE = [1e9, 1e9]
+
+# Arguments that do not change what is measured
+NOT_COMPARED = {"output", "baseline", "tolerance", "keep", "verbose"}
+
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED = {
+    "historical.messages_per_second": True,
+    "historical.save_ms.p95": False,
+    "historical.commit_ms.p95": False,
+    "startup.seconds": False,
+    "realtime.messages_per_second": True,
+    "realtime.latency_ms.p95": False,
+    "peak_rss_mib": False,
+}
+
+
+def percentiles(samples):
+    """p50/p95/p99/max of a list of seconds, in milliseconds"""
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": ordered[-1] * 1000}
+
+
+def peak_rss_mib():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def time_calls(obj, name, samples):
+    """Record the duration of every call of ``obj.name`` in ``samples``"""
+    func = getattr(obj, name)
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - start)
+
+    setattr(obj, name, timed)
+
+
+def make_config(args):
+    config = {
+        "channel_username": USERNAME,
+        "output_json": "messages.json",
+        "media_folder": "media",
+        "media_comments_folder": "media_comments",
+        "date_format": "%d.%m.%Y. %H:%M:%S",
+        "timezone_offset_hours": 0,
+        "transliterate_key": "message_latin" if args.transliterate else False,
+        "transliterate_schema": args.transliterate or "",
+        "storage_backend": args.backend,
+        "search_index": not args.no_search_index,
+        "download_workers": args.download_workers,
+        "media_dedup": True,
+        "comment_fetch_concurrency": args.comment_concurrency,
+        "realtime_quiet_ms": args.quiet_ms,
+        "realtime_max_wait_ms": args.quiet_ms * 3,
+    }
+    if not args.rate_limits:
+        config["request_rates"] = {name: UNLIMITED_RATE for name in DEFAULT_RATES}
+    return config
+
+
+def set_up(config, base_dir, client):
+    """Initialize the globals the way ``TelegramClientManager`` does"""
+    g.initialize_globals(
+        client,
+        config,
+        setup_transliteration_schema(config),
+        base_dir,
+        None,
+        ReactionLookup.from_config(config),
+        RequestScheduler.from_config(config),
+        MediaStore.from_config(config, base_dir),
+    )
+
+
+def open_channel(config, base_dir):
+    start = time.perf_counter()
+    channel = Channel(config, base_dir).open()
+    return channel, time.perf_counter() - start
+
+
+async def bench_historical(config, base_dir, client, quiet):
+    with quiet():
+        channel, _ = open_channel(config, base_dir)
+    g.current_channel.set(channel)
+    processor = channel.message_processor
+    saves, commits = [], []
+    time_calls(processor, "_save_record", saves)
+    time_calls(processor, "commit", commits)
+    if channel.media_queue:
+        channel.media_queue.start(client)
+
+    mode = HistoricalSyncMode(processor, config["comment_fetch_concurrency"])
+    args = argparse.Namespace(no_prompts=True, offset_id=None, stop_count=None)
+    start = time.perf_counter()
+    with quiet():
+        await mode.run(client, USERNAME, channel.output_json_path, args)
+    elapsed = time.perf_counter() - start
+    if channel.media_queue:
+        await channel.media_queue.stop()
+
+    start = time.perf_counter()
+    with quiet():
+        channel.close()
+    close_seconds = time.perf_counter() - start
+
+    synthetic = client.channels[USERNAME]
+    messages = synthetic.last_id + synthetic.total_comments
+    return {
+        "messages": messages,
+        "seconds": elapsed,
+        "messages_per_second": messages / elapsed,
+        "save_ms": percentiles(saves),
+        "commit_ms": percentiles(commits),
+        "close_seconds": close_seconds,
+        "requests": dict(client.requests),
+        "media_mib_per_second": client.downloaded_bytes / 2**20 / elapsed,
+    }
+
+
+def bench_startup(config, base_dir, quiet):
+    with quiet():
+        channel, seconds = open_channel(config, base_dir)
+    result = {"seconds": seconds, "stored_messages": channel.store.count()}
+    return channel, result
+
+
+async def bench_realtime(channel, client, count, rate, quiet):
+    g.current_channel.set(channel)
+    processor = channel.message_processor
+    published = {}
+    latencies = []
+    process_new_message = processor.process_new_message
+
+    def timed_process(root_rec, msg):
+        process_new_message(root_rec, msg)
+        latencies.append(time.perf_counter() - published[msg.id])
+
+    processor.process_new_message = timed_process
+    if channel.media_queue:
+        channel.media_queue.start(client)
+
+    handler = create_new_message_handler(processor, channel)
+    client.add_event_handler(handler, events.NewMessage(chats=USERNAME))
+    ingest = handler.ingest
+
+    start = time.perf_counter()
+    with quiet():
+        for i in range(count):
+            msg = client.new_post(USERNAME)
+            published[msg.id] = time.perf_counter()
+            await client.publish(USERNAME, msg)
+            if rate:
+                await asyncio.sleep(max(0, start + (i + 1) / rate - time.perf_counter()))
+        while ingest.stats["processed"] + ingest.stats["failed"] < count:
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        await processor.wait_for_downloads()
+        if channel.media_queue:
+            await channel.media_queue.stop()
+        channel.close()
+
+    return {
+        "messages": count,
+        "seconds": elapsed,
+        "messages_per_second": count / elapsed,
+        "latency_ms": percentiles(latencies),
+        "flushes": ingest.stats["flushes"],
+        "max_depth": ingest.stats["max_depth"],
+        "failed": ingest.stats["failed"],
+    }
+
+
+async def run(args, base_dir):
+    config = make_config(args)
+    setup_directories(config["media_folder"], config["media_comments_folder"], base_dir)
+    shape = ChannelShape(
+        posts=args.posts,
+        album_ratio=args.album_ratio,
+        album_size=args.album_size,
+        photo_ratio=args.photo_ratio,
+        comments_per_post=args.comments_per_post,
+        media_bytes=args.media_kib * 1024,
+        seed=args.seed,
+    )
+    latency = Latency(
+        history=args.latency_ms / 1000,
+        replies=args.latency_ms / 1000,
+        reactions=args.latency_ms / 1000,
+        get_messages=args.latency_ms / 1000,
+        download=args.download_ms / 1000,
+    )
+    client = FakeTelegramClient([SyntheticChannel(shape, USERNAME)], latency)
+    set_up(config, base_dir, client)
+
+    def quiet():
+        if args.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(io.StringIO())
+
+    results = {"historical": await bench_historical(config, base_dir, client, quiet)}
+    channel, results["startup"] = bench_startup(config, base_dir, quiet)
+    results["realtime"] = await bench_realtime(
+        channel, client, args.realtime, args.realtime_rate, quiet
+    )
+    results["peak_rss_mib"] = peak_rss_mib()
+    return results
+
+
+def report(results):
+    historical = results["historical"]
+    realtime = results["realtime"]
+    startup = results["startup"]
+
+    def ms(p):
+        return f"p50 {p['p50']:.2f}  p95 {p['p95']:.2f}  p99 {p['p99']:.2f}  max {p['max']:.2f} ms"
+
+    print(
+        f"historical:  {historical['messages']} messages in {historical['seconds']:.2f}s "
+        f"= {historical['messages_per_second']:.0f} msg/s, "
+        f"media {historical['media_mib_per_second']:.1f} MiB/s"
+    )
+    print(f"  save:      {ms(historical['save_ms'])}")
+    print(f"  commit:    {ms(historical['commit_ms'])}")
+    print(f"  close:     {historical['close_seconds']:.2f}s")
+    print(
+        "  requests:  "
+        + ", ".join(f"{name} {count}" for name, count in historical["requests"].items())
+    )
+    print(
+        f"startup:     {startup['stored_messages']} stored messages opened in "
+        f"{startup['seconds']:.3f}s"
+    )
+    print(
+        f"real-time:   {realtime['messages']} messages in {realtime['seconds']:.2f}s "
+        f"= {realtime['messages_per_second']:.0f} msg/s in {realtime['flushes']} flushes "
+        f"(max depth {realtime['max_depth']})"
+    )
+    print(f"  latency:   {ms(realtime['latency_ms'])}")
+    rss = results["peak_rss_mib"]
+    print(f"peak RSS:    {'n/a' if rss is None else f'{rss:.1f} MiB'}")
+
+
+def metric(results, path):
+    value = results
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results, baseline, tolerance):
+    """Print the compared metrics; returns the names of the regressed ones"""
+    regressions = []
+    print(f"\nAgainst the baseline (tolerance {tolerance:.0%}):")
+    arguments = results["arguments"]
+    for name, previous in baseline.get("arguments", {}).items():
+        if name not in NOT_COMPARED and arguments.get(name) != previous:
+            print(f"  Warning: the baseline ran with --{name.replace('_', '-')} {previous}")
+    for path, higher_is_better in COMPARED.items():
+        current, previous = metric(results, path), metric(baseline, path)
+        if current is None or not previous:
+            continue
+        change = current / previous - 1
+        regressed = -change > tolerance if higher_is_better else change > tolerance
+        if regressed:
+            regressions.append(path)
+        flag = "REGRESSION" if regressed else "ok"
+        print(f"  {path:34} {previous:10.2f} -> {current:10.2f} ({change:+.1%}) {flag}")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    shape = parser.add_argument_group("synthetic channel")
+    shape.add_argument("--posts", type=int, default=1000)
+    shape.add_argument("--comments-per-post", type=int, default=5)
+    shape.add_argument("--album-ratio", type=float, default=0.1)
+    shape.add_argument("--album-size", type=int, default=4)
+    shape.add_argument("--photo-ratio", type=float, default=0.3)
+    shape.add_argument("--media-kib", type=int, default=64)
+    shape.add_argument("--seed", type=int, default=0)
+    shape.add_argument(
+        "--latency-ms", type=float, default=0, help="Per API request (default: 0)"
+    )
+    shape.add_argument(
+        "--download-ms", type=float, default=0, help="Per media download (default: 0)"
+    )
+
+    scraper = parser.add_argument_group("scraper")
+    scraper.add_argument(
+        "--backend", choices=["json", "sqlite", "sharded"], default="json"
+    )
+    scraper.add_argument("--comment-concurrency", type=int, default=1)
+    scraper.add_argument("--download-workers", type=int, default=4)
+    scraper.add_argument("--no-search-index", action="store_true")
+    scraper.add_argument("--transliterate", metavar="SCHEMA", help="e.g. scientific")
+    scraper.add_argument(
+        "--rate-limits", action="store_true", help="Keep the default request rates"
+    )
+    scraper.add_argument(
+        "--realtime", type=int, default=500, help="Real-time messages (default: 500)"
+    )
+    scraper.add_argument(
+        "--realtime-rate",
+        type=float,
+        default=0,
+        help="Real-time messages per second (default: as fast as possible)",
+    )
+    scraper.add_argument("--quiet-ms", type=int, default=10, help="realtime_quiet_ms")
+
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with results written by --output")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--keep", metavar="DIR", help="Run in DIR and keep the archive")
+    parser.add_argument("--verbose", action="store_true", help="Show scraper output")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.keep:
+        os.makedirs(args.keep, exist_ok=True)
+        results = asyncio.run(run(args, os.path.abspath(args.keep)))
+    else:
+        with tempfile.TemporaryDirectory() as base_dir:
+            results = asyncio.run(run(args, base_dir))
+
+    results["arguments"] = vars(args)
+    report(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+"""Local stand-in for ``TelegramClient`` serving synthetic channels.
+
+``SyntheticChannel`` generates a channel deterministically from a seed: posts
+with text, views, forwards and reactions, photo albums and comment threads.
+``FakeTelegramClient`` serves it through the parts of the Telethon API the
+scraper uses (``iter_messages``, ``get_messages``, ``download_media``,
+``GetMessageReactionsListRequest`` and ``NewMessage`` handlers), sleeping for
+a configurable latency per request so runs behave like a slow network without
+needing an account.
+"""
+
+import asyncio
+import os
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from telethon.tl.functions.messages import GetMessageReactionsListRequest
+
+CHANNEL_ID = 1000000001
+PAGE_SIZE = 100  # messages per history request, like Telegram
+
+WORDS = (
+    "сегодня новости канал фото видео город люди время работа день неделя "
+    "вопрос ответ обновление важно смотрите подробнее ссылка итоги"
+).split()
+EMOJI = ["👍", "❤", "🔥", "😁", "👏", "🤔"]
+COMMENTERS = [
+    (2000 + i, first, last, username)
+    for i, (first, last, username) in enumerate(
+        [
+            ("Ivan", "Petrov", "ivanp"),
+            ("Olena", None, "olena_k"),
+            ("Max", None, None),
+            ("Daria", "Sokolova", "dasha"),
+        ]
+    )
+]
+CHANNEL_POST = -1  # commenter index of comments posted by the channel itself
+
+
+@dataclass
+class Latency:
+    """Simulated seconds per request of each kind"""
+
+    history: float = 0.0  # per page of ``PAGE_SIZE`` messages
+    replies: float = 0.0  # per page of a comment thread
+    reactions: float = 0.0
+    get_messages: float = 0.0
+    download: float = 0.0
+    download_bytes_per_second: float = 0.0  # 0 means unlimited
+
+
+# --- Telethon-shaped objects -------------------------------------------------
+
+
+class PeerChannel:
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+
+
+class PeerUser:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+class User:
+    def __init__(self, user_id, first_name, last_name, username):
+        self.id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.username = username
+
+
+class ReactionEmoji:
+    def __init__(self, emoticon):
+        self.emoticon = emoticon
+
+
+class ReactionCount:
+    def __init__(self, emoticon, count):
+        self.reaction = ReactionEmoji(emoticon)
+        self.count = count
+
+
+class MessageReactions:
+    def __init__(self, results):
+        self.results = results
+
+
+class MessagePeerReaction:
+    def __init__(self, peer_id, emoticon):
+        self.peer_id = peer_id
+        self.reaction = ReactionEmoji(emoticon)
+
+
+class MessageReactionsList:
+    def __init__(self, reactions):
+        self.reactions = reactions
+
+
+class Photo:
+    def __init__(self, photo_id, size):
+        self.id = photo_id
+        self.size = size
+
+
+class MessageMediaPhoto:
+    # ``handle_message`` dispatches on the class name, like on Telethon's types
+    def __init__(self, photo):
+        self.photo = photo
+
+
+class FakeMessage:
+    """The attributes of ``telethon.tl.custom.Message`` the scraper reads"""
+
+    forward = None
+    document = None
+    file = None
+
+    def __init__(
+        self,
+        client,
+        msg_id,
+        date,
+        text,
+        sender=None,
+        reply_to_msg_id=None,
+        views=None,
+        forwards=None,
+        reactions=None,
+        photo=None,
+        grouped_id=None,
+    ):
+        self.client = client
+        self.id = msg_id
+        self.date = date
+        self.message = text
+        self.text = text
+        self.sender = sender
+        self.sender_id = sender.id if sender else None
+        self.reply_to_msg_id = reply_to_msg_id
+        self.views = views
+        self.forwards = forwards
+        self.reactions = reactions
+        self.photo = photo
+        self.media = MessageMediaPhoto(photo) if photo else None
+        self.grouped_id = grouped_id
+        self.peer_id = PeerChannel(CHANNEL_ID)
+        self.chat_id = -100 * 10**10 - CHANNEL_ID
+
+    async def download_media(self, file=None):
+        return await self.client.download_media(self, file=file)
+
+
+class NewMessageEvent:
+    def __init__(self, message):
+        self.message = message
+
+
+# --- Synthetic channel -------------------------------------------------------
+
+
+@dataclass
+class ChannelShape:
+    """How a synthetic channel looks"""
+
+    posts: int = 1000
+    album_ratio: float = 0.1  # share of posts that are photo albums
+    album_size: int = 4
+    photo_ratio: float = 0.3  # share of the other posts with a single photo
+    comments_per_post: int = 5  # average; the actual count varies per post
+    reaction_ratio: float = 0.5  # share of posts and comments with reactions
+    media_bytes: int = 64 * 1024
+    seed: int = 0
+
+
+class SyntheticChannel:
+    """Deterministic channel content generated from a ``ChannelShape``.
+
+    Channel posts get IDs ``1..`` (album members consecutive IDs sharing a
+    ``grouped_id``); comments live in the discussion group, numbered on their
+    own. Messages are built on request, so large channels cost little memory.
+    """
+
+    def __init__(self, shape, username="bench_channel"):
+        self.shape = shape
+        self.username = username
+        self.start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        rng = random.Random(shape.seed)
+
+        # Per channel message ID: (root ID, grouped_id or None, position)
+        self.layout = {}
+        self.comment_counts = {}  # root ID -> number of comments
+        self.comment_ids = {}  # root ID -> first comment ID
+        self.last_id = 0
+        next_comment_id = 1
+        for _ in range(shape.posts):
+            root_id = self.last_id + 1
+            if rng.random() < shape.album_ratio:
+                size = shape.album_size
+                grouped_id = 10**12 + root_id
+            else:
+                size = 1
+                grouped_id = None
+            for position in range(size):
+                self.layout[root_id + position] = (root_id, grouped_id, position)
+            self.last_id = root_id + size - 1
+            comments = (
+                rng.randint(0, 2 * shape.comments_per_post)
+                if shape.comments_per_post
+                else 0
+            )
+            self.comment_counts[root_id] = comments
+            self.comment_ids[root_id] = next_comment_id
+            next_comment_id += comments
+        self.total_comments = next_comment_id - 1
+        self.channel_user = User(None, None, None, username)
+
+    def _rng(self, kind, msg_id):
+        # Seeded with a string, which (unlike hash()) is stable across runs
+        return random.Random(f"{self.shape.seed}:{kind}:{msg_id}")
+
+    def _text(self, rng, words):
+        return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+    def _reactions(self, rng):
+        if rng.random() >= self.shape.reaction_ratio:
+            return None
+        return MessageReactions(
+            [
+                ReactionCount(emoticon, rng.randint(1, 50))
+                for emoticon in rng.sample(EMOJI, rng.randint(1, 3))
+            ]
+        )
+
+    def post(self, client, msg_id):
+        """Channel message ``msg_id``, or None past the end of the channel"""
+        if msg_id not in self.layout:
+            return None
+        root_id, grouped_id, position = self.layout[msg_id]
+        rng = self._rng("post", msg_id)
+        photo = None
+        if grouped_id or rng.random() < self.shape.photo_ratio:
+            photo = Photo(msg_id, self.shape.media_bytes)
+        return FakeMessage(
+            client,
+            msg_id,
+            self.start + timedelta(minutes=msg_id),
+            # Telegram puts an album's caption on its first message
+            self._text(rng, rng.randint(5, 60)) if position == 0 else "",
+            views=rng.randint(100, 100000),
+            forwards=rng.randint(0, 500),
+            reactions=self._reactions(rng),
+            photo=photo,
+            grouped_id=grouped_id,
+        )
+
+    def comments(self, client, root_id):
+        """Comment thread of a channel post, oldest first"""
+        first_id = self.comment_ids.get(root_id, 1)
+        for comment_id in range(first_id, first_id + self.comment_counts.get(root_id, 0)):
+            rng = self._rng("comment", comment_id)
+            index = rng.randrange(len(COMMENTERS) + 1) - 1
+            if index == CHANNEL_POST:
+                sender = self.channel_user
+                photo = Photo(10**9 + comment_id, self.shape.media_bytes)
+            else:
+                sender = User(*COMMENTERS[index])
+                photo = None
+            yield FakeMessage(
+                client,
+                comment_id,
+                self.start + timedelta(minutes=root_id, seconds=comment_id % 3600),
+                self._text(rng, rng.randint(1, 25)),
+                sender=sender,
+                reply_to_msg_id=root_id,
+                reactions=self._reactions(rng),
+                photo=photo,
+            )
+
+    def creator_reacted(self, msg_id):
+        """Whether the channel itself reacted to a comment"""
+        return self._rng("creator", msg_id).random() < 0.2
+
+
+class FakeTelegramClient:
+    """Serves ``SyntheticChannel``s with simulated latency.
+
+    New channel posts for real-time benchmarks are appended with
+    ``publish``, which runs the ``NewMessage`` handlers like Telethon's update
+    loop does.
+    """
+
+    def __init__(self, channels, latency=None):
+        self.channels = {channel.username: channel for channel in channels}
+        self.latency = latency or Latency()
+        self.handlers = []
+        self.requests = {}
+        self.downloaded_bytes = 0
+        self._connected = True
+        self._disconnected = asyncio.Event()
+
+    def _channel(self, entity):
+        if isinstance(entity, str):
+            return self.channels[entity]
+        # Media jobs resumed from the queue file refer to the chat ID
+        return next(iter(self.channels.values()))
+
+    async def _request(self, kind, seconds):
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        if seconds:
+            await asyncio.sleep(seconds)
+        else:
+            await asyncio.sleep(0)  # still yield, like a network call
+
+    # Connection
+
+    async def start(self):
+        self._connected = True
+        self._disconnected.clear()
+        return self
+
+    async def connect(self):
+        await self.start()
+
+    def is_connected(self):
+        return self._connected
+
+    async def disconnect(self):
+        self._connected = False
+        self._disconnected.set()
+
+    async def run_until_disconnected(self):
+        await self._disconnected.wait()
+
+    async def catch_up(self):
+        pass
+
+    # Requests
+
+    async def iter_messages(
+        self, entity, limit=None, offset_id=0, reverse=False, reply_to=None, ids=None
+    ):
+        channel = self._channel(entity)
+        if reply_to is not None:
+            messages = channel.comments(self, reply_to)
+            kind, latency = "replies", self.latency.replies
+        else:
+            ids = range(offset_id + 1, channel.last_id + 1)
+            messages = (channel.post(self, msg_id) for msg_id in ids)
+            kind, latency = "history", self.latency.history
+        if not reverse:
+            messages = reversed(list(messages))
+
+        yielded = 0
+        for msg in messages:
+            if reply_to is not None and offset_id and msg.id <= offset_id:
+                continue
+            if yielded % PAGE_SIZE == 0:
+                await self._request(kind, latency)
+            yield msg
+            yielded += 1
+            if limit is not None and yielded >= limit:
+                return
+
+    async def get_messages(self, entity, ids=None):
+        await self._request("get_messages", self.latency.get_messages)
+        return self._channel(entity).post(self, ids)
+
+    async def download_media(self, msg, file=None):
+        seconds = self.latency.download
+        if self.latency.download_bytes_per_second:
+            seconds += msg.photo.size / self.latency.download_bytes_per_second
+        await self._request("download", seconds)
+        os.makedirs(file, exist_ok=True)
+        path = os.path.join(file, f"photo_{msg.photo.id}.jpg")
+        # Content varies per photo, so deduplication does not link them all
+        content = msg.photo.id.to_bytes(8, "little") * (msg.photo.size // 8)
+        with open(path, "wb") as f:
+            f.write(content)
+        self.downloaded_bytes += len(content)
+        return path
+
+    async def __call__(self, request):
+        if not isinstance(request, GetMessageReactionsListRequest):
+            raise NotImplementedError(type(request).__name__)
+        await self._request("reactions", self.latency.reactions)
+        channel = next(iter(self.channels.values()))
+        reactions = []
+        if channel.creator_reacted(request.id):
+            reactions.append(MessagePeerReaction(PeerChannel(CHANNEL_ID), EMOJI[0]))
+        reactions.append(MessagePeerReaction(PeerUser(COMMENTERS[0][0]), EMOJI[1]))
+        return MessageReactionsList(reactions)
+
+    # Updates
+
+    def add_event_handler(self, callback, event=None):
+        chats = getattr(event, "chats", None)
+        self.handlers.append((callback, chats))
+
+    def on(self, event):
+        def decorator(callback):
+            self.add_event_handler(callback, event)
+            return callback
+
+        return decorator
+
+    async def publish(self, username, msg):
+        """Deliver a new message of ``username`` to the registered handlers"""
+        for callback, chats in self.handlers:
+            if chats is None or chats == username:
+                await callback(NewMessageEvent(msg))
+
+    def new_post(self, username):
+        """Append a post to a channel and return its message"""
+        channel = self.channels[username]
+        channel.last_id += 1
+        channel.layout[channel.last_id] = (channel.last_id, None, 0)
+        channel.comment_counts[channel.last_id] = 0
+        channel.comment_ids[channel.last_id] = channel.total_comments + 1
+        return channel.post(self, channel.last_id)
@@ -3,14 +3,23 @@ import argparse
 import os
 import sys
 import io
+import time
+from src.api_server import (
+    DEFAULT_CORS_ORIGIN,
+    DEFAULT_PORT,
+    ArchiveAPI,
+    make_server,
+    start_in_background,
+)
 from src.utils import (
     load_config,
     setup_transliteration_schema,
     setup_directories,
-    load_messages,
 )
+from src.channels import Channel, channel_configs
 from src.client_manager import TelegramClientManager
-from src.message_processor import MessageProcessor
+from src.media_store import MediaStore
+from src import metrics
 
 # Set stdout to handle UTF-8 and flush on newline (line buffering)
 try:
@@ -26,23 +35,156 @@ except Exception:
 c = load_config()
 transliteration_schema = setup_transliteration_schema(c)
 
-# Setup paths and load existing messages
+# Setup paths
 current_dir = os.path.dirname(os.path.abspath(__file__))
-output_json_path = os.path.join(current_dir, c["output_json"])
-all_messages = load_messages(output_json_path)
+
+
+def search(channels, query, limit, reindex=False):
+    """Print the best full-text matches in each channel"""
+    for channel in channels:
+        search_index = channel.open_search_index()
+        if reindex:
+            search_index.rebuild(channel.store)
+        if query:
+            start_time = time.perf_counter()
+            hits = search_index.search(query, limit)
+            elapsed = (time.perf_counter() - start_time) * 1000
+            print(f"{len(hits)} matches in {channel.username} ({elapsed:.1f} ms)")
+            for hit in hits:
+                where = f"#{hit['root_id']}"
+                if hit["is_comment"]:
+                    where += f" comment {hit['id']}"
+                print(f"  {where} [{hit['field']}]: {hit['snippet']}")
+        search_index.close()
+
+
+def print_history(channels, message_id):
+    """Print the engagement snapshots of a message in each channel"""
+    for channel in channels:
+        history = channel.open_engagement_history()
+        series = history.history(message_id)
+        history.close()
+        if not series:
+            print(f"No engagement history for #{message_id} in {channel.username}")
+            continue
+        print(f"Engagement history of #{message_id} in {channel.username}:")
+        for i, timestamp in enumerate(series["time"]):
+            reactions = ", ".join(
+                f"{key} {counts[i]}"
+                for key, counts in series["reactions"].items()
+                if counts[i]
+            )
+            print(
+                f"  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}: "
+                f"{series['views'][i]} views, {series['forwards'][i]} forwards"
+                + (f", {reactions}" if reactions else "")
+            )
+
+
+def dedupe_media():
+    """Replace duplicate files in the media folders with hard links"""
+    media_store = MediaStore.from_config(c, current_dir)
+    folders = []
+    for channel_config in channel_configs(c):
+        for key in ("media_folder", "media_comments_folder"):
+            if not channel_config[key]:
+                # Unset: the scraper directory itself, with its session file
+                print(f"Skipping unset {key} of {channel_config['channel_username']}")
+                continue
+            folder = os.path.join(current_dir, channel_config[key])
+            if folder not in folders:
+                folders.append(folder)
+    linked, freed = media_store.dedupe_folders(folders)
+    print(f"Linked {linked} duplicate media files, freeing {freed / 2**20:.1f} MiB")
 
 
 async def main(args=None):
-    setup_directories(c["media_folder"], c["media_comments_folder"], current_dir)
+    channels = [Channel(config, current_dir) for config in channel_configs(c)]
+
+    # Existing messages are indexed only once arguments have been parsed
+    for channel in channels:
+        start_time = time.perf_counter()
+        store = channel.open_store()
+        print(
+            f"Indexed {store.count()} stored messages of {channel.username} "
+            f"in {time.perf_counter() - start_time:.2f}s"
+        )
+
+    if args and args.export_json:
+        for channel in channels:
+            channel.store.export_json()
+            print(f"Wrote {channel.store.count()} messages to {channel.output_json_path}")
+            channel.close()
+        return
+
+    if args and (args.search or args.reindex_search):
+        search(channels, args.search, args.search_limit, args.reindex_search)
+        for channel in channels:
+            channel.close()
+        return
+
+    if args and args.history is not None:
+        print_history(channels, args.history)
+        for channel in channels:
+            channel.close()
+        return
+
+    if args and args.serve:
+        port = args.port or c.get("api_port") or DEFAULT_PORT
+        server = make_server(
+            ArchiveAPI.from_channels(
+                channels,
+                current_dir,
+                c.get("api_cors_origin", DEFAULT_CORS_ORIGIN),
+            ),
+            c.get("api_host", "127.0.0.1"),
+            port,
+        )
+        print(f"Serving the archive API on http://{server.server_address[0]}:{port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            for channel in channels:
+                channel.close()
+        return
+
+    for channel in channels:
+        setup_directories(
+            channel.config["media_folder"],
+            channel.config["media_comments_folder"],
+            current_dir,
+        )
+        # Initialize the message processor and media queue
+        channel.open()
+
+    # Serve the live archive to the viewer while scraping
+    if c.get("api_port"):
+        start_in_background(
+            ArchiveAPI.from_channels(
+                channels,
+                current_dir,
+                c.get("api_cors_origin", DEFAULT_CORS_ORIGIN),
+            ),
+            c.get("api_host", "127.0.0.1"),
+            c["api_port"],
+        )
+
+    if c.get("metrics_port"):
+        metrics.start_in_background(c.get("api_host", "127.0.0.1"), c["metrics_port"])
 
-    # Initialize message processor and client manager
-    message_processor = MessageProcessor(all_messages, output_json_path)
     client_manager = TelegramClientManager(
-        c, transliteration_schema, current_dir, message_processor
+        c, transliteration_schema, current_dir, channels
     )
 
-    # Run with automatic reconnection
-    await client_manager.run_with_reconnection(output_json_path, args)
+    try:
+        # Run with automatic reconnection
+        await client_manager.run_with_reconnection(args)
+    finally:
+        for channel in channels:
+            channel.close()
 
 
 def parse_arguments():
@@ -54,9 +196,9 @@ def parse_arguments():
     parser.add_argument(
         "--mode",
         "-m",
-        choices=["1", "2", "historical", "realtime"],
+        choices=["1", "2", "3", "historical", "realtime", "refresh"],
         default="2",
-        help="Operating mode: 1/historical = Historical Sync, 2/realtime = Real-time Listening (default: 2)",
+        help="Operating mode: 1/historical = Historical Sync, 2/realtime = Real-time Listening, 3/refresh = Refresh views, forwards and reactions of stored messages (default: 2)",
     )
 
     parser.add_argument(
@@ -73,6 +215,81 @@ def parse_arguments():
         help="Maximum number of messages to process in historical sync (default: no limit)",
     )
 
+    parser.add_argument(
+        "--comment-concurrency",
+        "-c",
+        type=int,
+        help="Number of comment threads fetched concurrently in historical sync (default: comment_fetch_concurrency from config, or 1)",
+    )
+
+    parser.add_argument(
+        "--refresh-days",
+        type=int,
+        help="Refresh mode: refresh messages posted in the last N days (default: 30)",
+    )
+
+    parser.add_argument(
+        "--from-id",
+        type=int,
+        help="Refresh mode: first message ID to refresh (instead of --refresh-days)",
+    )
+
+    parser.add_argument(
+        "--to-id",
+        type=int,
+        help="Refresh mode: last message ID to refresh (default: the newest)",
+    )
+
+    parser.add_argument(
+        "--export-json",
+        action="store_true",
+        help="Bring the output JSON file up to date with the message store and exit",
+    )
+
+    parser.add_argument(
+        "--dedupe-media",
+        action="store_true",
+        help="Replace duplicate files in the media folders with hard links and exit",
+    )
+
+    parser.add_argument(
+        "--search",
+        metavar="QUERY",
+        help="Search messages and comments in the full-text index and exit (SQLite FTS5 syntax, e.g. 'word*' or '\"exact phrase\"')",
+    )
+
+    parser.add_argument(
+        "--search-limit",
+        type=int,
+        default=20,
+        help="Maximum number of matches printed by --search per channel (default: 20)",
+    )
+
+    parser.add_argument(
+        "--reindex-search",
+        action="store_true",
+        help="Rebuild the full-text index from the message store (e.g. after running the translation scripts) and exit",
+    )
+
+    parser.add_argument(
+        "--history",
+        type=int,
+        metavar="MESSAGE_ID",
+        help="Print the recorded views, forwards and reactions of a message over time and exit",
+    )
+
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Serve the stored archive over a local HTTP API for the viewer without connecting to Telegram",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        help=f"Port for --serve (default: api_port from config, or {DEFAULT_PORT})",
+    )
+
     parser.add_argument(
         "--no-prompts",
         "-n",
@@ -85,4 +302,7 @@ def parse_arguments():
 
 if __name__ == "__main__":
     args = parse_arguments()
-    asyncio.run(main(args))
+    if args.dedupe_media:
+        dedupe_media()
+    else:
+        asyncio.run(main(args))
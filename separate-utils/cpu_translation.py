@@ -0,0 +1,234 @@
+"""Length-bucketed, multi-process NLLB translation for machines without a GPU.
+
+Texts are split at sentence boundaries into chunks that fit the model, sorted
+by token count and grouped into batches of similar length, so a long post no
+longer pads a whole batch. Batches run in a pool of processes, each limited to
+``threads_per_worker`` torch threads so the workers do not oversubscribe the
+cores. Every text is handed to ``on_done`` as soon as all of its chunks are
+translated, so callers can stream results to disk.
+"""
+
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from tqdm import tqdm
+
+MAX_TOKENS = 256  # chunk size; NLLB quality drops well before its 512 limit
+MAX_BATCH_TOKENS = 4096  # padded tokens per batch
+MAX_BATCH_SIZE = 32
+
+# The whitespace after a sentence is captured, so it can be restored
+SENTENCE_END = re.compile(r"((?<=[.!?…])\s+|\s*\n\s*)")
+
+# State of a worker process, set by _init_worker
+_worker = {}
+
+
+def split_text(text, count_tokens, max_tokens=MAX_TOKENS):
+    """Split a text into chunks of at most ``max_tokens`` at sentence boundaries.
+
+    A single sentence that is still too long is split between words. Returns
+    ``(chunk, separator)`` pairs, where ``separator`` is the whitespace that
+    followed the chunk in ``text`` (such as a paragraph break), so that
+    translated chunks can be joined with the same layout.
+    """
+    if count_tokens(text) <= max_tokens:
+        return [(text, "")]
+
+    pieces = []
+    parts = SENTENCE_END.split(text.strip())
+    for k in range(0, len(parts), 2):
+        sentence = parts[k].strip()
+        separator = parts[k + 1] if k + 1 < len(parts) else ""
+        if not sentence:
+            continue
+        if count_tokens(sentence) <= max_tokens:
+            pieces.append((sentence, separator))
+            continue
+        words = []
+        for word in sentence.split():
+            if words and count_tokens(" ".join(words + [word])) > max_tokens:
+                pieces.append((" ".join(words), " "))
+                words = []
+            words.append(word)
+        pieces.append((" ".join(words), separator))
+
+    # Greedily pack consecutive sentences back together
+    chunks = []
+    for piece, separator in pieces:
+        if chunks:
+            last, last_separator = chunks[-1]
+            packed = f"{last}{last_separator}{piece}"
+            if count_tokens(packed) <= max_tokens:
+                chunks[-1] = (packed, separator)
+                continue
+        chunks.append((piece, separator))
+    return chunks
+
+
+def make_batches(
+    lengths, max_batch_tokens=MAX_BATCH_TOKENS, max_batch_size=MAX_BATCH_SIZE
+):
+    """Group item indices into batches of similar token length.
+
+    Items are sorted by length; a batch grows until its padded size (items
+    times the longest item) would exceed ``max_batch_tokens``.
+    """
+    batches = []
+    batch = []
+    for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # Sorted ascending, so the item being added is the batch's longest
+        if batch and (
+            len(batch) >= max_batch_size
+            or (len(batch) + 1) * lengths[index] > max_batch_tokens
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _init_worker(model_name, src_lang, tgt_lang, threads):
+    import torch
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+    torch.set_num_threads(threads)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, src_lang=src_lang)
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+    model.eval()
+    _worker.update(
+        tokenizer=tokenizer,
+        model=model,
+        bos=tokenizer.convert_tokens_to_ids(tgt_lang),
+    )
+
+
+def _translate_batch(texts):
+    import torch
+
+    tokenizer = _worker["tokenizer"]
+    inputs = tokenizer(texts, return_tensors="pt", padding=True)
+    with torch.inference_mode():
+        generated_tokens = _worker["model"].generate(
+            **inputs,
+            forced_bos_token_id=_worker["bos"],
+            max_new_tokens=int(inputs["input_ids"].shape[1] * 1.5) + 10,
+        )
+    return tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+
+
+class CpuTranslator:
+    def __init__(
+        self,
+        model_name,
+        src_lang,
+        tgt_lang,
+        workers=None,
+        threads_per_worker=None,
+        max_tokens=MAX_TOKENS,
+    ):
+        cpus = os.cpu_count() or 1
+        self.workers = workers or max(1, min(4, cpus // 4))
+        self.threads_per_worker = threads_per_worker or max(1, cpus // self.workers)
+        self.model_name = model_name
+        self.src_lang = src_lang
+        self.tgt_lang = tgt_lang
+        self.max_tokens = max_tokens
+        self._pool = None  # started on first use, reused across calls
+
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, src_lang=src_lang)
+
+    def _get_pool(self):
+        """Worker processes with the model loaded, started once"""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                initializer=_init_worker,
+                initargs=(
+                    self.model_name,
+                    self.src_lang,
+                    self.tgt_lang,
+                    self.threads_per_worker,
+                ),
+            )
+        return self._pool
+
+    def close(self):
+        """Stop the worker processes"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def count_tokens(self, text):
+        return len(self.tokenizer(text)["input_ids"])
+
+    def translate(self, texts, on_done):
+        """Translate ``texts``, calling ``on_done({text: translation})`` as they finish"""
+        chunks = []  # (text index, chunk)
+        separators = []  # whitespace after each chunk in its text
+        text_chunks = []  # chunk indices, per text
+        for i, text in enumerate(texts):
+            text_chunks.append([])
+            for chunk, separator in split_text(
+                text, self.count_tokens, self.max_tokens
+            ):
+                text_chunks[i].append(len(chunks))
+                chunks.append((i, chunk))
+                separators.append(separator)
+        lengths = [
+            len(ids)
+            for ids in self.tokenizer([chunk for _, chunk in chunks])["input_ids"]
+        ]
+        batches = make_batches(lengths)
+        print(
+            f"Translating {len(texts)} texts as {len(chunks)} chunks in "
+            f"{len(batches)} batches on {self.workers} workers x "
+            f"{self.threads_per_worker} threads"
+        )
+
+        remaining = [len(indices) for indices in text_chunks]
+        results = [None] * len(chunks)
+
+        pool = self._get_pool()
+        # Keep a couple of batches queued per worker
+        pending = {}
+        batch_iter = iter(batches)
+        progress = tqdm(total=len(batches), desc="Translating Batches")
+
+        def submit():
+            batch = next(batch_iter, None)
+            if batch is not None:
+                batch_texts = [chunks[j][1] for j in batch]
+                pending[pool.submit(_translate_batch, batch_texts)] = batch
+
+        for _ in range(self.workers * 2):
+            submit()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                progress.update(1)
+                submit()
+                try:
+                    translations = future.result()
+                except Exception as e:
+                    # Left untranslated, so the next run retries them
+                    print(f"⚠️ Error translating a batch of {len(batch)}: {e}")
+                    continue
+                finished = {}
+                for j, translation in zip(batch, translations):
+                    results[j] = translation
+                    i = chunks[j][0]
+                    remaining[i] -= 1
+                    if remaining[i] == 0:
+                        finished[texts[i]] = "".join(
+                            results[k] + separators[k] for k in text_chunks[i]
+                        )
+                if finished:
+                    on_done(finished)
+        progress.close()
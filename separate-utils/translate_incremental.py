@@ -0,0 +1,210 @@
+"""Translate only the texts of the archive that have no translation yet.
+
+Every ``message`` and ``messageV{n}`` edit of root messages and comments gets a
+``message_translated`` / ``message_translatedV{n}`` field. Translations are
+cached by source text hash, model and language pair in ``CACHE_PATH``, and
+merged back into the archive through the scraper's message store (so only the
+changed records are journaled, whatever ``storage_backend`` is configured).
+Stop the scraper while this runs.
+"""
+
+import os
+import re
+import sys
+import time
+
+from tqdm import tqdm
+
+from cpu_translation import CpuTranslator
+from translation_cache import TranslationCache
+from utils import insert_after_key
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from src.channels import channel_configs  # noqa: E402
+from src.search_index import SearchIndex  # noqa: E402
+from src.storage import open_store  # noqa: E402
+from src.utils import load_config  # noqa: E402
+
+# --- CONFIGURATION ---
+MODEL_NAME = "facebook/nllb-200-distilled-1.3B"
+SRC_LANG = "rus_Cyrl"
+TGT_LANG = "eng_Latn"
+BATCH_SIZE = 16
+MAX_LENGTH = 512
+# Without a GPU: processes, and torch threads per process (None = by CPU count)
+CPU_WORKERS = None
+CPU_THREADS_PER_WORKER = None
+CACHE_PATH = os.path.join(ROOT_DIR, "translation-cache.db")
+
+SOURCE_FIELD = re.compile(r"^message(V\d+)?$")
+TRANSLATED_KEY = "message_translated"
+
+
+def pending_fields(target):
+    """(source key, translated key, text) of the untranslated texts of a record"""
+    pending = []
+    for key, text in target.items():
+        match = SOURCE_FIELD.match(key)
+        if not match or not isinstance(text, str) or not text.strip():
+            continue
+        translated_key = TRANSLATED_KEY + (match.group(1) or "")
+        if translated_key not in target:
+            pending.append((key, translated_key, text))
+    return pending
+
+
+def collect_pending(store):
+    """Root records with untranslated texts, by ID, and the set of those texts"""
+    records = {}
+    texts = set()
+    for record in store.iter_messages():
+        found = False
+        for target in [record, *record.get("comments", [])]:
+            for _, _, text in pending_fields(target):
+                texts.add(text)
+                found = True
+        if found:
+            records[record["id"]] = record
+    return records, texts
+
+
+class GpuTranslator:
+    """NLLB model on the GPU"""
+
+    def __init__(self):
+        self.tokenizer = None
+        self.model = None
+
+    def _load(self):
+        from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+
+        print("🔄 Loading model...")
+        start_time = time.time()
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, src_lang=SRC_LANG)
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(MODEL_NAME).to("cuda")
+        print(
+            f"✅ Model loaded on {self.model.device} in {time.time() - start_time:.2f} seconds"
+        )
+
+    def translate_batch(self, texts):
+        if self.model is None:
+            self._load()
+        inputs = self.tokenizer(
+            texts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=MAX_LENGTH,
+        ).to(self.model.device)
+        generated_tokens = self.model.generate(
+            **inputs,
+            forced_bos_token_id=self.tokenizer.convert_tokens_to_ids(TGT_LANG),
+            max_length=MAX_LENGTH,
+        )
+        return self.tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
+
+
+def make_translator():
+    """The GPU translator if CUDA is available, the multi-process CPU one otherwise"""
+    import torch
+
+    if torch.cuda.is_available():
+        return GpuTranslator()
+    return CpuTranslator(
+        MODEL_NAME, SRC_LANG, TGT_LANG, CPU_WORKERS, CPU_THREADS_PER_WORKER
+    )
+
+
+def translate_missing(texts, cache, translator):
+    """Translate texts that are not cached yet, caching each finished batch"""
+    if isinstance(translator, CpuTranslator):
+        translator.translate(sorted(texts), cache.put_many)
+        return
+
+    texts = sorted(texts, key=len)  # similar lengths pad less
+    for i in tqdm(range(0, len(texts), BATCH_SIZE), desc="Translating Batches"):
+        batch = texts[i : i + BATCH_SIZE]
+        try:
+            translations = translator.translate_batch(batch)
+        except Exception as e:
+            # Left untranslated, so the next run retries them
+            print(f"⚠️ Error processing batch starting at index {i}: {e}")
+            continue
+        cache.put_many(dict(zip(batch, translations)))
+
+
+def merge(records, translations, store, search_index=None):
+    """Add the translations to the records and save the changed ones"""
+    merged = 0
+    for record in records.values():
+        touched = []
+        root_changed = False
+        for position, target in enumerate([record, *record.get("comments", [])]):
+            updated = target
+            for key, translated_key, text in pending_fields(target):
+                if text in translations:
+                    updated = insert_after_key(
+                        updated, key, translated_key, translations[text]
+                    )
+                    merged += 1
+            if updated is target:
+                continue
+            if position == 0:
+                record = updated
+                root_changed = True
+            else:
+                record["comments"][position - 1] = updated
+                touched.append(updated)
+        if root_changed or touched:
+            store.upsert_message(record, comments=touched)
+            if search_index:
+                search_index.update(record, comments=touched)
+    store.commit()
+    if search_index:
+        search_index.commit()
+    return merged
+
+
+def main():
+    config = load_config()
+    cache = TranslationCache(CACHE_PATH, MODEL_NAME, SRC_LANG, TGT_LANG)
+    # Loaded once and shared by every channel
+    translator = None
+
+    for channel_config in channel_configs(config):
+        print(f"📂 Scanning {channel_config['output_json']}...")
+        store = open_store(channel_config, ROOT_DIR)
+        records, texts = collect_pending(store)
+        translations = cache.get_many(texts)
+        missing = texts - translations.keys()
+        print(
+            f"Found {len(texts)} untranslated texts in {len(records)} messages, "
+            f"{len(translations)} of them cached"
+        )
+
+        if missing:
+            print("🌐 Translating new texts in batches...")
+            if translator is None:
+                translator = make_translator()
+            translate_missing(missing, cache, translator)
+            translations.update(cache.get_many(missing))
+
+        search_index = None
+        if channel_config.get("search_index", True):
+            search_index = SearchIndex.from_config(channel_config, ROOT_DIR).open(store)
+        print("💾 Merging translations into the archive...")
+        merged = merge(records, translations, store, search_index)
+        if search_index:
+            search_index.close()
+        store.close()
+        print(f"✅ Added {merged} translations")
+
+    if isinstance(translator, CpuTranslator):
+        translator.close()
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
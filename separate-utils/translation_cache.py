@@ -0,0 +1,55 @@
+import hashlib
+import sqlite3
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+    """Persistent translations keyed by source text hash, model and language pair.
+
+    A text seen before (a repost, a re-run after a crash, another channel) is
+    never translated twice by the same model.
+    """
+
+    def __init__(self, path, model, src_lang, tgt_lang):
+        self.model = model
+        self.src_lang = src_lang
+        self.tgt_lang = tgt_lang
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "text_hash TEXT NOT NULL, model TEXT NOT NULL, "
+            "src_lang TEXT NOT NULL, tgt_lang TEXT NOT NULL, "
+            "translation TEXT NOT NULL, "
+            "PRIMARY KEY (text_hash, model, src_lang, tgt_lang)) WITHOUT ROWID"
+        )
+
+    def get_many(self, texts):
+        """Cached translations of ``texts``, by text"""
+        found = {}
+        for text in texts:
+            row = self.conn.execute(
+                "SELECT translation FROM translations WHERE text_hash = ? "
+                "AND model = ? AND src_lang = ? AND tgt_lang = ?",
+                (text_hash(text), self.model, self.src_lang, self.tgt_lang),
+            ).fetchone()
+            if row is not None:
+                found[text] = row[0]
+        return found
+
+    def put_many(self, translations):
+        """Store ``{text: translation}`` and commit, so finished batches survive a crash"""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)",
+            [
+                (text_hash(text), self.model, self.src_lang, self.tgt_lang, translation)
+                for text, translation in translations.items()
+            ],
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -1,75 +1,203 @@
+"""Add or remove a transliteration field across the whole archive.
+
+Only records lacking the key (when adding) or carrying it (when removing) are
+touched, and they are saved through the scraper's message store, so just the
+changed messages are journaled. Texts are transliterated by a pool of
+processes. ``message`` gets ``<key>`` and every ``messageV{n}`` edit gets
+``<key>V{n}``, like the scraper does. Stop the scraper while this runs.
+
+    python transliterate.py                      # add transliterate_key from config.json
+    python transliterate.py --remove             # remove it again
+    python transliterate.py --test               # compare schemas on a sample
+"""
+
+import argparse
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
 import iuliia
-import json
 from tqdm import tqdm
 
-test = False
-add_transliteration = False  # Set to True to add, False to remove
-schema = iuliia.schemas.get("scientific")
-new_key = "message_latin_scientific"
-
-
-def transliterate(text: str) -> str:
-    return schema.translate(text).replace("X", "H").replace("x", "h")
-
-
-def add_transliterations(messages):
-    """Add transliteration to messages and comments"""
-    for msg in tqdm(messages, desc="Adding transliteration"):
-        if "message" in msg:
-            try:
-                msg[new_key] = transliterate(msg["message"])
-            except Exception as e:
-                print(f"Error Transliterating message ID {msg.get('id')}: {e}")
-                msg[new_key] = ""
-        if "comments" in msg:
-            for comment in msg["comments"]:
-                if "message" in comment:
-                    try:
-                        comment[new_key] = transliterate(comment["message"])
-                    except Exception as e:
-                        print(
-                            f"Error Transliterating comment ID {comment.get('id')}: {e}"
-                        )
-                        comment[new_key] = ""
-
-
-def remove_transliterations(messages):
-    """Remove transliteration from messages and comments"""
-    for msg in tqdm(messages, desc="Removing transliteration"):
-        if new_key in msg:
-            del msg[new_key]
-            print(f"Removed {new_key} from message ID {msg.get('id')}")
-        if "comments" in msg:
-            for comment in msg["comments"]:
-                if new_key in comment:
-                    del comment[new_key]
-                    print(f"Removed {new_key} from comment ID {comment.get('id')}")
-
-
-if test:
+from utils import insert_after_key
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from src.channels import channel_configs  # noqa: E402
+from src.search_index import SearchIndex  # noqa: E402
+from src.storage import open_store  # noqa: E402
+from src.transliteration import Transliterator  # noqa: E402
+from src.utils import load_config  # noqa: E402
+
+DEFAULT_SCHEMA = "scientific"
+DEFAULT_KEY = "message_latin_scientific"
+CHUNK_TEXTS = 2000  # texts per task sent to a worker
+
+SOURCE_FIELD = re.compile(r"^message(V\d+)?$")
+
+# Transliterator of a worker process, set by _init_worker
+_transliterator = None
+
+
+def _init_worker(schema_name):
+    global _transliterator
+    _transliterator = Transliterator(iuliia.schemas.get(schema_name))
+
+
+def _transliterate_many(texts):
+    return [_transliterator(text) for text in texts]
+
+
+def missing_fields(target, key):
+    """(source key, transliterated key, text) lacking a transliteration"""
+    missing = []
+    for source_key, text in target.items():
+        match = SOURCE_FIELD.match(source_key)
+        if not match or not isinstance(text, str) or not text:
+            continue
+        new_key = key + (match.group(1) or "")
+        if new_key not in target:
+            missing.append((source_key, new_key, text))
+    return missing
+
+
+def carried_fields(target, key):
+    pattern = re.compile(rf"^{re.escape(key)}(V\d+)?$")
+    return [field for field in target if pattern.match(field)]
+
+
+def save(store, search_index, record, touched):
+    store.upsert_message(record, comments=touched)
+    if search_index:
+        search_index.update(record, comments=touched)
+
+
+def add_transliterations(store, key, schema_name, workers, search_index=None):
+    """Transliterate the texts lacking ``key``; returns the number added"""
+    records = {}
+    texts = set()
+    for record in tqdm(store.iter_messages(), desc="Scanning"):
+        found = False
+        for target in [record, *record.get("comments", [])]:
+            for _, _, text in missing_fields(target, key):
+                texts.add(text)
+                found = True
+        if found:
+            records[record["id"]] = record
+    print(f"Found {len(texts)} texts to transliterate in {len(records)} messages")
+    if not texts:
+        return 0
+
+    texts = list(texts)
+    chunks = [texts[i : i + CHUNK_TEXTS] for i in range(0, len(texts), CHUNK_TEXTS)]
+    transliterated = {}
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(schema_name,)
+    ) as pool:
+        for chunk, results in zip(
+            chunks,
+            tqdm(pool.map(_transliterate_many, chunks), desc="Transliterating"),
+        ):
+            transliterated.update(zip(chunk, results))
+
+    added = 0
+    for record in records.values():
+        touched = []
+        for position, target in enumerate([record, *record.get("comments", [])]):
+            updated = target
+            for source_key, new_key, text in missing_fields(target, key):
+                updated = insert_after_key(
+                    updated, source_key, new_key, transliterated[text]
+                )
+                added += 1
+            if updated is target:
+                continue
+            if position == 0:
+                record = updated
+            else:
+                record["comments"][position - 1] = updated
+                touched.append(updated)
+        save(store, search_index, record, touched)
+    store.commit()
+    return added
+
+
+def remove_transliterations(store, key, search_index=None):
+    """Remove ``key`` and its versions; returns the number removed"""
+    removed = 0
+    changed = []
+    for record in tqdm(store.iter_messages(), desc="Removing transliteration"):
+        touched = []
+        root_changed = False
+        for target in [record, *record.get("comments", [])]:
+            fields = carried_fields(target, key)
+            for field in fields:
+                del target[field]
+            if fields:
+                removed += len(fields)
+                if target is record:
+                    root_changed = True
+                else:
+                    touched.append(target)
+        if root_changed or touched:
+            changed.append((record, touched))
+    # Saved after the scan, which must not see its own changes
+    for record, touched in changed:
+        save(store, search_index, record, touched)
+    store.commit()
+    return removed
+
+
+def test():
     text = """Юлия Щеглова, Хрущёв, Счастье, Любовь"""
 
     for name, s in iuliia.schemas.items():
         print(name, "\t\t", s.translate(text))
 
-    print("Modified Scientific Schema:\n", transliterate(text))
-    exit()
-
-# -------------------------
-
-print("Loading messages.json...")
-with open("../messages.json", "r", encoding="utf-8") as f:
-    messages = json.load(f)
-
-if add_transliteration:
-    add_transliterations(messages)
-    action = "Addition"
-else:
-    remove_transliterations(messages)
-    action = "Removal"
-
-print("Saving to messages.json...")
-with open("../messages.json", "w", encoding="utf-8") as f:
-    json.dump(messages, f, ensure_ascii=False, indent=2)
-
-print(f"{action} complete!")
+    transliterator = Transliterator(iuliia.schemas.get(DEFAULT_SCHEMA))
+    print("Modified Scientific Schema:\n", transliterator(text))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--remove", action="store_true", help="Remove the key")
+    parser.add_argument("--key", help="Field name (default: transliterate_key)")
+    parser.add_argument("--schema", help="iuliia schema (default: transliterate_schema)")
+    parser.add_argument("--workers", type=int, help="Processes (default: one per CPU)")
+    parser.add_argument("--test", action="store_true", help="Compare schemas and exit")
+    args = parser.parse_args()
+
+    if args.test:
+        test()
+        return
+
+    config = load_config()
+    key = args.key or config.get("transliterate_key") or DEFAULT_KEY
+    schema_name = args.schema or config.get("transliterate_schema") or DEFAULT_SCHEMA
+
+    for channel_config in channel_configs(config):
+        print(f"Loading {channel_config['output_json']}...")
+        store = open_store(channel_config, ROOT_DIR)
+        # The index covers the configured transliterate_key only
+        search_index = None
+        if channel_config.get("search_index", True) and key == config.get(
+            "transliterate_key"
+        ):
+            search_index = SearchIndex.from_config(channel_config, ROOT_DIR).open(store)
+        if args.remove:
+            count = remove_transliterations(store, key, search_index)
+            print(f"Removed {count} {key} fields")
+        else:
+            count = add_transliterations(
+                store, key, schema_name, args.workers, search_index
+            )
+            print(f"Added {count} {key} fields")
+        if search_index:
+            search_index.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""Local read-only HTTP API serving the archive to telegram-viewer"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import fnmatch
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+DEFAULT_PORT = 8765
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_CHUNK = 64 * 1024
+# Origin of the Vite dev server running telegram-viewer
+DEFAULT_CORS_ORIGIN = "http://localhost:5173"
+# Files never served even if a media folder contains them (Telegram auth key,
+# API credentials)
+PRIVATE_FILES = ("*.session", "*.session-journal", "config*.json")
+
+MESSAGE_PATH = re.compile(r"^/api/messages/(-?\d+)(/comments)?$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ArchiveAPI:
+    """Pagination and lookups over the message stores of one or more channels.
+
+    Root messages are listed without their comments (``comment_count`` tells
+    how many there are); a thread is fetched on demand, also paginated.
+    Cursors are message IDs, so pages stay stable while messages are added.
+    The stores are read from the handler threads while the scraper writes to
+    them; every storage backend supports that on its own.
+    """
+
+    def __init__(
+        self, stores, base_dir, media_folders, cors_origin=DEFAULT_CORS_ORIGIN
+    ):
+        self.stores = stores  # channel username -> store, first is the default
+        self.base_dir = base_dir
+        self.cors_origin = cors_origin
+        self.media_roots = []
+        base = os.path.realpath(base_dir)
+        for folder in media_folders:
+            root = os.path.realpath(os.path.join(base_dir, folder))
+            if root == base or base.startswith(root + os.sep):
+                # Would expose the session file and config.json
+                print(
+                    f"Not serving media folder {folder!r}: media folders must be "
+                    "subfolders of the scraper directory"
+                )
+                continue
+            self.media_roots.append(root)
+        self._lock = threading.Lock()  # guards _sorted_ids
+        self._sorted_ids = {}  # channel -> (count, sorted root IDs)
+
+    @classmethod
+    def from_channels(cls, channels, base_dir, cors_origin=DEFAULT_CORS_ORIGIN):
+        folders = []
+        for channel in channels:
+            for key in ("media_folder", "media_comments_folder"):
+                if channel.config[key] not in folders:
+                    folders.append(channel.config[key])
+        stores = {channel.username: channel.store for channel in channels}
+        return cls(stores, base_dir, folders, cors_origin)
+
+    def store(self, channel=None):
+        if channel is None:
+            channel = next(iter(self.stores))
+        if channel not in self.stores:
+            raise KeyError(channel)
+        return channel, self.stores[channel]
+
+    def _ids(self, channel, store):
+        count = store.count()
+        with self._lock:
+            cached = self._sorted_ids.get(channel)
+            if cached is None or cached[0] != count:
+                cached = (count, sorted(store.message_ids()))
+                self._sorted_ids[channel] = cached
+        return cached[1]
+
+    def channels(self):
+        return [
+            {"channel": channel, "count": store.count()}
+            for channel, store in self.stores.items()
+        ]
+
+    def messages(self, channel=None, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+        """A page of root messages.
+
+        Without ``after`` the page goes backwards from ``before`` (or from the
+        newest message); with ``after`` it goes forwards. ``next_cursor`` is
+        the value to pass as ``before``/``after`` for the following page.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        channel, store = self.store(channel)
+        ids = self._ids(channel, store)
+        if after is not None:
+            start = bisect_right(ids, after)
+            page_ids = ids[start : start + limit]
+            more = start + limit < len(ids)
+        else:
+            end = len(ids) if before is None else bisect_left(ids, before)
+            page_ids = ids[max(0, end - limit) : end][::-1]
+            more = end - limit > 0
+        records = [self._summary(store, i) for i in page_ids]
+        return {
+            "channel": channel,
+            "count": len(ids),
+            "messages": records,
+            "next_cursor": page_ids[-1] if page_ids and more else None,
+        }
+
+    @staticmethod
+    def _summary(store, message_id):
+        """A root record without its comments, with their ``comment_count``"""
+        record = store.get(message_id, with_comments=False)
+        if record is not None:
+            record["comment_count"] = store.comment_count(message_id)
+        return record
+
+    def message(self, message_id, channel=None):
+        _, store = self.store(channel)
+        return self._summary(store, message_id)
+
+    def comments(self, message_id, channel=None, after=None, limit=MAX_PAGE_SIZE):
+        """A page of the comment thread of a root message, in thread order"""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        _, store = self.store(channel)
+        record = store.get(message_id, with_comments=True)
+        if record is None:
+            return None
+        comments = record.get("comments", [])
+        start = 0
+        if after is not None:
+            for i, comment in enumerate(comments):
+                if comment["id"] == after:
+                    start = i + 1
+                    break
+        page = comments[start : start + limit]
+        return {
+            "id": message_id,
+            "count": len(comments),
+            "comments": page,
+            "next_cursor": page[-1]["id"] if start + limit < len(comments) else None,
+        }
+
+    def media_path(self, rel_path):
+        """Absolute path of a media file, or None if outside the media folders"""
+        path = os.path.realpath(os.path.join(self.base_dir, rel_path))
+        name = os.path.basename(path)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in PRIVATE_FILES):
+            return None
+        for root in self.media_roots:
+            if path.startswith(root + os.sep) and os.path.isfile(path):
+                return path
+        return None
+
+
+def _int_param(query, name):
+    values = query.get(name)
+    return int(values[0]) if values else None
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    """Routes ``/api/...`` to the ArchiveAPI and other paths to media files"""
+
+    api = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_common_headers(self):
+        # The viewer is served by Vite from another origin; other sites the
+        # browser visits must not be able to read the archive
+        self.send_header("Vary", "Origin")
+        origin = self.headers.get("Origin")
+        if origin and origin == self.api.cors_origin:
+            self.send_header("Access-Control-Allow-Origin", origin)
+            self.send_header("Access-Control-Expose-Headers", "ETag, Content-Range")
+
+    def _send_error(self, status, message):
+        body = json.dumps({"error": message}).encode("utf-8")
+        self.send_response(status)
+        self._send_common_headers()
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_modified(self, etag):
+        if etag in [e.strip() for e in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self._send_common_headers()
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return True
+        return False
+
+    def _send_json(self, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        if self._not_modified(etag):
+            return
+        self.send_response(200)
+        self._send_common_headers()
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        try:
+            if not url.path.startswith("/api/"):
+                # Stored media paths are relative to the scraper directory
+                return self._send_media(unquote(url.path.lstrip("/")))
+            channel = query.get("channel", [None])[0]
+            if url.path == "/api/channels":
+                return self._send_json(self.api.channels())
+            if url.path == "/api/messages":
+                return self._send_json(
+                    self.api.messages(
+                        channel,
+                        before=_int_param(query, "before"),
+                        after=_int_param(query, "after"),
+                        limit=_int_param(query, "limit") or DEFAULT_PAGE_SIZE,
+                    )
+                )
+            match = MESSAGE_PATH.match(url.path)
+            if match:
+                message_id = int(match.group(1))
+                if match.group(2):
+                    payload = self.api.comments(
+                        message_id,
+                        channel,
+                        after=_int_param(query, "after"),
+                        limit=_int_param(query, "limit") or MAX_PAGE_SIZE,
+                    )
+                else:
+                    payload = self.api.message(message_id, channel)
+                if payload is None:
+                    return self._send_error(404, f"No message {message_id}")
+                return self._send_json(payload)
+            self._send_error(404, "Not found")
+        except KeyError as e:
+            self._send_error(404, f"Unknown channel {e}")
+        except ValueError as e:
+            self._send_error(400, str(e))
+
+    def _send_media(self, rel_path):
+        path = self.api.media_path(rel_path)
+        if path is None:
+            return self._send_error(404, "No such media file")
+
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+        if self._not_modified(etag):
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == etag):
+            match = RANGE.match(range_header.strip())
+            if match is None or match.groups() == ("", ""):
+                return self._send_range_not_satisfiable(size)
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                # Suffix range: the last N bytes
+                start = max(0, size - int(last))
+            if start > end or start >= size:
+                return self._send_range_not_satisfiable(size)
+            status = 206
+
+        self.send_response(status)
+        self._send_common_headers()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "max-age=86400")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(STREAM_CHUNK, remaining))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def _send_range_not_satisfiable(self, size):
+        self.send_response(416)
+        self._send_common_headers()
+        self.send_header("Content-Range", f"bytes */{size}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def make_server(api, host="127.0.0.1", port=DEFAULT_PORT):
+    handler = type("Handler", (ArchiveRequestHandler,), {"api": api})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(api, host="127.0.0.1", port=DEFAULT_PORT):
+    """Serve the API from a daemon thread of the running scraper"""
+    server = make_server(api, host, port)
+    thread = threading.Thread(
+        target=server.serve_forever, name="archive-api", daemon=True
+    )
+    thread.start()
+    print(f"Serving the archive API on http://{host}:{server.server_port}")
+    return server
@@ -0,0 +1,108 @@
+"""Per-channel configuration and state for scraping several channels at once"""
+
+import os
+
+from .engagement_history import EngagementHistory
+from .media_downloader import MediaDownloadQueue
+from .message_processor import MessageProcessor
+from .search_index import SearchIndex
+from .storage import open_store
+from .utils import setup_transliteration_schema
+
+
+def channel_configs(config):
+    """One config per scraped channel.
+
+    Without a ``channels`` list this is just the top-level config. Otherwise
+    each entry is a channel username, or an object overriding top-level keys
+    for that channel. Channels given by username only get their own output
+    file next to ``output_json`` (``messages_<channel>.json``) and share the
+    media folders.
+    """
+    entries = config.get("channels")
+    if not entries:
+        return [config]
+
+    base = {key: value for key, value in config.items() if key != "channels"}
+    stem, ext = os.path.splitext(config["output_json"])
+    configs = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"channel_username": entry}
+        channel_config = {**base, **entry}
+        if "output_json" not in entry:
+            channel_config["output_json"] = f"{stem}_{entry['channel_username']}{ext}"
+        configs.append(channel_config)
+
+    outputs = [channel_config["output_json"] for channel_config in configs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Every channel needs its own output_json")
+    return configs
+
+
+class Channel:
+    """Store, message processor and media queue of one scraped channel"""
+
+    def __init__(self, config, base_dir):
+        self.config = config
+        self.base_dir = base_dir
+        self.username = config["channel_username"]
+        self.output_json_path = os.path.join(base_dir, config["output_json"])
+        self.store = None
+        self.message_processor = None
+        self._transliteration_schema = None
+
+    @property
+    def transliteration_schema(self):
+        """Transliterator for this channel's ``transliterate_schema``, or None"""
+        if self._transliteration_schema is None:
+            self._transliteration_schema = setup_transliteration_schema(self.config)
+        return self._transliteration_schema
+
+    def open_store(self):
+        self.store = open_store(self.config, self.base_dir)
+        return self.store
+
+    def open_engagement_history(self):
+        """Open the channel's store of view, forward and reaction snapshots"""
+        return EngagementHistory.from_config(self.config, self.base_dir).open()
+
+    def open_search_index(self):
+        """Open the channel's full-text index, building it on first use"""
+        return SearchIndex.from_config(self.config, self.base_dir).open(self.store)
+
+    def open(self):
+        """Open the store and create the message processor"""
+        if self.store is None:
+            self.open_store()
+
+        # Media is downloaded by a background worker pool unless disabled
+        media_queue = None
+        if self.config.get("download_workers", 4) > 0:
+            media_queue = MediaDownloadQueue(
+                f"{self.output_json_path}.media-queue",
+                workers=self.config.get("download_workers", 4),
+                max_size=self.config.get("download_queue_size", 100),
+            )
+        search_index = None
+        if self.config.get("search_index", True):
+            search_index = self.open_search_index()
+        engagement_history = None
+        if self.config.get("engagement_history", True):
+            engagement_history = self.open_engagement_history()
+        self.message_processor = MessageProcessor(
+            self.store, media_queue, search_index, engagement_history
+        )
+        if media_queue:
+            media_queue.channel = self
+        return self
+
+    @property
+    def media_queue(self):
+        return self.message_processor.media_queue if self.message_processor else None
+
+    def close(self):
+        if self.message_processor:
+            self.message_processor.close()
+        elif self.store:
+            self.store.close()
@@ -1,90 +1,254 @@
 """Telegram client connection and reconnection management"""
 
+import argparse
 import asyncio
-import time
-from telethon import TelegramClient, events
+import random
+from telethon import TelegramClient, events, functions
 from .utils import send_windows_notification
+from . import globals as g
 from .globals import initialize_globals
+from .media_store import MediaStore
+from .metrics import DEFAULT_SUMMARY_SECONDS, report_periodically
+from .reaction_lookup import ReactionLookup
+from .request_scheduler import RequestScheduler
 from .event_handlers import create_new_message_handler
-from .modes import HistoricalSyncMode, RealTimeMode, get_mode_choice
+from .modes import HistoricalSyncMode, RealTimeMode, RefreshMode, get_mode_choice
+
+# A session that ran this long resets the reconnection backoff
+RESET_BACKOFF_AFTER = 300
+HEALTH_CHECK_TIMEOUT = 30
 
 
 class TelegramClientManager:
-    def __init__(self, config, transliteration_schema, current_dir, message_processor):
+    """Runs the scraper over one Telegram client, reconnecting when it drops.
+
+    The client, its session and entity cache, the registered real-time
+    handlers (with their buffered messages) and the chosen mode live across
+    reconnections, so a reconnection only has to reconnect.
+    """
+
+    def __init__(self, config, transliteration_schema, current_dir, channels):
         self.config = config
         self.transliteration_schema = transliteration_schema
         self.current_dir = current_dir
-        self.message_processor = message_processor
+        self.channels = channels
         self.session_path = f"{current_dir}/session"
+        self.reaction_lookup = ReactionLookup.from_config(config)
+        self.scheduler = RequestScheduler.from_config(config)
+        self.media_store = None
+        if config.get("media_dedup", True):
+            self.media_store = MediaStore.from_config(config, current_dir)
+        self.reconnect_min = config.get("reconnect_min_seconds", 1)
+        self.reconnect_max = config.get("reconnect_max_seconds", 300)
+        self.health_check_interval = config.get("health_check_seconds", 60)
+        self.metrics_summary_interval = config.get(
+            "metrics_summary_seconds", DEFAULT_SUMMARY_SECONDS
+        )
+        self.client = None
+        self.mode = None
+        self.handlers = {}  # channel username -> registered handler
+
+    def _create_client(self):
+        # FloodWaits are handled by the request scheduler, not by Telethon, so
+        # every call the scraper makes goes through the scheduler
+        return TelegramClient(
+            self.session_path,
+            self.config["api_id"],
+            self.config["api_hash"],
+            flood_sleep_threshold=0,
+        )
 
-    async def run_with_reconnection(self, output_json_path, args=None):
-        """Main loop with automatic reconnection on failure"""
+    def _reconnect_delay(self, attempt):
+        """Exponential backoff with jitter, so restarts do not synchronize"""
+        delay = min(self.reconnect_max, self.reconnect_min * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def run_with_reconnection(self, args=None):
+        """Supervise client sessions, reconnecting with exponential backoff"""
+        self.client = self._create_client()
+        initialize_globals(
+            self.client,
+            self.config,
+            self.transliteration_schema,
+            self.current_dir,
+            None,  # media queues are per channel
+            self.reaction_lookup,
+            self.scheduler,
+            self.media_store,
+        )
+
+        if self.metrics_summary_interval:
+            # Kept across sessions, so each line covers a whole interval
+            asyncio.create_task(report_periodically(self.metrics_summary_interval))
+
+        loop = asyncio.get_running_loop()
+        attempt = 0
         while True:
+            started = loop.time()
             try:
-                await self._run_client_session(output_json_path, args)
-            except (ConnectionError, asyncio.TimeoutError) as e:
-                print(f"Network error: {e}. Reconnecting in 60 seconds...")
-                send_windows_notification(
-                    "Telethon Script Error",
-                    f"The script stopped with a network error: {e}. It will now restart.",
-                )
-                print("Restarting in 60 seconds...")
-                time.sleep(60)
+                await self._run_client_session(args)
+                error = None
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                error = f"network error: {e}"
             except Exception as e:
-                print(f"An unexpected error occurred: {e}. The script will restart.")
+                error = f"error: {e}"
+
+            if loop.time() - started > RESET_BACKOFF_AFTER:
+                attempt = 0  # the session was healthy for a while
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            reason = error or "the connection was closed"
+            print(f"Session ended with {reason}. Reconnecting in {delay:.1f} seconds...")
+            if error:
                 send_windows_notification(
                     "Telethon Script Error",
-                    f"The script stopped with an error: {e}. It will now restart.",
+                    f"The script stopped with an {error}. It will now reconnect.",
                 )
-                print("Restarting in 30 seconds...")
-                time.sleep(30)
+            await asyncio.sleep(delay)
+
+            if args and self.mode in ("1", "3"):
+                # Resume historical sync from the checkpoint (or run the
+                # refresh again) without prompting
+                args = argparse.Namespace(
+                    **{**vars(args), "no_prompts": True, "offset_id": None}
+                )
+
+    async def _health_check(self, client):
+        """Disconnect a client that stops answering, so it gets reconnected"""
+
+        async def get_state():
+            await asyncio.wait_for(
+                client(functions.updates.GetStateRequest()),
+                timeout=HEALTH_CHECK_TIMEOUT,
+            )
+
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                # A FloodWait is waited out by the scheduler, outside the timeout
+                await self.scheduler.call("session", get_state)
+            except Exception as e:
+                print(f"Health check failed: {e!r}. Reconnecting...")
+                await client.disconnect()
+                return
+
+    async def _subscribe(self, client):
+        """Register one handler, with its own ordering buffer, per channel.
+
+        Handlers stay registered on the client across reconnections, and
+        their buffered messages are processed once it is connected again.
+        Channels are resolved through the scheduler up front, so Telethon does
+        not resolve them itself. A channel that failed to resolve is retried on
+        the next connection.
+        """
+        for channel in self.channels:
+            if channel.username in self.handlers:
+                continue
+            entity = await self.scheduler.call(
+                "session", client.get_input_entity, channel.username
+            )
+            handler = create_new_message_handler(channel.message_processor, channel)
+            client.add_event_handler(handler, events.NewMessage(chats=entity))
+            self.handlers[channel.username] = handler
 
-    async def _run_client_session(self, output_json_path, args=None):
+    async def _run_client_session(self, args=None):
         """Run a single client session"""
-        client = TelegramClient(
-            self.session_path, self.config["api_id"], self.config["api_hash"]
-        )
+        client = self.client
+        media_queues = [c.media_queue for c in self.channels if c.media_queue]
 
         try:
-            initialize_globals(
-                client, self.config, self.transliteration_schema, self.current_dir
-            )
+            await self.scheduler.call("session", client.start)
+            for media_queue in media_queues:
+                media_queue.start(client)
 
-            async with client:
-                # Determine mode from args or user input
+            # Determine mode from args or user input, once
+            if self.mode is None:
                 if args and args.no_prompts:
-                    mode = self._get_mode_from_args(args)
+                    self.mode = self._get_mode_from_args(args)
                 else:
-                    mode = get_mode_choice(args)
-
-                if mode == "1" or mode == "historical":
-                    historical_mode = HistoricalSyncMode(self.message_processor)
-                    await historical_mode.run(
-                        client, self.config["channel_username"], output_json_path, args
-                    )
-                elif mode == "2" or mode == "realtime":
-                    # Set up event handler for real-time mode
-                    handler = create_new_message_handler(self.message_processor)
-                    client.add_event_handler(
-                        handler,
-                        events.NewMessage(chats=self.config["channel_username"]),
-                    )
-                    await RealTimeMode.run(client)
-                else:
-                    print("Invalid mode selected. Exiting.")
-                    exit(1)
+                    self.mode = get_mode_choice(args)
+
+            if self.mode == "1" or self.mode == "historical":
+                self.mode = "1"
+                await self._run_historical(client, args)
+                print("Client session ended successfully.")
+                exit(0)
+            elif self.mode == "3" or self.mode == "refresh":
+                self.mode = "3"
+                await self._run_refresh(client, args)
                 print("Client session ended successfully.")
                 exit(0)
+            elif self.mode == "2" or self.mode == "realtime":
+                self.mode = "2"
+                await self._subscribe(client)
+                try:
+                    # Fetch updates missed while disconnected
+                    await self.scheduler.call("session", client.catch_up)
+                except Exception as e:
+                    print(f"Could not catch up on missed messages: {e}")
+                health_check = asyncio.create_task(self._health_check(client))
+                try:
+                    await RealTimeMode.run(client)
+                finally:
+                    health_check.cancel()
+            else:
+                print("Invalid mode selected. Exiting.")
+                exit(1)
         finally:
+            for media_queue in media_queues:
+                await media_queue.stop()
             if client.is_connected():
-                client.disconnect()
+                await client.disconnect()
             print("Client disconnected. Will attempt to reconnect.")
 
+    async def _run_historical(self, client, args=None):
+        """Backfill every channel; their requests interleave in the scheduler"""
+        if len(self.channels) > 1 and args:
+            # Prompts of concurrent channels would interleave; each channel
+            # starts from its own checkpoint instead
+            overrides = {"no_prompts": True}
+            if args.offset_id and args.offset_id > 0:
+                print("Ignoring --offset-id: message IDs differ between channels")
+                overrides["offset_id"] = None
+            args = argparse.Namespace(**{**vars(args), **overrides})
+
+        async def backfill(channel):
+            g.current_channel.set(channel)
+            historical_mode = HistoricalSyncMode(
+                channel.message_processor, self._get_comment_concurrency(args)
+            )
+            await historical_mode.run(
+                client, channel.username, channel.output_json_path, args
+            )
+
+        # Each channel runs in its own task (and context); the scheduler's
+        # token buckets serve their requests in turn
+        await asyncio.gather(*(backfill(channel) for channel in self.channels))
+
+    async def _run_refresh(self, client, args=None):
+        """Refresh the engagement counters of every channel"""
+
+        async def refresh(channel):
+            g.current_channel.set(channel)
+            await RefreshMode(channel.message_processor).run(
+                client, channel.username, args
+            )
+
+        await asyncio.gather(*(refresh(channel) for channel in self.channels))
+
     def _get_mode_from_args(self, args):
         """Convert argument mode to internal format"""
         if args.mode in ["1", "historical"]:
             return "1"
         elif args.mode in ["2", "realtime"]:
             return "2"
+        elif args.mode in ["3", "refresh"]:
+            return "3"
         else:
             return "2"  # Default to real-time
+
+    def _get_comment_concurrency(self, args):
+        """Comment threads fetched concurrently in historical sync"""
+        if args and args.comment_concurrency:
+            return args.comment_concurrency
+        return self.config.get("comment_fetch_concurrency", 1)
@@ -0,0 +1,65 @@
+"""Concurrent comment-thread fetching for historical sync"""
+
+import asyncio
+from collections import deque
+
+
+class CommentPrefetcher:
+    """Fetch the comment threads of upcoming root messages concurrently.
+
+    Wraps the channel's message iterator and yields ``(msg, task)`` pairs in the
+    original (ascending ID) order. ``task`` is already fetching the comments of
+    ``msg`` for up to ``window`` messages ahead, with at most ``concurrency``
+    threads being fetched at once; it is None for album members, which never
+    get their own comment thread.
+    """
+
+    def __init__(
+        self, message_processor, client, channel_username, concurrency=4, window=None
+    ):
+        self.message_processor = message_processor
+        self.client = client
+        self.channel_username = channel_username
+        self.window = window or concurrency * 2
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _fetch(self, msg):
+        async with self._semaphore:
+            existing = self.message_processor.existing_comments(msg.id)
+            return await self.message_processor.fetch_comments(
+                self.client, msg, self.channel_username, existing
+            )
+
+    def _needs_comments(self, msg, albums_seen):
+        """Only the root message of an album gets a comment thread"""
+        if not msg.grouped_id:
+            return True
+        root_id = self.message_processor.album_root(msg.grouped_id)
+        if root_id is not None:
+            return root_id == msg.id
+        # Not stored yet: its first message in this run will be the root
+        return msg.grouped_id not in albums_seen
+
+    async def prefetch(self, messages):
+        """Yield ``(msg, task)`` for every message of the async iterator"""
+        pending = deque()
+        albums_seen = set()
+        try:
+            async for msg in messages:
+                task = None
+                if self._needs_comments(msg, albums_seen):
+                    task = asyncio.create_task(self._fetch(msg))
+                if msg.grouped_id:
+                    albums_seen.add(msg.grouped_id)
+                pending.append((msg, task))
+
+                if len(pending) >= self.window:
+                    yield pending.popleft()
+
+            while pending:
+                yield pending.popleft()
+        finally:
+            # Stopped early (stop_count, error): drop the fetches never consumed
+            for _, task in pending:
+                if task is not None:
+                    self.message_processor.drop_prefetched(task)
@@ -0,0 +1,234 @@
+"""Time series of the views, forwards and reactions of root messages"""
+
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, groupby
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    message_id INTEGER NOT NULL,
+    chunk INTEGER NOT NULL,
+    first_time INTEGER NOT NULL,
+    last_time INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    reactions TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (message_id, chunk)
+);
+CREATE INDEX IF NOT EXISTS series_by_time ON series (last_time, first_time);
+"""
+
+# Columns stored before the one-per-reaction columns
+FIXED_COLUMNS = ("time", "views", "forwards")
+TYPECODE = "q"
+# Snapshots per row; appending only re-encodes the last row of a message
+CHUNK_POINTS = 64
+
+
+def engagement_history_path(output_json_path):
+    return f"{output_json_path}.history.db"
+
+
+def _encode(columns):
+    """Delta-encode equally long integer columns into one compressed blob"""
+    data = array(TYPECODE)
+    for column in columns:
+        previous = 0
+        for value in column:
+            data.append(value - previous)
+            previous = value
+    if sys.byteorder == "big":
+        data.byteswap()  # blobs are little-endian
+    return zlib.compress(data.tobytes())
+
+
+def _decode(blob, column_count, points):
+    data = array(TYPECODE)
+    data.frombytes(zlib.decompress(blob))
+    if sys.byteorder == "big":
+        data.byteswap()
+    return [
+        list(accumulate(data[i * points : (i + 1) * points]))
+        for i in range(column_count)
+    ]
+
+
+def snapshot(record):
+    """``(views, forwards, {reaction: count})`` of a record; missing counts are 0"""
+    return (
+        record.get("views") or 0,
+        record.get("forwards") or 0,
+        {r["reaction"]: r["count"] for r in record.get("reactions", [])},
+    )
+
+
+class EngagementHistory:
+    """Columnar side store of engagement snapshots of root messages.
+
+    The snapshots of a message are kept in rows of up to ``CHUNK_POINTS``.
+    A row holds the observation times and the view, forward and per-reaction
+    counts as integer columns, delta-encoded and compressed together, so
+    counters that rarely change cost next to nothing; a reaction missing from
+    a row had no count during it. A snapshot equal to the previous one is not
+    stored, as counts hold until the next snapshot. The time span of each row
+    is kept in plain columns, so range queries only decode the rows they
+    return. Messages.json keeps the latest counts only.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+
+    @classmethod
+    def from_config(cls, config, base_dir):
+        return cls(
+            engagement_history_path(os.path.join(base_dir, config["output_json"]))
+        )
+
+    def open(self):
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        return self
+
+    @staticmethod
+    def _columns(points, reactions, data):
+        """``(reaction keys, columns)`` of a series row"""
+        reactions = json.loads(reactions)
+        return reactions, _decode(data, len(FIXED_COLUMNS) + len(reactions), points)
+
+    def record(self, record, timestamp=None):
+        """Append a snapshot of a root record's counters, unless unchanged"""
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        views, forwards, counts = snapshot(record)
+        row = self.conn.execute(
+            "SELECT chunk, points, reactions, data FROM series "
+            "WHERE message_id = ? ORDER BY chunk DESC LIMIT 1",
+            (record["id"],),
+        ).fetchone()
+        if row is None:
+            chunk, reactions, columns = 0, [], [[] for _ in FIXED_COLUMNS]
+        else:
+            chunk = row[0]
+            reactions, columns = self._columns(*row[1:])
+            last = {
+                key: column[-1]
+                for key, column in zip(reactions, columns[len(FIXED_COLUMNS) :])
+                if column[-1]
+            }
+            current = {key: count for key, count in counts.items() if count}
+            if (columns[1][-1], columns[2][-1], last) == (views, forwards, current):
+                return
+            if len(columns[0]) >= CHUNK_POINTS:
+                chunk, reactions, columns = chunk + 1, [], [[] for _ in FIXED_COLUMNS]
+
+        # Reactions seen for the first time in this row get a column, zero
+        # until now
+        points = len(columns[0])
+        for key, count in counts.items():
+            if count and key not in reactions:
+                reactions.append(key)
+                columns.append([0] * points)
+
+        values = [timestamp, views, forwards]
+        values.extend(counts.get(key, 0) for key in reactions)
+        for column, value in zip(columns, values):
+            column.append(value)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                record["id"],
+                chunk,
+                columns[0][0],
+                timestamp,
+                points + 1,
+                json.dumps(reactions, ensure_ascii=False),
+                _encode(columns),
+            ),
+        )
+
+    def _series(self, rows, since=None, until=None):
+        """Join the rows of one message, keeping snapshots in the time range"""
+        series = {name: [] for name in FIXED_COLUMNS}
+        series["reactions"] = {}
+        for points, reactions, data in rows:
+            keys, columns = self._columns(points, reactions, data)
+            times = columns[0]  # appended in time order
+            start = 0 if since is None else bisect_left(times, since)
+            end = len(times) if until is None else bisect_right(times, until)
+            before = len(series["time"])
+            for name, column in zip(FIXED_COLUMNS, columns):
+                series[name].extend(column[start:end])
+            row_reactions = dict(zip(keys, columns[len(FIXED_COLUMNS) :]))
+            for key in keys:
+                series["reactions"].setdefault(key, [0] * before)
+            for key, counts in series["reactions"].items():
+                if key in row_reactions:
+                    counts.extend(row_reactions[key][start:end])
+                else:
+                    counts.extend([0] * (end - start))
+        return series
+
+    @staticmethod
+    def _time_bounds(since, until):
+        return (
+            -(2**63) if since is None else since,
+            2**63 - 1 if until is None else until,
+        )
+
+    def history(self, message_id, since=None, until=None):
+        """Snapshots of one message taken between ``since`` and ``until``.
+
+        Times are Unix timestamps and both bounds are inclusive. Returns
+        ``{"time": [...], "views": [...], "forwards": [...],
+        "reactions": {reaction: [...]}}`` with one item per snapshot, or None
+        if the message has no history.
+        """
+        rows = self.conn.execute(
+            "SELECT points, reactions, data FROM series WHERE message_id = ? "
+            "AND last_time >= ? AND first_time <= ? ORDER BY chunk",
+            (message_id, *self._time_bounds(since, until)),
+        ).fetchall()
+        if not rows:
+            exists = self.conn.execute(
+                "SELECT 1 FROM series WHERE message_id = ?", (message_id,)
+            ).fetchone()
+            return self._series([]) if exists else None
+        return self._series(rows, since, until)
+
+    def channel_history(self, since=None, until=None, from_id=None, to_id=None):
+        """Yield ``(message_id, series)`` for every message with snapshots in range.
+
+        ``from_id`` and ``to_id`` limit the messages; series are as returned
+        by ``history``.
+        """
+        cursor = self.conn.execute(
+            "SELECT message_id, points, reactions, data FROM series "
+            "WHERE last_time >= ? AND first_time <= ? "
+            "AND message_id >= ? AND message_id <= ? ORDER BY message_id, chunk",
+            (
+                *self._time_bounds(since, until),
+                -(2**63) if from_id is None else from_id,
+                2**63 - 1 if to_id is None else to_id,
+            ),
+        )
+        for message_id, rows in groupby(cursor, key=lambda row: row[0]):
+            series = self._series([row[1:] for row in rows], since, until)
+            if series["time"]:
+                yield message_id, series
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        if self.conn:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
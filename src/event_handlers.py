@@ -2,87 +2,232 @@
 
 import asyncio
 import heapq
+import time
+from collections import OrderedDict
 from typing import Any, Optional
 
+from . import globals as g
 from .handle_message import handle_message
+from .metrics import metrics
+from .request_scheduler import REALTIME, request_priority
+
+DEFAULT_QUIET_MS = 1000
+DEFAULT_MAX_WAIT_MS = 3000
+DEFAULT_DEDUPE_WINDOW = 10000
+DEFAULT_MAX_BUFFER = 1000
+
+
+class OrderedIngest:
+    """Buffer of real-time messages flushed in ascending message ID order.
+
+    A flush starts once no message arrived for ``quiet_ms`` (so a burst is
+    sorted as a whole), but never later than ``max_wait_ms`` after the first
+    message buffered since the previous flush, however steady the stream is.
+    IDs of the last ``dedupe_window`` processed messages are remembered to
+    drop duplicates. When ``max_buffer`` messages are waiting, the handler
+    blocks until the flush catches up (backpressure). ``stats`` counts
+    messages, flushes, buffer depth (buffered plus being processed) and the
+    latency from the first buffered message to its flush. Messages that fail
+    because the connection dropped stay buffered until it is back.
+    """
 
+    def __init__(
+        self,
+        message_processor,
+        channel=None,
+        quiet_ms=DEFAULT_QUIET_MS,
+        max_wait_ms=DEFAULT_MAX_WAIT_MS,
+        dedupe_window=DEFAULT_DEDUPE_WINDOW,
+        max_buffer=DEFAULT_MAX_BUFFER,
+    ):
+        self.message_processor = message_processor
+        self.channel = channel
+        self.quiet = quiet_ms / 1000
+        self.max_wait = max_wait_ms / 1000
+        self.dedupe_window = dedupe_window
+        self.max_buffer = max_buffer
+
+        # Min-heap of (message_id, message)
+        self.pending: list[tuple[int, Any]] = []
+        self.pending_ids: set[int] = set()  # buffered or being processed
+        self.in_flight = 0  # messages of the current flush not processed yet
+        self.processed_ids: OrderedDict[int, None] = OrderedDict()
+        self.first_buffered_at: Optional[float] = None
+        self.last_buffered_at: Optional[float] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._space: Optional[asyncio.Event] = None
+        self._depth_gauge = metrics.gauge(
+            "realtime_buffer_depth",
+            "Real-time messages buffered or being processed",
+            channel=channel.username if channel is not None else "",
+        )
 
-def create_new_message_handler(message_processor):
-    """Create event handler for new messages in real-time mode.
+        self.stats = {
+            "received": 0,
+            "duplicates": 0,
+            "processed": 0,
+            "failed": 0,
+            "flushes": 0,
+            "depth": 0,
+            "max_depth": 0,
+            "backpressure_waits": 0,
+            "backpressure_seconds": 0.0,
+            "last_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+        }
+
+    @classmethod
+    def from_config(cls, config, message_processor, channel=None):
+        return cls(
+            message_processor,
+            channel,
+            quiet_ms=config.get("realtime_quiet_ms", DEFAULT_QUIET_MS),
+            max_wait_ms=config.get("realtime_max_wait_ms", DEFAULT_MAX_WAIT_MS),
+            dedupe_window=config.get("realtime_dedupe_window", DEFAULT_DEDUPE_WINDOW),
+            max_buffer=config.get("realtime_max_buffer", DEFAULT_MAX_BUFFER),
+        )
 
-    Ensures processing occurs in ascending message ID order by buffering
-    incoming events briefly and flushing them in order.
-    """
+    def depth(self):
+        return len(self.pending) + self.in_flight
+
+    def _update_depth(self):
+        depth = self.depth()
+        self.stats["depth"] = depth
+        self.stats["max_depth"] = max(self.stats["max_depth"], depth)
+        self._depth_gauge.set(depth)
+
+    def _is_duplicate(self, message_id):
+        return message_id in self.pending_ids or message_id in self.processed_ids
 
-    # Min-heap of (message_id, message)
-    pending_heap: list[tuple[int, Any]] = []
-    heap_lock = asyncio.Lock()
-    processing = False
-    processed_ids: set[int] = set()
-    # Separate task just for the debounce timer (do not tie to the flush task)
-    flush_timer_task: Optional[asyncio.Task] = None
-
-    async def _flush_buffered_in_order():
-        nonlocal processing
-        if processing:
+    def _remember(self, message_id):
+        self.processed_ids[message_id] = None
+        while len(self.processed_ids) > self.dedupe_window:
+            self.processed_ids.popitem(last=False)
+
+    async def add(self, msg):
+        """Buffer a message and make sure a flush is scheduled"""
+        self.stats["received"] += 1
+        if self._is_duplicate(msg.id):
+            self.stats["duplicates"] += 1
             return
-        processing = True
-        try:
-            while True:
-                # Pop a snapshot batch under lock
-                async with heap_lock:
-                    if not pending_heap:
-                        break
-                    batch = [
-                        heapq.heappop(pending_heap) for _ in range(len(pending_heap))
-                    ]
-
-                # Process in ascending ID order
-                for _, msg in batch:
-                    if msg.id in processed_ids:
-                        continue
-
-                    print(
-                        f"Processing message (ID: {msg.id}) in order...",
-                        flush=True,
-                    )
-                    root_rec = await handle_message(msg, is_comment=False)
-                    message_processor.process_new_message(root_rec, msg)
-
-                    print(
-                        f"Saved new message (ID: {msg.id}). Total messages: {len(message_processor.all_messages)}",
-                        flush=True,
-                    )
-
-                    # Special output line for PowerShell to catch
-                    print(
-                        f"POWERSHELL_NOTIFICATION:NEW_MESSAGE:{msg.id}:{msg.text[:100] if msg.text else '[Media/No text]'}",
-                        flush=True,
-                    )
-
-                    processed_ids.add(msg.id)
-
-                # loop again to drain anything that arrived mid-processing
-        finally:
-            processing = False
-
-    async def _schedule_flush():
-        nonlocal flush_timer_task
-        # Resettable debounce: cancel existing timer (if still sleeping) and start a new 1s timer
-        if flush_timer_task and not flush_timer_task.done():
-            flush_timer_task.cancel()
+
+        if self.depth() >= self.max_buffer:
+            # Backpressure: let the flush catch up before buffering more
+            self.stats["backpressure_waits"] += 1
+            start = time.monotonic()
+            if self._space is None:
+                self._space = asyncio.Event()
+            while self.depth() >= self.max_buffer:
+                self._space.clear()
+                await self._space.wait()
+            self.stats["backpressure_seconds"] += time.monotonic() - start
+            if self._is_duplicate(msg.id):
+                self.stats["duplicates"] += 1
+                return
+
+        now = time.monotonic()
+        if not self.pending:
+            self.first_buffered_at = now
+        self.last_buffered_at = now
+        heapq.heappush(self.pending, (msg.id, msg))
+        self.pending_ids.add(msg.id)
+        self._update_depth()
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
+
+    def _deadline(self):
+        return min(
+            self.last_buffered_at + self.quiet, self.first_buffered_at + self.max_wait
+        )
+
+    async def _run(self):
+        """Wait for each flush deadline and flush, until the buffer is empty"""
+        # Real-time requests are served before any backfill in the scheduler
+        request_priority.set(REALTIME)
+        if self.channel is not None:
+            g.current_channel.set(self.channel)
+        while self.pending:
+            delay = self._deadline() - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue  # more messages may have moved the deadline
+            await self.flush()
+
+    async def flush(self):
+        """Process every buffered message in ascending ID order"""
+        latency = (time.monotonic() - self.first_buffered_at) * 1000
+        self.stats["flushes"] += 1
+        self.stats["last_latency_ms"] = latency
+        self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], latency)
+
+        # Take a snapshot batch; messages arriving meanwhile start a new one
+        batch = [heapq.heappop(self.pending) for _ in range(len(self.pending))]
+        self.first_buffered_at = self.last_buffered_at = None
+        self.in_flight = len(batch)
+
+        for index, (_, msg) in enumerate(batch):
             try:
-                await flush_timer_task
-            except asyncio.CancelledError:
-                pass
+                await self._process(msg)
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                # Disconnected: keep the rest of the batch for a later flush
+                print(
+                    f"Connection lost while processing message {msg.id}: {e}. "
+                    f"Keeping {len(batch) - index} messages buffered",
+                    flush=True,
+                )
+                self._requeue(batch[index:])
+                return
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Error processing real-time message {msg.id}: {e}", flush=True)
+            self.pending_ids.discard(msg.id)
+            self.in_flight -= 1
+            self._update_depth()
+            if self._space is not None:
+                self._space.set()
+
+    def _requeue(self, items):
+        for item in items:
+            heapq.heappush(self.pending, item)
+        self.in_flight -= len(items)
+        # Retry after the quiet period rather than in a tight loop
+        self.first_buffered_at = self.last_buffered_at = time.monotonic()
+
+    async def _process(self, msg):
+        print(
+            f"Processing message (ID: {msg.id}) in order...",
+            flush=True,
+        )
+        root_rec = await handle_message(msg, is_comment=False)
+        self.message_processor.process_new_message(root_rec, msg)
+        self._remember(msg.id)
+        self.stats["processed"] += 1
 
-        async def _debounce_timer():
-            # Wait 1 second since last message, then trigger a flush.
-            await asyncio.sleep(1.0)
-            # Fire-and-forget the flush so the timer cancellation never cancels an active flush
-            asyncio.create_task(_flush_buffered_in_order())
+        print(
+            f"Saved new message (ID: {msg.id}). Total messages: {self.message_processor.count()}",
+            flush=True,
+        )
+
+        # Special output line for PowerShell to catch
+        print(
+            f"POWERSHELL_NOTIFICATION:NEW_MESSAGE:{msg.id}:{msg.text[:100] if msg.text else '[Media/No text]'}",
+            flush=True,
+        )
 
-        flush_timer_task = asyncio.create_task(_debounce_timer())
+
+def create_new_message_handler(message_processor, channel=None, ingest=None):
+    """Create event handler for new messages in real-time mode.
+
+    Messages go through an ``OrderedIngest`` buffer (``ingest``, or a new one
+    configured from the channel's settings), so they are processed in
+    ascending message ID order within a bounded delay. ``channel`` is the
+    channel the handler is registered for; each channel gets its own handler
+    and buffer.
+    """
+    if ingest is None:
+        config = channel.config if channel is not None else g.config
+        ingest = OrderedIngest.from_config(config, message_processor, channel)
 
     async def new_message_handler(event):
         msg: Any = event.message
@@ -90,11 +235,7 @@ def create_new_message_handler(message_processor):
             f"New message received (ID: {msg.id}). Buffering for ordered processing...",
             flush=True,
         )
+        await ingest.add(msg)
 
-        # Buffer for ordered processing
-        async with heap_lock:
-            heapq.heappush(pending_heap, (msg.id, msg))
-
-        await _schedule_flush()
-
+    new_message_handler.ingest = ingest
     return new_message_handler
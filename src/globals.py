@@ -1,16 +1,57 @@
 """Global variables for the telegram scraper"""
 
+from contextvars import ContextVar
+
 # Global variables accessible throughout the application
 client = None
 config = None
 transliteration_schema = None
 base_dir = None
+media_queue = None
+reaction_lookup = None
+scheduler = None
+media_store = None
+
+# Channel (see channels.Channel) the current task works on
+current_channel = ContextVar("current_channel", default=None)
 
 
-def initialize_globals(telegram_client, app_config, trans_schema, app_base_dir):
+def initialize_globals(
+    telegram_client,
+    app_config,
+    trans_schema,
+    app_base_dir,
+    download_queue=None,
+    reactions=None,
+    request_scheduler=None,
+    content_store=None,
+):
     """Initialize all global variables"""
-    global client, config, transliteration_schema, base_dir
+    global client, config, transliteration_schema, base_dir, media_queue
+    global reaction_lookup, scheduler, media_store
     client = telegram_client
     config = app_config
     transliteration_schema = trans_schema
     base_dir = app_base_dir
+    media_queue = download_queue
+    reaction_lookup = reactions
+    scheduler = request_scheduler
+    media_store = content_store
+
+
+def channel_settings():
+    """Config of the current channel, or the global config outside of one"""
+    channel = current_channel.get()
+    return channel.config if channel else config
+
+
+def channel_transliteration_schema():
+    """Transliterator of the current channel, or the global one outside of one"""
+    channel = current_channel.get()
+    return channel.transliteration_schema if channel else transliteration_schema
+
+
+def channel_media_queue():
+    """Media queue of the current channel, or the global one outside of one"""
+    channel = current_channel.get()
+    return channel.media_queue if channel else media_queue
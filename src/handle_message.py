@@ -1,32 +1,111 @@
+import asyncio
 import os
 
+from .media_store import media_key
+from .metrics import metrics
+from .resumable_download import chunk_bytes, download_resumable, should_resume
 from .utils import format_date, transliterate_text
+from .reaction_lookup import get_reaction_key
 from . import globals as g
-from telethon.tl.functions.messages import GetMessageReactionsListRequest
 
 """ from telethon.utils import get_input_location
 from telethon.tl import types """
 
 
-def get_reaction_key(reaction):
-    """Extract reaction identifier from a reaction object"""
-    return (
-        reaction.emoticon if hasattr(reaction, "emoticon") else type(reaction).__name__
-    )
-
+async def download_message_media(msg, folder):
+    """Download the media of a message into folder and return its relative path"""
+    if g.media_store:
+        stored = await asyncio.to_thread(g.media_store.find, msg, folder)
+        if stored:
+            print(f"Media already stored at {stored}")
+            return stored
+
+    media_type = type(msg.media).__name__
+    print(f"Downloading {media_type} media...")
+
+    if media_type == "MessageMediaPhoto":
+        # Sometimes, largest PHOTO resolution is not the default... WTF!
+        """largest_size = max(
+            msg.photo.sizes,
+            key=lambda s: getattr(s, "w", 0) * getattr(s, "h", 0),
+        )
+        sorted_by_size = sorted(
+            msg.photo.sizes,
+            key=lambda s: getattr(s, "size", 0),
+        )
+        largest_idx_in_sorted = sorted_by_size.index(largest_size)"""
+        # input_location = get_input_location(largest_size)
+        """ input_location = types.InputPhotoFileLocation(
+            id=msg.photo.id,
+            access_hash=msg.photo.access_hash,
+            file_reference=msg.photo.file_reference,
+            thumb_size=largest_size.type,  # This correctly uses the 'y' type string
+        ) """
+        # path = await msg.client.download_file(input_location, file=folder)
+        # path = await g.client.download_file()
+        # path = await msg.download_media(thumb=largest_size, file=folder)
+        """ path = await msg.client.download_media(
+            msg.photo, thumb=largest_size, file=folder
+        ) """
+        """ path = await msg.download_media(
+            file=folder, thumb=largest_idx_in_sorted
+        ) """
+        # path = await g.client.download_media(largest_size, file=folder)
+        path = await g.scheduler.call("download", msg.download_media, file=folder)
+    elif should_resume(msg, g.channel_settings()):
+        path = await g.scheduler.call(
+            "download",
+            download_resumable,
+            msg.client,
+            msg,
+            folder,
+            chunk_bytes(g.channel_settings()),
+        )
+    else:
+        path = await g.scheduler.call("download", msg.download_media, file=folder)
 
-async def handle_message(msg, is_comment=False, skip_media_download=False):
-    """Handle processing of a single message"""
+    if g.base_dir:
+        rel_path = os.path.relpath(path, g.base_dir)
+    else:
+        rel_path = os.path.relpath(path)
+    print(f"Downloaded media to {rel_path}")
+    metrics.counter("media_downloads_total", "Media files downloaded").inc()
+    metrics.counter(
+        "media_downloaded_bytes_total", "Bytes of media downloaded"
+    ).inc(os.path.getsize(path))
+    if g.media_store:
+        await asyncio.to_thread(g.media_store.add, rel_path, media_key(msg))
+    return rel_path
+
+
+async def handle_message(
+    msg, is_comment=False, skip_media_download=False, previous=None
+):
+    """Handle processing of a single message.
+
+    ``previous`` is the stored record of the same message, if any.
+    """
+    kind = "comment" if is_comment else "post"
+    with metrics.histogram(
+        "handle_message_seconds",
+        "Time to convert a message, including reaction lookups and media",
+        kind=kind,
+    ).time():
+        return await _convert_message(msg, is_comment, skip_media_download, previous)
+
+
+async def _convert_message(msg, is_comment, skip_media_download, previous):
+    config = g.channel_settings()
     sender_id = msg.sender_id or None
     first_name = getattr(msg.sender, "first_name", None) if msg.sender else None
     last_name = getattr(msg.sender, "last_name", None) if msg.sender else None
     username = getattr(msg.sender, "username", None) if msg.sender else None
-    sender_is_creator = not sender_id or username == g.config["channel_username"]
+    sender_is_creator = not sender_id or username == config["channel_username"]
 
     rec = {
         "id": msg.id,
         "date": format_date(
-            msg.date, g.config["timezone_offset_hours"], g.config["date_format"]
+            msg.date, config["timezone_offset_hours"], config["date_format"]
         ),
     }
 
@@ -57,10 +136,12 @@ async def handle_message(msg, is_comment=False, skip_media_download=False):
         rec["username"] = username
     if msg.message:
         rec["message"] = msg.message
-        if g.config.get("transliterate_key"):
-            transliterated = transliterate_text(msg.message, g.transliteration_schema)
+        if config.get("transliterate_key"):
+            transliterated = transliterate_text(
+                msg.message, g.channel_transliteration_schema()
+            )
             if transliterated:
-                rec[g.config["transliterate_key"]] = transliterated
+                rec[config["transliterate_key"]] = transliterated
 
     rec["reactions"] = []
 
@@ -74,16 +155,9 @@ async def handle_message(msg, is_comment=False, skip_media_download=False):
         creator_reactions = set()
 
         if is_comment:
-            all_reactions = await g.client(
-                GetMessageReactionsListRequest(peer=msg.peer_id, id=msg.id, limit=100)
+            creator_reactions = await g.reaction_lookup.creator_reactions(
+                msg, previous
             )
-            for reaction_peer in all_reactions.reactions:
-                # Check if the reaction is from the channel itself
-                if (
-                    hasattr(reaction_peer.peer_id, "channel_id")
-                    and reaction_peer.peer_id.channel_id == msg.peer_id.channel_id
-                ):
-                    creator_reactions.add(get_reaction_key(reaction_peer.reaction))
 
         for reaction in msg.reactions.results:
             r = {
@@ -99,9 +173,9 @@ async def handle_message(msg, is_comment=False, skip_media_download=False):
     if msg.media:
         if not is_comment or sender_is_creator:
             folder = (
-                g.config["media_comments_folder"]
+                config["media_comments_folder"]
                 if is_comment
-                else g.config["media_folder"]
+                else config["media_folder"]
             )
             # Make folder path absolute relative to base_dir if provided
             if g.base_dir:
@@ -118,45 +192,17 @@ async def handle_message(msg, is_comment=False, skip_media_download=False):
                     "total_voters": msg.media.results.total_voters,
                 }
             elif media_type != "MessageMediaWebPage" and not skip_media_download:
-                print(f"Downloading {media_type} media...")
-
-                if media_type == "MessageMediaPhoto":
-                    # Sometimes, largest PHOTO resolution is not the default... WTF!
-                    """largest_size = max(
-                        msg.photo.sizes,
-                        key=lambda s: getattr(s, "w", 0) * getattr(s, "h", 0),
-                    )
-                    sorted_by_size = sorted(
-                        msg.photo.sizes,
-                        key=lambda s: getattr(s, "size", 0),
-                    )
-                    largest_idx_in_sorted = sorted_by_size.index(largest_size)"""
-                    # input_location = get_input_location(largest_size)
-                    """ input_location = types.InputPhotoFileLocation(
-                        id=msg.photo.id,
-                        access_hash=msg.photo.access_hash,
-                        file_reference=msg.photo.file_reference,
-                        thumb_size=largest_size.type,  # This correctly uses the 'y' type string
-                    ) """
-                    # path = await msg.client.download_file(input_location, file=folder)
-                    # path = await g.client.download_file()
-                    # path = await msg.download_media(thumb=largest_size, file=folder)
-                    """ path = await msg.client.download_media(
-                        msg.photo, thumb=largest_size, file=folder
-                    ) """
-                    """ path = await msg.download_media(
-                        file=folder, thumb=largest_idx_in_sorted
-                    ) """
-                    # path = await g.client.download_media(largest_size, file=folder)
-                    path = await msg.download_media(file=folder)
-                else:
-                    path = await msg.download_media(file=folder)
-
-                if g.base_dir:
-                    rel_path = os.path.relpath(path, g.base_dir)
+                stored = None
+                if g.media_store:
+                    stored = await asyncio.to_thread(g.media_store.find, msg, folder)
+                if stored:
+                    rec["media"] = [stored]
+                elif media_queue := g.channel_media_queue():
+                    # Downloaded in the background; the placeholder is swapped
+                    # for the real path once the file is on disk
+                    await media_queue.wait_for_capacity()
+                    rec["media"] = [media_queue.defer(msg, folder)]
                 else:
-                    rel_path = os.path.relpath(path)
-                rec["media"] = [rel_path]
-                print(f"Downloaded media to {rel_path}")
+                    rec["media"] = [await download_message_media(msg, folder)]
 
     return rec
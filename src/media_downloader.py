@@ -0,0 +1,177 @@
+"""Background media download queue decoupled from message processing"""
+
+import asyncio
+import json
+import os
+
+from .handle_message import download_message_media
+from .request_scheduler import request_priority
+from . import globals as g
+
+# Stored in a record's media list until the download has finished
+PENDING_PREFIX = "pending:"
+
+
+class MediaDownloadQueue:
+    """Bounded, persistent queue of media downloads served by a worker pool.
+
+    ``handle_message`` reserves a placeholder path for each file with
+    ``defer``; records that end up not being stored release theirs with
+    ``discard``. Once the record holding the placeholder is stored, ``dispatch``
+    turns it into a job that is written to ``queue_path`` before it is queued,
+    so downloads that were pending when the process died resume on the next
+    ``start``. Finished downloads are reported through
+    ``on_downloaded(job, rel_path)``, with ``rel_path`` None when the media is
+    gone.
+    """
+
+    def __init__(self, queue_path, workers=4, max_size=100):
+        self.queue_path = queue_path
+        self.workers = workers
+        self.max_size = max_size
+        self.on_downloaded = None
+        self.channel = None  # channels.Channel whose settings downloads use
+        self.client = None
+        self.queue = None
+        self._tasks = []
+        self._deferred = {}  # placeholder -> (msg, folder), not yet dispatched
+        self._messages = {}  # placeholder -> msg for dispatched jobs
+        self._jobs = self._load_jobs()  # placeholder -> job, in flight
+        self._failed = {}  # placeholder -> job, retried on the next start
+        self._capacity = asyncio.Event()
+
+    def _load_jobs(self):
+        """Replay the queue file and rewrite it with only unfinished jobs"""
+        jobs = {}
+        if os.path.exists(self.queue_path):
+            with open(self.queue_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    entry = json.loads(line)
+                    if entry["op"] == "add":
+                        jobs[entry["job"]["placeholder"]] = entry["job"]
+                    else:
+                        jobs.pop(entry["placeholder"], None)
+        with open(self.queue_path, "w", encoding="utf-8") as f:
+            for job in jobs.values():
+                f.write(json.dumps({"op": "add", "job": job}) + "\n")
+        if jobs:
+            print(f"Resuming {len(jobs)} pending media downloads")
+        return jobs
+
+    def _append(self, entry):
+        with open(self.queue_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def pending_count(self):
+        return len(self._jobs)
+
+    def start(self, client):
+        """Start the workers for a (new) client session"""
+        self.client = client
+        # Deferred placeholders are kept: their records may still be stored
+        # (and dispatched) after the reconnect, or else are discarded
+        self._messages.clear()
+        # Jobs that failed last session get another try
+        self._jobs.update(self._failed)
+        self._failed.clear()
+
+        self.queue = asyncio.Queue()
+        for job in self._jobs.values():
+            self.queue.put_nowait(job)
+        self._tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        """Cancel the workers; unfinished jobs stay in the queue file"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self):
+        """Wait until every queued download has finished or failed"""
+        if self.queue is not None and self._jobs:
+            print(f"Waiting for {len(self._jobs)} media downloads to finish...")
+            await self.queue.join()
+
+    async def wait_for_capacity(self):
+        """Block while the queue holds ``max_size`` or more downloads"""
+        while len(self._jobs) >= self.max_size:
+            self._capacity.clear()
+            await self._capacity.wait()
+
+    def defer(self, msg, folder):
+        """Reserve a placeholder path for the media of ``msg``"""
+        placeholder = f"{PENDING_PREFIX}{msg.chat_id}:{msg.id}"
+        self._deferred[placeholder] = (msg, folder)
+        return placeholder
+
+    def discard(self, records):
+        """Forget the deferred downloads of records that will not be stored"""
+        for record in records:
+            for path in record.get("media", []):
+                self._deferred.pop(path, None)
+
+    def dispatch(self, root_id, records):
+        """Queue the deferred downloads referenced by ``records``.
+
+        ``root_id`` is the stored root message the records belong to; it is
+        where ``on_downloaded`` will look for the placeholders.
+        """
+        for record in records:
+            for path in record.get("media", []):
+                if path not in self._deferred:
+                    continue
+                msg, folder = self._deferred.pop(path)
+                job = {
+                    "placeholder": path,
+                    "root_id": root_id,
+                    "chat_id": msg.chat_id,
+                    "msg_id": msg.id,
+                    "folder": folder,
+                    "priority": request_priority.get(),
+                }
+                self._append({"op": "add", "job": job})
+                self._jobs[path] = job
+                self._messages[path] = msg
+                self.queue.put_nowait(job)
+
+    async def _fetch_message(self, job):
+        msg = self._messages.pop(job["placeholder"], None)
+        if msg is None:
+            # Message objects do not survive a restart; fetch it again
+            msg = await g.scheduler.call(
+                "get_messages", self.client.get_messages, job["chat_id"], ids=job["msg_id"]
+            )
+        return msg
+
+    async def _worker(self):
+        # Workers are started outside any channel's task
+        g.current_channel.set(self.channel)
+        while True:
+            job = await self.queue.get()
+            placeholder = job["placeholder"]
+            # Downloads for real-time messages keep their priority
+            request_priority.set(job.get("priority", request_priority.get()))
+            try:
+                msg = await self._fetch_message(job)
+                if msg is None or not msg.media:
+                    print(f"Media for message {job['msg_id']} is no longer available")
+                    rel_path = None
+                else:
+                    rel_path = await download_message_media(msg, job["folder"])
+                if self.on_downloaded:
+                    self.on_downloaded(job, rel_path)
+                self._append({"op": "done", "placeholder": placeholder})
+                self._jobs.pop(placeholder, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Failed to download media for message {job['msg_id']}: {e}")
+                self._failed[placeholder] = self._jobs.pop(placeholder, job)
+            finally:
+                self._capacity.set()
+                self.queue.task_done()
@@ -0,0 +1,171 @@
+"""Content-addressed index of downloaded media files"""
+
+import hashlib
+import json
+import os
+import threading
+
+HASH_CHUNK = 1024 * 1024
+
+
+def media_key(msg):
+    """Telegram's own ID of the photo or document attached to ``msg``, or None"""
+    if msg.photo:
+        return f"photo:{msg.photo.id}"
+    if msg.document:
+        return f"document:{msg.document.id}"
+    return None
+
+
+def file_hash(path):
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_file(source, target):
+    """Replace ``target`` with a hard link to ``source``.
+
+    Returns False, leaving ``target`` untouched, when the file system does not
+    support hard links between the two paths.
+    """
+    tmp_path = f"{target}.link-tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        return False
+    os.replace(tmp_path, target)
+    return True
+
+
+class MediaStore:
+    """Keeps one copy of every media file, however often it is posted.
+
+    Files are indexed by the Telegram photo/document ID and by the SHA-256 of
+    their content. A message whose media ID is already indexed is not
+    downloaded again, and a downloaded file whose content is already stored
+    is replaced by a hard link to the stored copy. The index is an append-only
+    JSONL file; paths in it are relative to ``base_dir``, like the paths in
+    the records.
+    """
+
+    def __init__(self, index_path, base_dir):
+        self.index_path = index_path
+        self.base_dir = base_dir
+        self.by_media_id = {}  # media key -> path
+        self.by_hash = {}  # content hash -> path
+        self.linked = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_config(cls, config, base_dir):
+        output_json_path = os.path.join(base_dir, config["output_json"])
+        return cls(f"{output_json_path}.media-index", base_dir)
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                entry = json.loads(line)
+                if entry.get("media_id"):
+                    self.by_media_id[entry["media_id"]] = entry["path"]
+                self.by_hash.setdefault(entry["sha256"], entry["path"])
+
+    def _append(self, entry):
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _abs(self, rel_path):
+        return os.path.join(self.base_dir, rel_path) if self.base_dir else rel_path
+
+    def _rel(self, path):
+        if self.base_dir:
+            return os.path.relpath(path, self.base_dir)
+        return os.path.relpath(path)
+
+    def find(self, msg, folder):
+        """Return the stored path of the media of ``msg``, or None.
+
+        When the stored copy lives in another folder, it is linked into
+        ``folder`` under the same name where possible. Blocking (file system
+        calls), like ``add``.
+        """
+        key = media_key(msg)
+        with self._lock:
+            rel_path = self.by_media_id.get(key) if key else None
+        if rel_path is None:
+            return None
+        stored = self._abs(rel_path)
+        if not os.path.exists(stored):
+            with self._lock:
+                self.by_media_id.pop(key, None)
+            return None
+
+        with self._lock:
+            self.reused += 1
+        if os.path.samefile(os.path.dirname(stored), folder):
+            return rel_path
+        target = os.path.join(folder, os.path.basename(stored))
+        if os.path.exists(target):
+            return self._rel(target) if os.path.samefile(stored, target) else rel_path
+        try:
+            os.link(stored, target)
+        except OSError:
+            return rel_path
+        return self._rel(target)
+
+    def add(self, rel_path, key=None):
+        """Index a newly downloaded file, linking it to an identical stored copy.
+
+        Blocking (the file is hashed). Returns True if the file was replaced by
+        a link.
+        """
+        path = self._abs(rel_path)
+        digest = file_hash(path)
+        linked = False
+        with self._lock:
+            stored_rel = self.by_hash.get(digest)
+            if stored_rel is None or not os.path.exists(self._abs(stored_rel)):
+                self.by_hash[digest] = rel_path
+            elif not os.path.samefile(self._abs(stored_rel), path):
+                linked = link_file(self._abs(stored_rel), path)
+            elif not key:
+                return False  # already indexed
+            if key:
+                self.by_media_id[key] = rel_path
+            if key or not linked:
+                self._append({"media_id": key, "sha256": digest, "path": rel_path})
+        if linked:
+            self.linked += 1
+        return linked
+
+    def dedupe_folders(self, folders):
+        """Replace duplicate files under ``folders`` with hard links.
+
+        The first copy of each content (in path order) is kept. Returns
+        ``(files linked, bytes freed)``.
+        """
+        linked = freed = 0
+        for folder in folders:
+            if not folder:
+                continue  # unset; would walk the whole working directory
+            for root, dirs, files in os.walk(folder):
+                # Skip partial downloads (.partial) and other hidden folders
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    if os.path.islink(path) or name.endswith(".link-tmp"):
+                        continue
+                    size = os.path.getsize(path)
+                    if self.add(self._rel(path)):
+                        linked += 1
+                        freed += size
+        return linked, freed
@@ -1,36 +1,44 @@
 """Message processing utilities for handling grouped messages and comments"""
 
+import asyncio
+from bisect import bisect
+
 from .handle_message import handle_message
-from .utils import save_messages
+from .metrics import metrics
+from . import globals as g
 
 
 class MessageProcessor:
-    def __init__(self, all_messages, output_json_path):
-        self.all_messages = all_messages
-        self.output_json_path = output_json_path
-        self.last_grouped_id = -1
-        self._message_index = self._build_message_index()
-        self._processed_grouped_messages = set()  # Track processed grouped message IDs
-        self._initialize_processed_grouped_messages()  # Initialize from existing data
-
-    def _build_message_index(self):
-        """Build an index of messages by their ID for quick lookup"""
-        index = {}
-        for i, message in enumerate(self.all_messages):
-            index[message["id"]] = i
-        return index
-
-    def _initialize_processed_grouped_messages(self):
-        """Initialize the set of processed grouped messages from existing data"""
-        # Look through existing messages to find those that have multiple media items
-        # and estimate which message IDs were likely grouped together
-        for msg in self.all_messages:
-            media_list = msg.get("media", [])
-            if len(media_list) > 1:
-                # This message likely contains grouped media
-                # The subsequent message IDs (msg.id + 1, msg.id + 2, etc.) were probably grouped
-                for i in range(1, len(media_list)):
-                    self._processed_grouped_messages.add(msg["id"] + i)
+    def __init__(
+        self, store, media_queue=None, search_index=None, engagement_history=None
+    ):
+        self.store = store
+        self.media_queue = media_queue
+        self.search_index = search_index
+        self.engagement_history = engagement_history
+        if media_queue:
+            media_queue.on_downloaded = self.patch_media
+        # Root messages whose comment thread could not be fetched completely
+        self.incomplete_threads = set()
+        self.albums = {}  # grouped_id -> ID of the root record holding the album
+        self.album_members = {}  # ID of every stored album message -> its root ID
+        self._load_albums()
+
+    def _load_albums(self):
+        """Index the albums already stored"""
+        for root_id, grouped_id, album_ids, media_count in self.store.iter_albums():
+            if grouped_id is None:
+                # Stored before albums were tracked: the members were most
+                # likely the IDs following the root, one per media item
+                album_ids = range(root_id, root_id + media_count)
+            else:
+                self.albums[grouped_id] = root_id
+            for member_id in album_ids:
+                self.album_members[member_id] = root_id
+
+    def album_root(self, grouped_id):
+        """ID of the root record holding an album, or None"""
+        return self.albums.get(grouped_id)
 
     def _get_next_message_version(self, existing_message):
         """Get the next version number for a message"""
@@ -49,33 +57,37 @@ class MessageProcessor:
                 # Also update transliterated version if present
                 try:
                     from .utils import transliterate_text
-                    from . import globals as g
 
+                    settings = g.channel_settings()
                     if (
-                        g.config
-                        and g.config.get("transliterate_key")
+                        settings
+                        and settings.get("transliterate_key")
                         and new_message.get("message")
                     ):
                         transliterated = transliterate_text(
-                            new_message["message"], g.transliteration_schema
+                            new_message["message"], g.channel_transliteration_schema()
                         )
                         if transliterated:
                             existing_message[
-                                f"{g.config['transliterate_key']}V{version}"
+                                f"{settings['transliterate_key']}V{version}"
                             ] = transliterated
                 except (AttributeError, ImportError):
                     # Globals not initialized or transliteration not available
                     pass
 
     def _update_comments(self, existing_message, new_comments):
-        """Update existing comments with new reactions and add new comments"""
+        """Update existing comments with new reactions and add new comments.
+
+        Returns the comments that were updated or added.
+        """
         if not new_comments:
-            return
+            return []
 
         existing_comments = existing_message.get("comments", [])
         existing_comment_ids = {
             comment["id"]: i for i, comment in enumerate(existing_comments)
         }
+        touched = []
 
         for new_comment in new_comments:
             comment_id = new_comment["id"]
@@ -95,14 +107,20 @@ class MessageProcessor:
 
                 # Handle message text versioning for comments too
                 self._update_message_text(existing_comments[idx], new_comment)
+                touched.append(existing_comments[idx])
             else:
                 # Add new comment
                 existing_comments.append(new_comment)
+                touched.append(new_comment)
 
         existing_message["comments"] = existing_comments
+        return touched
 
     def update_existing_message(self, existing_message, new_message):
-        """Update an existing message with new data while preserving history"""
+        """Update an existing message with new data while preserving history.
+
+        Returns the comments that were updated or added.
+        """
         # Update reactions only if they exist in new message
         if "reactions" in new_message:
             existing_message["reactions"] = new_message["reactions"]
@@ -114,78 +132,292 @@ class MessageProcessor:
             existing_message["views"] = new_message["views"]
         if "forwards" in new_message:
             existing_message["forwards"] = new_message["forwards"]
+        self._record_engagement(existing_message)
 
         # Update message text with versioning if different
         self._update_message_text(existing_message, new_message)
 
         # Handle comments if present in new message
         if "comments" in new_message:
-            self._update_comments(existing_message, new_message["comments"])
+            return self._update_comments(existing_message, new_message["comments"])
+        return []
 
-    def find_existing_message(self, message_id):
+    def _record_engagement(self, record):
+        """Append the current counters of a root record to its history, if changed"""
+        if self.engagement_history:
+            self.engagement_history.record(record)
+
+    def find_existing_message(self, message_id, with_comments=True):
         """Find existing message by ID"""
-        if message_id in self._message_index:
-            return (
-                self._message_index[message_id],
-                self.all_messages[self._message_index[message_id]],
-            )
-        return None, None
+        return self.store.get(message_id, with_comments)
+
+    def count(self):
+        """Number of root messages in the store"""
+        return self.store.count()
 
     def rebuild_message_index(self):
         """Rebuild the message index (useful if messages are manually modified)"""
-        self._message_index = self._build_message_index()
+        self.store.rebuild_index()
+
+    def _save_record(self, record, comments=None):
+        """Upsert a root record, index its text and queue its downloads"""
+        with metrics.histogram(
+            "store_save_seconds", "Duration of store writes", operation="upsert"
+        ).time():
+            self.store.upsert_message(record, comments=comments)
+            if self.search_index:
+                self.search_index.update(record, comments=comments)
+        if self.media_queue:
+            if comments is None:
+                comments = record.get("comments", [])
+            self.media_queue.dispatch(record["id"], [record, *comments])
+
+    def save_counters(self, record):
+        """Store the updated root fields (counters) of a stored record.
+
+        Its comments are left as stored, so ``record`` may have been read
+        without them.
+        """
+        self._save_record(record, comments=[])
+
+    def patch_media(self, job, rel_path):
+        """Swap a pending media placeholder for the downloaded file's path"""
+        # Most placeholders are in the root record, which is looked up without
+        # converting its comments
+        placeholder = job["placeholder"]
+        record = self.store.get(job["root_id"], with_comments=False)
+        if record is not None and placeholder not in record.get("media", []):
+            record = self.store.get(job["root_id"])
+        if record is None:
+            print(f"Dropping media for message {job['msg_id']}: record not stored")
+            return
+
+        for target in [record, *record.get("comments", [])]:
+            media = target.get("media", [])
+            if placeholder in media:
+                if rel_path:
+                    media[media.index(placeholder)] = rel_path
+                else:
+                    media.remove(placeholder)
+                    if not media:
+                        del target["media"]
+                comments = [] if target is record else [target]
+                self.store.upsert_message(record, comments=comments)
+                self.commit()
+                return
+
+    async def wait_for_downloads(self):
+        """Wait for queued media downloads to finish"""
+        if self.media_queue:
+            await self.media_queue.join()
+
+    def commit(self):
+        """Persist all changes recorded since the last commit"""
+        with metrics.histogram(
+            "store_save_seconds", "Duration of store writes", operation="commit"
+        ).time():
+            self.store.commit()
+            if self.search_index:
+                self.search_index.commit()
+            if self.engagement_history:
+                self.engagement_history.commit()
+
+    def close(self):
+        """Flush the store and fold its journal into the output file"""
+        self.store.close()
+        if self.search_index:
+            self.search_index.close()
+        if self.engagement_history:
+            self.engagement_history.close()
+
+    def _start_album(self, record, grouped_id, album_ids):
+        record["grouped_id"] = grouped_id
+        record["album_ids"] = album_ids
+        self.albums[grouped_id] = record["id"]
+        for member_id in album_ids:
+            self.album_members[member_id] = record["id"]
+
+    def _adopt_album(self, existing_message, msg):
+        """Record the album of a root stored before albums were tracked"""
+        if msg.grouped_id and "grouped_id" not in existing_message:
+            media_count = max(1, len(existing_message.get("media", [])))
+            self._start_album(
+                existing_message,
+                msg.grouped_id,
+                list(range(msg.id, msg.id + media_count)),
+            )
 
     def _handle_grouped_message(self, root_rec, msg):
-        """Handle grouped message logic and return whether message was appended to existing group"""
-        if msg.grouped_id and msg.grouped_id == self.last_grouped_id:
-            # Append media to the last message if it's part of the same group
-            if self.all_messages and "media" in self.all_messages[-1]:
-                self.all_messages[-1]["media"].append(root_rec["media"][0])
-            self.last_grouped_id = msg.grouped_id
-            # Track this message as part of a processed group
-            self._processed_grouped_messages.add(msg.id)
-            return True
-        else:
-            self.last_grouped_id = msg.grouped_id if msg.grouped_id is not None else -1
+        """Merge an album message into the root record of its album.
+
+        Returns True when the album is already stored under another message;
+        the media (and a caption the root lacks) is then added to that
+        record, in message ID order whatever order the members arrive in.
+        Otherwise ``root_rec`` becomes the root of a new album (if ``msg``
+        belongs to one) and False is returned.
+        """
+        if not msg.grouped_id:
             return False
+        root_id = self.albums.get(msg.grouped_id)
+        root = None
+        if root_id is not None and root_id != msg.id:
+            root = self.store.get(root_id, with_comments=False)
+        if root is None:
+            self._start_album(root_rec, msg.grouped_id, [msg.id])
+            return False
+
+        album_ids = root.setdefault("album_ids", [root_id])
+        if msg.id not in album_ids:
+            position = bisect(album_ids, msg.id)
+            media = root.setdefault("media", [])
+            if len(media) == len(album_ids):
+                # One item per member so far, so positions line up
+                media[position:position] = root_rec.get("media", [])
+            else:
+                media.extend(root_rec.get("media", []))
+            album_ids.insert(position, msg.id)
+
+            # The caption is on one member, not always the first to arrive
+            if root_rec.get("message") and not root.get("message"):
+                text_keys = {"message", g.channel_settings().get("transliterate_key")}
+                for key, value in root_rec.items():
+                    if key in text_keys:
+                        root[key] = value
+            self._save_record(root, comments=[])
+        self.album_members[msg.id] = root_id
+        return True
 
     def _should_skip_grouped_message(self, msg):
         """Check if this grouped message should be skipped because it's already part of an existing group"""
         if not msg.grouped_id:
             return False
 
-        # If this message ID has already been processed as part of a group, skip it
-        return msg.id in self._processed_grouped_messages
+        # Members already merged into another message's record are not stored again
+        return self.album_members.get(msg.id, msg.id) != msg.id
 
     def process_new_message(self, root_rec, msg):
         """Process a new message and handle grouping logic"""
         # Check if message already exists (for real-time updates)
-        existing_index, existing_message = self.find_existing_message(msg.id)
+        existing_message = self.find_existing_message(msg.id)
 
         if existing_message is not None:
             # Message exists, update it
             print(f"Updating existing message {msg.id} in real-time")
-            self.update_existing_message(existing_message, root_rec)
+            touched = self.update_existing_message(existing_message, root_rec)
+            self._adopt_album(existing_message, msg)
+            self._save_record(existing_message, comments=touched)
         else:
             # New message, handle normally
             if not self._handle_grouped_message(root_rec, msg):
-                self.all_messages.append(root_rec)
-                # Update the index for the new message
-                self._message_index[msg.id] = len(self.all_messages) - 1
+                self._record_engagement(root_rec)
+                self._save_record(root_rec)
+
+        self.commit()
+
+    def existing_comments(self, message_id):
+        """Comments already stored for a root message, by ID"""
+        existing_message = self.store.get(message_id)
+        if existing_message is None:
+            return {}
+        return {
+            comment["id"]: comment for comment in existing_message.get("comments", [])
+        }
 
-        save_messages(self.all_messages, self.output_json_path)
+    async def fetch_comments(self, client, msg, channel_username, existing=None):
+        """Fetch and convert the comment thread of a root message.
+
+        ``existing`` maps IDs of already stored comments to their records.
+        Up to ``reaction_lookup_concurrency`` comments are converted at once,
+        so their reaction lookups (and inline downloads) overlap without a
+        long thread starting a task per comment. Returns ``(comments, error)``;
+        when fetching fails, ``comments`` holds whatever was fetched before
+        the error.
+        """
+        existing = existing or {}
+        limit = max(1, g.channel_settings().get("reaction_lookup_concurrency", 4))
+        tasks = []
+        window = set()  # tasks still converting
+        comments = []
+        error = None
+        returned = False
+        try:
+            try:
+                async for comment in g.scheduler.iter_messages(
+                    client, channel_username, "replies", reply_to=msg.id, reverse=True
+                ):
+                    if len(window) >= limit:
+                        _, window = await asyncio.wait(
+                            window, return_when=asyncio.FIRST_COMPLETED
+                        )
+                    previous = existing.get(comment.id)
+                    # Skip media download only for existing comments
+                    task = asyncio.create_task(
+                        handle_message(
+                            comment,
+                            is_comment=True,
+                            skip_media_download=previous is not None,
+                            previous=previous,
+                        )
+                    )
+                    tasks.append(task)
+                    window.add(task)
+            except Exception as e:
+                error = e
 
-    async def process_message_with_comments(self, client, msg, channel_username):
-        """Process a message and its comments for historical sync"""
+            try:
+                for task in tasks:
+                    comments.append(await task)
+            except Exception as e:
+                error = error or e
+            returned = True
+            return comments, error
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Comments converted but not returned (all of them when cancelled)
+            dropped = [] if returned else comments
+            dropped += [
+                task.result()
+                for task in tasks[len(comments) :]
+                if task.done() and not task.cancelled() and task.exception() is None
+            ]
+            self.discard_media(dropped)
+
+    def discard_media(self, records):
+        """Release the media placeholders of converted records never stored"""
+        if self.media_queue and records:
+            self.media_queue.discard(records)
+
+    def drop_prefetched(self, prefetched):
+        """Cancel an unneeded comment fetch (see ``fetch_comments``)"""
+        prefetched.cancel()
+        if (
+            prefetched.done()
+            and not prefetched.cancelled()
+            and prefetched.exception() is None
+        ):
+            comments, _ = prefetched.result()
+            self.discard_media(comments)
+
+    async def process_message_with_comments(
+        self, client, msg, channel_username, prefetched=None
+    ):
+        """Process a message and its comments for historical sync.
+
+        ``prefetched`` is an optional task already fetching the comments of
+        ``msg`` (see ``fetch_comments``); it is cancelled if not needed.
+        """
         # Check if this is a grouped message that should be skipped
         if self._should_skip_grouped_message(msg):
             print(
                 f"Skipping grouped message {msg.id} (part of existing group {msg.grouped_id})"
             )
+            if prefetched is not None:
+                self.drop_prefetched(prefetched)
             return None
 
         # Check if message already exists
-        existing_index, existing_message = self.find_existing_message(msg.id)
+        existing_message = self.find_existing_message(msg.id)
 
         if existing_message is not None:
             # Message exists, update it (skip media download)
@@ -195,51 +427,54 @@ class MessageProcessor:
             )
 
             # Process comments separately and merge them properly
-            try:
-                new_comments = []
-                existing_comments = existing_message.get("comments", [])
-                existing_comment_ids = {comment["id"] for comment in existing_comments}
-
-                async for comment in client.iter_messages(
-                    channel_username, reply_to=msg.id, reverse=True
-                ):
-                    # Skip media download only for existing comments
-                    skip_media = comment.id in existing_comment_ids
-                    comment_rec = await handle_message(
-                        comment, is_comment=True, skip_media_download=skip_media
-                    )
-                    new_comments.append(comment_rec)
-
-                # Update the existing message first (without comments)
-                self.update_existing_message(existing_message, root_rec)
-
-                # Then merge comments properly
-                if new_comments:
-                    self._update_comments(existing_message, new_comments)
+            if prefetched is None:
+                prefetched = self.fetch_comments(
+                    client,
+                    msg,
+                    channel_username,
+                    self.existing_comments(msg.id),
+                )
+            new_comments, error = await prefetched
+
+            # Re-read the record: background downloads may have patched it
+            # while the comments were being fetched
+            existing_message = self.find_existing_message(msg.id)
+
+            # Update the existing message first (without comments)
+            self.update_existing_message(existing_message, root_rec)
+            self._adopt_album(existing_message, msg)
 
-            except Exception as e:
-                print(f"Error processing comments for message {msg.id}: {e}")
+            if error:
+                print(f"Error processing comments for message {msg.id}: {error}")
                 # Still update the message even if comment processing fails
-                self.update_existing_message(existing_message, root_rec)
+                touched = []
+                self.discard_media(new_comments)
+                self.incomplete_threads.add(msg.id)
+            else:
+                # Then merge comments properly
+                touched = self._update_comments(existing_message, new_comments)
+                self.incomplete_threads.discard(msg.id)
+            self._save_record(existing_message, comments=touched)
 
         else:
             # New message, process normally with media download
             root_rec = await handle_message(msg, is_comment=False)
             if not self._handle_grouped_message(root_rec, msg):
                 # Process comments
-                try:
-                    async for comment in client.iter_messages(
-                        channel_username, reply_to=msg.id, reverse=True
-                    ):
-                        comment_rec = await handle_message(comment, is_comment=True)
-                        if "comments" not in root_rec:
-                            root_rec["comments"] = []
-                        root_rec["comments"].append(comment_rec)
-                except Exception as e:
-                    print(f"Error processing comments for message {msg.id}: {e}")
-
-                self.all_messages.append(root_rec)
-                # Update the index for the new message
-                self._message_index[msg.id] = len(self.all_messages) - 1
+                if prefetched is None:
+                    prefetched = self.fetch_comments(client, msg, channel_username)
+                comments, error = await prefetched
+                if error:
+                    print(f"Error processing comments for message {msg.id}: {error}")
+                    self.incomplete_threads.add(msg.id)
+                else:
+                    self.incomplete_threads.discard(msg.id)
+                if comments:
+                    root_rec["comments"] = comments
+
+                self._record_engagement(root_rec)
+                self._save_record(root_rec)
+            elif prefetched is not None:
+                self.drop_prefetched(prefetched)
 
         return root_rec
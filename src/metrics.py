@@ -0,0 +1,254 @@
+"""Counters, gauges and histograms of where the scraper spends its time.
+
+Every module records into the process-wide ``metrics`` registry. It is served in
+the Prometheus text format by ``start_in_background`` (``metrics_port``), and
+``report_periodically`` prints a one-line summary of the last interval.
+"""
+
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds; the last bucket is +Inf
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+DEFAULT_SUMMARY_SECONDS = 60
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Bucketed distribution of observed values (usually seconds)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the ``with`` block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q, counts=None):
+        """Upper bound of the bucket holding quantile ``q`` of ``counts``"""
+        counts = counts or self.counts
+        total = sum(counts)
+        if not total:
+            return 0.0
+        seen = 0
+        for bound, count in zip((*self.buckets, float("inf")), counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+
+KINDS = {"counter": Counter, "gauge": Gauge, "histogram": Histogram}
+
+
+class Metrics:
+    """Registry of metric families, each holding one series per label set"""
+
+    def __init__(self):
+        self._families = {}  # name -> (kind, help, {labels: metric})
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, help, labels):
+        key = tuple(sorted(labels.items()))
+        family = self._families.get(name)
+        if family is None or key not in family[2]:
+            with self._lock:
+                family = self._families.setdefault(name, (kind, help, {}))
+                if family[0] != kind:
+                    raise ValueError(f"{name} is a {family[0]}, not a {kind}")
+                family[2].setdefault(key, KINDS[kind]())
+        return family[2][key]
+
+    def counter(self, name, help="", **labels):
+        return self._get("counter", name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self._get("gauge", name, help, labels)
+
+    def histogram(self, name, help="", **labels):
+        return self._get("histogram", name, help, labels)
+
+    def series(self, name):
+        """``{labels: metric}`` of a family (empty if nothing was recorded)"""
+        with self._lock:
+            family = self._families.get(name)
+            return dict(family[2]) if family else {}
+
+    def render(self):
+        """All series in the Prometheus text exposition format"""
+        with self._lock:
+            families = [
+                (name, kind, help, list(series.items()))
+                for name, (kind, help, series) in sorted(self._families.items())
+            ]
+        lines = []
+        for name, kind, help, series in families:
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(metric.value)}")
+                    continue
+                cumulative = 0
+                bounds = [f"{bound:g}" for bound in metric.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, list(metric.counts)):
+                    cumulative += count
+                    bucket_labels = _labels((*labels, ("le", bound)))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(metric.sum)}")
+                lines.append(f"{name}_count{_labels(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+# The registry the whole scraper records into
+metrics = Metrics()
+
+
+class Summary:
+    """One-line digest of what changed in the registry since the last call"""
+
+    def __init__(self, registry=metrics):
+        self.registry = registry
+        self.previous = {}  # (name, labels) -> counter value or histogram counts
+        self.previous_time = time.monotonic()
+
+    def _delta(self, name, labels, metric):
+        key = (name, labels)
+        if isinstance(metric, Histogram):
+            current = (list(metric.counts), metric.sum)
+            before = self.previous.get(key, ([0] * len(current[0]), 0.0))
+            self.previous[key] = current
+            return [a - b for a, b in zip(current[0], before[0])], current[1] - before[1]
+        before = self.previous.get(key, 0.0)
+        self.previous[key] = metric.value
+        return metric.value - before
+
+    def _histograms(self, name, label):
+        parts = []
+        for labels, metric in sorted(self.registry.series(name).items()):
+            counts, _ = self._delta(name, labels, metric)
+            if sum(counts):
+                value = dict(labels).get(label, "all")
+                p95 = metric.quantile(0.95, counts)
+                parts.append(f"{value} {sum(counts)}x p95<={p95 * 1000:g}ms")
+        return parts
+
+    def _total(self, name):
+        return sum(
+            self._delta(name, labels, metric)
+            for labels, metric in self.registry.series(name).items()
+        )
+
+    def line(self):
+        now = time.monotonic()
+        elapsed = max(now - self.previous_time, 1e-9)
+        self.previous_time = now
+
+        requests = self._histograms("telegram_request_seconds", "request_class")
+        handled = self._histograms("handle_message_seconds", "kind")
+        saves = self._histograms("store_save_seconds", "operation")
+        media = self._total("media_downloaded_bytes_total")
+        flood_wait = self._total("flood_wait_seconds_total")
+        depth = sum(
+            metric.value
+            for metric in self.registry.series("realtime_buffer_depth").values()
+        )
+        return (
+            f"Metrics ({elapsed:.0f}s): "
+            f"requests [{', '.join(requests) or 'none'}]; "
+            f"handled [{', '.join(handled) or 'none'}]; "
+            f"saves [{', '.join(saves) or 'none'}]; "
+            f"media {media / 2**20 / elapsed:.2f} MiB/s; "
+            f"buffer depth {depth:g}; FloodWait {flood_wait:g}s"
+        )
+
+
+async def report_periodically(interval=DEFAULT_SUMMARY_SECONDS, registry=metrics):
+    """Print a ``Summary`` line every ``interval`` seconds"""
+    summary = Summary(registry)
+    while True:
+        await asyncio.sleep(interval)
+        print(summary.line(), flush=True)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(host, port, registry=metrics):
+    handler = type("Handler", (MetricsRequestHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(host, port, registry=metrics):
+    """Serve ``/metrics`` from a daemon thread of the running scraper"""
+    server = make_server(host, port, registry)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    print(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
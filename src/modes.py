@@ -1,18 +1,41 @@
 """Different operating modes for the telegram scraper"""
 
-from .utils import save_messages
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
+
+from telethon.tl.functions.messages import (
+    GetMessagesReactionsRequest,
+    GetMessagesViewsRequest,
+)
+from telethon.tl.types import UpdateMessageReactions
+
+from .comment_prefetcher import CommentPrefetcher
+from .reaction_lookup import get_reaction_key
+from .sync_checkpoint import SyncCheckpoint
+from . import globals as g
+
+# Message IDs per GetMessagesViews / GetMessagesReactions request
+REFRESH_BATCH = 100
+DEFAULT_REFRESH_DAYS = 30
+REFRESHED_FIELDS = ("views", "forwards", "reactions")
 
 
 class HistoricalSyncMode:
-    def __init__(self, message_processor):
+    def __init__(self, message_processor, comment_concurrency=1):
         self.message_processor = message_processor
+        self.comment_concurrency = comment_concurrency
+        self.checkpoint = None
 
     def get_default_offset_id(self):
         """Calculate default offset ID based on existing messages"""
+        if self.checkpoint and self.checkpoint.last_message_id is not None:
+            return self.checkpoint.last_message_id
+
+        # Archives synced before checkpoints existed: estimate from the last record
         default_offset_id = 0
         try:
-            if self.message_processor.all_messages:
-                last_message = self.message_processor.all_messages[-1]
+            last_message = self.message_processor.store.last(with_comments=False)
+            if last_message:
                 media_count = len(last_message.get("media", []))
                 if media_count:
                     media_count -= 1  # Because first message carries media!
@@ -85,27 +108,202 @@ class HistoricalSyncMode:
     async def run(self, client, channel_username, output_json_path, args=None):
         """Run historical sync mode"""
         print("Starting in Historical Sync mode...")
+        self.checkpoint = SyncCheckpoint(
+            f"{output_json_path}.sync-checkpoint", channel_username
+        )
+        if self.checkpoint.load():
+            print(
+                f"Sync checkpoint: last committed message {self.checkpoint.last_message_id}, "
+                f"{len(self.checkpoint.incomplete_threads)} incomplete comment threads"
+            )
         offset_id, stop_count = self.get_user_input(args)
         count = 1
 
-        async for msg in client.iter_messages(
-            channel_username, offset_id=offset_id, reverse=True
-        ):
-            print(f"Processing message {count} (ID: {msg.id})...")
+        await self.retry_incomplete_threads(client, channel_username)
+
+        messages = g.scheduler.iter_messages(
+            client, channel_username, "history", offset_id=offset_id, reverse=True
+        )
+        if self.comment_concurrency > 1:
+            # Fetch comment threads of upcoming messages while committing in order
+            print(f"Fetching comments with concurrency {self.comment_concurrency}")
+            prefetcher = CommentPrefetcher(
+                self.message_processor,
+                client,
+                channel_username,
+                self.comment_concurrency,
+            )
+            pairs = prefetcher.prefetch(messages)
+        else:
+            pairs = ((msg, None) async for msg in messages)
+
+        async with aclosing(pairs):
+            async for msg, prefetched in pairs:
+                print(f"Processing message {count} (ID: {msg.id})...")
+
+                await self.message_processor.process_message_with_comments(
+                    client, msg, channel_username, prefetched
+                )
+                count += 1
+
+                self.message_processor.commit()
+                self.checkpoint.advance(msg, self.message_processor.incomplete_threads)
+
+                if stop_count is not None and count >= stop_count:
+                    print(f"Reached stop_count of {stop_count}. Stopping.")
+                    break
+
+        await self.message_processor.wait_for_downloads()
+
+        print(
+            f"Saved {count - 1} new messages to {output_json_path}, totaling {self.message_processor.count()} messages."
+        )
+        if g.scheduler.flood_waits:
+            print(
+                f"Waited out {g.scheduler.flood_waits} FloodWaits ({g.scheduler.flood_wait_seconds}s in total)."
+            )
+
+    async def retry_incomplete_threads(self, client, channel_username):
+        """Fetch again the comment threads that failed in a previous run"""
+        incomplete = self.message_processor.incomplete_threads
+        incomplete.update(self.checkpoint.incomplete_threads)
+        if not incomplete:
+            return
 
+        for message_id in sorted(incomplete):
+            print(f"Retrying comments of message {message_id}...")
+            msg = await g.scheduler.call(
+                "get_messages", client.get_messages, channel_username, ids=message_id
+            )
+            if msg is None:
+                # Deleted from the channel; there is nothing left to fetch
+                incomplete.discard(message_id)
+                continue
             await self.message_processor.process_message_with_comments(
                 client, msg, channel_username
             )
-            count += 1
+            self.message_processor.commit()
+
+        self.checkpoint.incomplete_threads = sorted(incomplete)
+        self.checkpoint.save()
+
+
+class RefreshMode:
+    """Update views, forwards and reactions of stored posts in an ID range.
+
+    Counters are fetched for up to ``REFRESH_BATCH`` messages per request,
+    with one ``GetMessagesViews`` and one ``GetMessagesReactions`` request per
+    batch, so neither messages nor comment threads are iterated. Only records
+    whose counters changed are written, but every refreshed message gets a
+    snapshot in the engagement history.
+    """
+
+    def __init__(self, message_processor, batch_size=REFRESH_BATCH):
+        self.message_processor = message_processor
+        self.batch_size = batch_size
+        self.requests = 0
+
+    async def first_id_since(self, client, channel_username, since):
+        """ID of the first message posted at or after ``since``"""
+        older = await g.scheduler.call(
+            "get_messages",
+            client.get_messages,
+            channel_username,
+            offset_date=since,
+            limit=1,
+        )
+        self.requests += 1
+        return older[0].id + 1 if older else 0
+
+    async def resolve_range(self, client, channel_username, args=None):
+        """``(first_id, last_id)`` to refresh; ``last_id`` None means no limit"""
+        from_id = getattr(args, "from_id", None)
+        to_id = getattr(args, "to_id", None)
+        if from_id is not None:
+            return from_id, to_id
+        days = getattr(args, "refresh_days", None) or DEFAULT_REFRESH_DAYS
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        first_id = await self.first_id_since(client, channel_username, since)
+        print(f"Refreshing messages of the last {days} days (from ID {first_id})")
+        return first_id, to_id
+
+    async def fetch_counters(self, client, channel_username, ids):
+        """``{id: {"views", "forwards", "reactions"}}`` for a batch of IDs.
+
+        ``reactions`` is missing for messages Telegram did not report on.
+        """
+        views = await g.scheduler.call(
+            "refresh",
+            client,
+            GetMessagesViewsRequest(peer=channel_username, id=ids, increment=False),
+        )
+        reactions = await g.scheduler.call(
+            "refresh",
+            client,
+            GetMessagesReactionsRequest(peer=channel_username, id=ids),
+        )
+        self.requests += 2
+
+        counters = {
+            message_id: {"views": counts.views, "forwards": counts.forwards}
+            for message_id, counts in zip(ids, views.views)
+        }
+        for update in getattr(reactions, "updates", []):
+            if isinstance(update, UpdateMessageReactions) and update.msg_id in counters:
+                counters[update.msg_id]["reactions"] = [
+                    {"reaction": get_reaction_key(r.reaction), "count": r.count}
+                    for r in update.reactions.results
+                ]
+        return counters
+
+    def apply(self, message_id, counters):
+        """Write changed counters of one stored record; returns whether it changed"""
+        existing = self.message_processor.find_existing_message(
+            message_id, with_comments=False
+        )
+        if existing is None:
+            return False
+
+        new_message = {}
+        for key in ("views", "forwards"):
+            if counters.get(key) is not None:
+                new_message[key] = counters[key]
+        reactions = counters.get("reactions", existing.get("reactions"))
+        if reactions:
+            # No reactions at all (an empty list) removes the field
+            new_message["reactions"] = reactions
+
+        before = [existing.get(key) for key in REFRESHED_FIELDS]
+        self.message_processor.update_existing_message(existing, new_message)
+        if [existing.get(key) for key in REFRESHED_FIELDS] == before:
+            return False
+        self.message_processor.save_counters(existing)
+        return True
 
-            save_messages(self.message_processor.all_messages, output_json_path)
+    async def run(self, client, channel_username, args=None):
+        """Run refresh mode"""
+        print("Starting in Refresh mode...")
+        first_id, last_id = await self.resolve_range(client, channel_username, args)
+        ids = [
+            message_id
+            for message_id in sorted(self.message_processor.store.message_ids())
+            if message_id >= first_id and (last_id is None or message_id <= last_id)
+        ]
+        batches = [
+            ids[i : i + self.batch_size] for i in range(0, len(ids), self.batch_size)
+        ]
+        print(f"Refreshing {len(ids)} stored messages in {len(batches)} batches")
 
-            if stop_count is not None and count >= stop_count:
-                print(f"Reached stop_count of {stop_count}. Stopping.")
-                break
+        updated = 0
+        for batch in batches:
+            counters = await self.fetch_counters(client, channel_username, batch)
+            for message_id, message_counters in counters.items():
+                if self.apply(message_id, message_counters):
+                    updated += 1
+            self.message_processor.commit()
 
         print(
-            f"Saved {count - 1} new messages to {output_json_path}, totaling {len(self.message_processor.all_messages)} messages."
+            f"Updated {updated} of {len(ids)} messages with {self.requests} requests."
         )
 
 
@@ -128,12 +326,15 @@ def get_mode_choice(args=None):
             return "1"
         elif args.mode in ["2", "realtime"]:
             return "2"
+        elif args.mode in ["3", "refresh"]:
+            return "3"
         else:
             return "2"  # Default to real-time
 
     return (
         input(
-            "Choose mode: [1] Historical Sync [2] Real-time Listening (default: 2): "
+            "Choose mode: [1] Historical Sync [2] Real-time Listening "
+            "[3] Refresh Stats (default: 2): "
         ).strip()
         or "2"
     )
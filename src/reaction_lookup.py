@@ -0,0 +1,137 @@
+"""Cached and coalesced lookups of who reacted to a comment"""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from telethon.tl.functions.messages import GetMessageReactionsListRequest
+
+from . import globals as g
+
+
+def get_reaction_key(reaction):
+    """Extract reaction identifier from a reaction object"""
+    return (
+        reaction.emoticon if hasattr(reaction, "emoticon") else type(reaction).__name__
+    )
+
+
+def reaction_counts(msg):
+    """Hashable snapshot of a message's reaction counts"""
+    return tuple(
+        (get_reaction_key(result.reaction), result.count)
+        for result in msg.reactions.results
+    )
+
+
+class ReactionLookup:
+    """Finds the reactions the channel itself left on a comment.
+
+    A ``GetMessageReactionsListRequest`` is only issued when the reaction counts
+    differ from the stored record and from the cached result for the same
+    ``(peer, msg_id)``. Concurrent lookups of the same message share one
+    request, and at most ``concurrency`` requests are in flight; their rate is
+    limited by the ``reactions`` class of the request scheduler.
+    """
+
+    def __init__(self, ttl=3600, max_entries=100_000, concurrency=4):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # key -> (expires_at, counts, reactions)
+        self._in_flight = {}  # key -> future
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.requests = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            ttl=config.get("reaction_cache_ttl", 3600),
+            concurrency=config.get("reaction_lookup_concurrency", 4),
+        )
+
+    async def creator_reactions(self, msg, previous=None):
+        """Return the reaction keys the channel left on ``msg``.
+
+        ``previous`` is the stored record of the same comment, if any.
+        """
+        counts = reaction_counts(msg)
+
+        if previous is not None:
+            stored = tuple(
+                (r["reaction"], r["count"]) for r in previous.get("reactions", [])
+            )
+            if stored == counts:
+                self.skipped += 1
+                return {
+                    r["reaction"]
+                    for r in previous["reactions"]
+                    if r.get("is_from_creator")
+                }
+
+        key = (getattr(msg.peer_id, "channel_id", None), msg.id)
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic() and cached[1] == counts:
+            self._cache.move_to_end(key)
+            self.skipped += 1
+            return cached[2]
+
+        while key in self._in_flight:
+            future = self._in_flight[key]
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The task that owned the lookup was cancelled, not this
+                # one; look it up again
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            reactions = await self._request(msg)
+            self._remember(key, counts, reactions)
+            future.set_result(reactions)
+            return reactions
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure is not reported as lost
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def _request(self, msg):
+        async with self._semaphore:
+            self.requests += 1
+            all_reactions = await g.scheduler.call(
+                "reactions",
+                g.client,
+                GetMessageReactionsListRequest(peer=msg.peer_id, id=msg.id, limit=100),
+            )
+
+        creator_reactions = set()
+        for reaction_peer in all_reactions.reactions:
+            # Check if the reaction is from the channel itself
+            if (
+                hasattr(reaction_peer.peer_id, "channel_id")
+                and reaction_peer.peer_id.channel_id == msg.peer_id.channel_id
+            ):
+                creator_reactions.add(get_reaction_key(reaction_peer.reaction))
+        return creator_reactions
+
+    def _remember(self, key, counts, reactions):
+        self._cache[key] = (time.monotonic() + self.ttl, counts, reactions)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        # Drop expired entries from the cold end
+        now = time.monotonic()
+        while self._cache:
+            oldest = next(iter(self._cache.values()))
+            if oldest[0] > now:
+                break
+            self._cache.popitem(last=False)
@@ -0,0 +1,140 @@
+"""Compact in-memory representation of message and comment records"""
+
+import sys
+
+# Fields held in slots; every other key of a record goes to ``extra``
+SLOT_FIELDS = (
+    "id",
+    "date",
+    "reply_to",
+    "sender_id",
+    "first_name",
+    "last_name",
+    "username",
+    "message",
+    "views",
+    "forwards",
+)
+# Short strings that repeat across many records
+INTERNED_FIELDS = ("first_name", "last_name", "username")
+
+# Key tuples are shared between records with the same fields in the same order
+_key_orders = {}
+
+
+def _shared_keys(keys):
+    keys = tuple(keys)
+    return _key_orders.setdefault(keys, keys)
+
+
+def _pack_reactions(reactions):
+    """Pack reactions into (reaction, count, is_from_creator) tuples.
+
+    Returns None when the list holds anything the tuples cannot reproduce.
+    """
+    packed = []
+    for r in reactions:
+        keys = tuple(r)
+        if keys == ("reaction", "count"):
+            packed.append((sys.intern(r["reaction"]), r["count"], None))
+        elif keys == ("reaction", "count", "is_from_creator"):
+            packed.append((sys.intern(r["reaction"]), r["count"], r["is_from_creator"]))
+        else:
+            return None
+    return tuple(packed)
+
+
+def _unpack_reactions(packed):
+    reactions = []
+    for reaction, count, is_from_creator in packed:
+        r = {"reaction": reaction, "count": count}
+        if is_from_creator is not None:
+            r["is_from_creator"] = is_from_creator
+        reactions.append(r)
+    return reactions
+
+
+def merge_comments(held, comments):
+    """Put comment dicts among compact comments, replacing those with their ID.
+
+    Only ``comments`` are converted; ``held`` is returned as is, extended, or
+    with some items replaced.
+    """
+    if not comments:
+        return held or ()
+    merged = list(held or ())
+    positions = {comment.id: i for i, comment in enumerate(merged)}
+    for comment in comments:
+        compact = MessageRecord.from_dict(comment)
+        if compact.id in positions:
+            merged[positions[compact.id]] = compact
+        else:
+            merged.append(compact)
+    return tuple(merged)
+
+
+class MessageRecord:
+    """Slotted form of a record from messages.json.
+
+    Common fields live in slots, repeated names and reaction keys are interned,
+    reactions are packed into tuples and comments are nested records. Key
+    order is remembered in a shared tuple, so ``to_dict`` reproduces the
+    original record exactly.
+    """
+
+    __slots__ = SLOT_FIELDS + ("reactions", "media", "comments", "extra", "keys")
+
+    @classmethod
+    def from_dict(cls, record, comments=None):
+        """Convert a record; ``comments``, if given, are held instead of its own"""
+        self = cls()
+        keys = list(record)
+        if comments and "comments" not in record:
+            keys.append("comments")
+        self.keys = _shared_keys(keys)
+        self.reactions = None
+        self.media = None
+        self.comments = None
+        self.extra = None
+        for key, value in record.items():
+            if key in SLOT_FIELDS:
+                if key in INTERNED_FIELDS and isinstance(value, str):
+                    value = sys.intern(value)
+                setattr(self, key, value)
+            elif key == "reactions" and (packed := _pack_reactions(value)) is not None:
+                self.reactions = packed
+            elif key == "media" and all(isinstance(path, str) for path in value):
+                self.media = tuple(value)
+            elif key == "comments":
+                if comments is None:
+                    comments = tuple(cls.from_dict(comment) for comment in value)
+                self.comments = comments
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+        if comments and "comments" not in record:
+            self.comments = comments
+        return self
+
+    def to_dict(self, with_comments=True):
+        record = {}
+        for key in self.keys:
+            if key == "comments" and not with_comments:
+                continue
+            if key in SLOT_FIELDS:
+                record[key] = getattr(self, key)
+            elif key == "reactions" and self.reactions is not None:
+                record[key] = _unpack_reactions(self.reactions)
+            elif key == "media" and self.media is not None:
+                record[key] = list(self.media)
+            elif key == "comments":
+                record[key] = [comment.to_dict() for comment in self.comments]
+            else:
+                record[key] = self.extra[key]
+        return record
+
+    def media_count(self):
+        if self.media is not None:
+            return len(self.media)
+        return len(self.extra.get("media", [])) if self.extra else 0
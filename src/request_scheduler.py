@@ -0,0 +1,218 @@
+"""Central scheduler that every Telegram API call goes through"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+
+from telethon.errors import FloodWaitError
+
+from .metrics import metrics
+
+# Request priorities; lower values are served first
+REALTIME = 0
+BACKFILL = 1
+
+# Priority of the requests made by the current task
+request_priority = ContextVar("request_priority", default=BACKFILL)
+
+# Telethon fetches message history in pages of this many messages
+PAGE_SIZE = 100
+
+# (requests per second, burst) per request class
+DEFAULT_RATES = {
+    "history": (3, 10),
+    "replies": (3, 10),
+    "reactions": (5, 5),
+    "download": (10, 10),
+    "get_messages": (5, 5),
+    "refresh": (3, 5),
+    "session": (5, 5),
+}
+FALLBACK_RATE = (5, 5)
+
+# Rate is multiplied by this after a FloodWait and recovers gradually
+BACKOFF_FACTOR = 0.5
+RECOVERY_FACTOR = 1.1
+RECOVERY_AFTER = 20  # successful requests before the rate is raised again
+
+
+class TokenBucket:
+    """Token bucket with a priority queue of waiters and a FloodWait block"""
+
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.successes = 0
+        self._waiters = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._condition = asyncio.Condition()
+
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _delay(self):
+        """Seconds until a token can be taken"""
+        now = time.monotonic()
+        self._refill(now)
+        delay = self.blocked_until - now
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return max(delay, 0)
+
+    async def acquire(self, priority):
+        """Wait for a token, serving higher-priority waiters first"""
+        entry = (priority, next(self._seq))
+        async with self._condition:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    delay = self._delay()
+                    if self._waiters[0] == entry and delay == 0:
+                        heapq.heappop(self._waiters)
+                        self.tokens -= 1
+                        self._condition.notify_all()
+                        return
+                    timeout = delay if self._waiters[0] == entry else None
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._condition.notify_all()
+                raise
+
+    def on_success(self):
+        self.successes += 1
+        if self.rate < self.base_rate and self.successes >= RECOVERY_AFTER:
+            self.rate = min(self.base_rate, self.rate * RECOVERY_FACTOR)
+            self.successes = 0
+
+    def on_flood_wait(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.rate = max(self.base_rate / 16, self.rate * BACKOFF_FACTOR)
+        self.successes = 0
+
+
+class RequestScheduler:
+    """Rate limits, prioritizes and retries Telegram API calls.
+
+    Each request class (``history``, ``replies``, ``reactions``, ``download``,
+    ``get_messages``, ``refresh``, ``session``) has its own token bucket. A
+    FloodWait blocks and slows down the bucket of the class that hit it, and
+    the call is retried once the wait is over instead of failing the session. Requests made while
+    ``request_priority`` is ``REALTIME`` are served before backfill requests.
+    """
+
+    def __init__(self, rates=None):
+        self.rates = {**DEFAULT_RATES, **(rates or {})}
+        self.buckets = {}
+        self.flood_waits = 0
+        self.flood_wait_seconds = 0
+
+    @classmethod
+    def from_config(cls, config):
+        rates = {
+            name: tuple(rate) for name, rate in config.get("request_rates", {}).items()
+        }
+        return cls(rates)
+
+    def bucket(self, request_class):
+        if request_class not in self.buckets:
+            rate, burst = self.rates.get(request_class, FALLBACK_RATE)
+            self.buckets[request_class] = TokenBucket(rate, burst)
+        return self.buckets[request_class]
+
+    def queue_depth(self):
+        """Number of requests waiting for a token, per request class"""
+        return {name: bucket.queue_depth() for name, bucket in self.buckets.items()}
+
+    async def acquire(self, request_class):
+        start = time.perf_counter()
+        await self.bucket(request_class).acquire(request_priority.get())
+        metrics.histogram(
+            "telegram_request_wait_seconds",
+            "Time spent waiting for a rate limit token",
+            request_class=request_class,
+        ).observe(time.perf_counter() - start)
+
+    def _observe(self, request_class, seconds):
+        metrics.histogram(
+            "telegram_request_seconds",
+            "Duration of Telegram API calls (history and replies: per page)",
+            request_class=request_class,
+        ).observe(seconds)
+
+    def _on_flood_wait(self, request_class, error):
+        bucket = self.bucket(request_class)
+        bucket.on_flood_wait(error.seconds)
+        self.flood_waits += 1
+        self.flood_wait_seconds += error.seconds
+        metrics.counter(
+            "flood_wait_seconds_total",
+            "Seconds Telegram asked to wait",
+            request_class=request_class,
+        ).inc(error.seconds)
+        print(
+            f"FloodWait of {error.seconds}s on {request_class} requests; "
+            f"slowing down to {bucket.rate:.2f} req/s and retrying"
+        )
+
+    async def call(self, request_class, func, *args, **kwargs):
+        """Await ``func(*args, **kwargs)`` once a token is available.
+
+        The call is repeated after a FloodWait.
+        """
+        while True:
+            await self.acquire(request_class)
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWaitError as e:
+                self._on_flood_wait(request_class, e)
+                continue
+            finally:
+                self._observe(request_class, time.perf_counter() - start)
+            self.bucket(request_class).on_success()
+            return result
+
+    async def iter_messages(self, client, entity, request_class="history", **kwargs):
+        """``client.iter_messages`` drawing one token per page.
+
+        After a FloodWait the iteration resumes after the last yielded message.
+        """
+        while True:
+            await self.acquire(request_class)
+            yielded = 0
+            fetching = 0.0  # time spent in the iterator for the current page
+            start = time.perf_counter()
+            try:
+                async for msg in client.iter_messages(entity, **kwargs):
+                    fetching += time.perf_counter() - start
+                    kwargs["offset_id"] = msg.id
+                    yield msg
+                    yielded += 1
+                    if yielded % PAGE_SIZE == 0:
+                        self._observe(request_class, fetching)
+                        fetching = 0.0
+                        self.bucket(request_class).on_success()
+                        await self.acquire(request_class)
+                    start = time.perf_counter()
+            except FloodWaitError as e:
+                self._on_flood_wait(request_class, e)
+                continue
+            self._observe(request_class, fetching + time.perf_counter() - start)
+            self.bucket(request_class).on_success()
+            return
@@ -0,0 +1,127 @@
+"""Chunked media downloads that resume from an on-disk checkpoint"""
+
+import json
+import os
+
+# Telegram serves files in requests of at most this many bytes; offsets that
+# are a multiple of it are always valid download offsets
+REQUEST_SIZE = 512 * 1024
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+DEFAULT_MIN_BYTES = 10 * 1024 * 1024
+
+# Partial files and their checkpoints, inside the media folder
+PARTIAL_FOLDER = ".partial"
+
+
+def chunk_bytes(config):
+    """Configured chunk size, rounded down to a whole number of requests"""
+    size = config.get("download_chunk_bytes", DEFAULT_CHUNK_BYTES)
+    return max(REQUEST_SIZE, size // REQUEST_SIZE * REQUEST_SIZE)
+
+
+def should_resume(msg, config):
+    """Whether the media of ``msg`` is large enough to be downloaded in chunks"""
+    min_bytes = config.get("resumable_download_min_bytes", DEFAULT_MIN_BYTES)
+    return (
+        msg.document is not None
+        and min_bytes is not None
+        and (msg.file.size or 0) >= min_bytes
+    )
+
+
+def proper_filename(msg, folder):
+    """Name the file like Telethon would, without overwriting an existing file"""
+    name = msg.file.name
+    if not name:
+        if msg.video:
+            kind = "video"
+        elif msg.voice:
+            kind = "voice"
+        elif msg.audio:
+            kind = "audio"
+        else:
+            kind = "document"
+        name = f"{kind}_{msg.date:%Y-%m-%d_%H-%M-%S}{msg.file.ext or ''}"
+
+    stem, ext = os.path.splitext(name)
+    path = os.path.join(folder, name)
+    counter = 1
+    while os.path.exists(path):
+        path = os.path.join(folder, f"{stem} ({counter}){ext}")
+        counter += 1
+    return path
+
+
+def _load_checkpoint(checkpoint_path, msg):
+    """Return the saved offset, or 0 if there is no checkpoint for this file"""
+    if not os.path.exists(checkpoint_path):
+        return 0
+    try:
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    if checkpoint.get("document_id") != msg.document.id:
+        return 0
+    if checkpoint.get("size") != msg.file.size:
+        return 0
+    return checkpoint.get("offset", 0)
+
+
+def _save_checkpoint(checkpoint_path, msg, offset):
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"document_id": msg.document.id, "size": msg.file.size, "offset": offset}, f
+        )
+    os.replace(tmp_path, checkpoint_path)
+
+
+async def download_resumable(client, msg, folder, chunk_size):
+    """Download the document of ``msg`` into ``folder`` and return its path.
+
+    Bytes go to ``.partial/<chat_id>_<msg_id>.part`` and the offset of the
+    last chunk written (and fsynced) is checkpointed next to it, so a download
+    interrupted by a dropped connection, a FloodWait or a restart continues
+    from that chunk. The file is moved into ``folder`` once complete; a
+    download that ends short of the file size raises ConnectionError and keeps
+    its partial file and checkpoint for the next attempt.
+    """
+    partial_folder = os.path.join(folder, PARTIAL_FOLDER)
+    os.makedirs(partial_folder, exist_ok=True)
+    part_path = os.path.join(partial_folder, f"{msg.chat_id}_{msg.id}.part")
+    checkpoint_path = f"{part_path}.json"
+
+    offset = _load_checkpoint(checkpoint_path, msg)
+    # The part file may hold less than checkpointed (lost after a crash, or
+    # deleted); truncating past its end would pad it with zeros. Resume from a
+    # request boundary within the bytes actually on disk.
+    part_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    offset = min(offset, part_size) // REQUEST_SIZE * REQUEST_SIZE
+    if offset:
+        print(f"Resuming download of message {msg.id} at {offset}/{msg.file.size} bytes")
+
+    with open(part_path, "ab") as f:
+        # Anything after the checkpoint may not have been written completely
+        f.truncate(offset)
+        async for chunk in client.iter_download(
+            msg.media,
+            offset=offset,
+            chunk_size=chunk_size,
+            request_size=REQUEST_SIZE,
+            file_size=msg.file.size,
+        ):
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+            offset += len(chunk)
+            _save_checkpoint(checkpoint_path, msg, offset)
+
+    if offset != msg.file.size:
+        raise ConnectionError(
+            f"Download of message {msg.id} ended at {offset}/{msg.file.size} bytes"
+        )
+    path = proper_filename(msg, folder)
+    os.replace(part_path, path)
+    os.remove(checkpoint_path)
+    return path
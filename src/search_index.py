@@ -0,0 +1,185 @@
+"""Incrementally maintained full-text index over messages and comments"""
+
+import os
+import re
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    rowid INTEGER PRIMARY KEY,
+    root_id INTEGER NOT NULL,
+    is_comment INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_message
+    ON entries (root_id, is_comment, message_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5 (
+    text,
+    content = 'entries',
+    content_rowid = 'rowid',
+    prefix = '2 3',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts (rowid, text) VALUES (new.rowid, new.text);
+END;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts (entries_fts, rowid, text)
+    VALUES ('delete', old.rowid, old.text);
+END;
+"""
+
+TRANSLATED = "message_translated"
+
+
+def search_index_path(output_json_path):
+    return f"{output_json_path}.search.db"
+
+
+class SearchIndex:
+    """SQLite FTS5 index of the searchable text fields of every record.
+
+    Indexed are ``message`` and its ``messageV{n}`` edits, the configured
+    ``transliterate_key`` field and its versions, and ``message_translated``.
+    Comments are indexed under their root message, so a hit can be shown in
+    its thread. Records are re-indexed only when one of these fields changed.
+    """
+
+    def __init__(self, db_path, transliterate_key=None):
+        self.db_path = db_path
+        self.transliterate_key = transliterate_key or None
+        prefixes = ["message"]
+        if self.transliterate_key:
+            prefixes.append(re.escape(self.transliterate_key))
+        self._field_pattern = re.compile(rf"^(?:{'|'.join(prefixes)})(?:V\d+)?$")
+        self.conn = None
+
+    @classmethod
+    def from_config(cls, config, base_dir):
+        return cls(
+            search_index_path(os.path.join(base_dir, config["output_json"])),
+            config.get("transliterate_key"),
+        )
+
+    def open(self, store=None):
+        """Open the index, building it from ``store`` if it was never completed"""
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        built = self.conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone()
+        if built is None and store is not None:
+            self.rebuild(store)
+        return self
+
+    def _fields(self, record):
+        """(field, text) pairs of a record to index"""
+        return sorted(
+            (field, value)
+            for field, value in record.items()
+            if isinstance(value, str)
+            and value
+            and (field == TRANSLATED or self._field_pattern.match(field))
+        )
+
+    def _index(self, root_id, record, is_comment):
+        key = (root_id, int(is_comment), record["id"])
+        fields = self._fields(record)
+        indexed = self.conn.execute(
+            "SELECT field, text FROM entries "
+            "WHERE root_id = ? AND is_comment = ? AND message_id = ? "
+            "ORDER BY field, text",
+            key,
+        ).fetchall()
+        if indexed == fields:
+            return
+        self.conn.execute(
+            "DELETE FROM entries WHERE root_id = ? AND is_comment = ? AND message_id = ?",
+            key,
+        )
+        self.conn.executemany(
+            "INSERT INTO entries (root_id, is_comment, message_id, field, text) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(*key, field, text) for field, text in fields],
+        )
+
+    def update(self, record, comments=None):
+        """Index a root record and the given comments (all when omitted)"""
+        root_id = record["id"]
+        self._index(root_id, record, is_comment=False)
+        if comments is None:
+            comments = record.get("comments", [])
+        for comment in comments:
+            self._index(root_id, comment, is_comment=True)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rebuild(self, store):
+        """Index every record of a store from scratch"""
+        print(f"Building search index {self.db_path}...")
+        # Recreating the tables is much faster than deleting every entry. The
+        # "built" marker is only written once every record is indexed, so an
+        # interrupted build is redone on the next open.
+        self.conn.executescript(
+            "DELETE FROM meta WHERE key = 'built'; "
+            "DROP TABLE entries; DROP TABLE entries_fts;"
+        )
+        self.conn.executescript(SCHEMA)
+        count = 0
+        for record in store.iter_messages():
+            root_id = record["id"]
+            rows = [
+                (root_id, int(target is not record), target["id"], field, text)
+                for target in [record, *record.get("comments", [])]
+                for field, text in self._fields(target)
+            ]
+            self.conn.executemany(
+                "INSERT INTO entries (root_id, is_comment, message_id, field, text) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            count += len(rows)
+        self.conn.execute("INSERT INTO entries_fts (entries_fts) VALUES ('optimize')")
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', '1')")
+        self.commit()
+        print(f"Indexed {count} text fields")
+
+    def search(self, query, limit=20):
+        """Best matches for an FTS5 query, as dicts with a highlighted snippet.
+
+        Queries that are not valid FTS5 syntax are searched as plain words.
+        """
+        sql = (
+            "SELECT e.root_id, e.is_comment, e.message_id, e.field, "
+            "snippet(entries_fts, 0, '[', ']', '...', 16) "
+            "FROM entries_fts JOIN entries e ON e.rowid = entries_fts.rowid "
+            "WHERE entries_fts MATCH ? ORDER BY rank LIMIT ?"
+        )
+        try:
+            rows = self.conn.execute(sql, (query, limit)).fetchall()
+        except sqlite3.OperationalError:
+            words = " ".join('"' + w.replace('"', '""') + '"' for w in query.split())
+            rows = self.conn.execute(sql, (words, limit)).fetchall()
+        return [
+            {
+                "root_id": root_id,
+                "id": message_id,
+                "is_comment": bool(is_comment),
+                "field": field,
+                "snippet": snippet,
+            }
+            for root_id, is_comment, message_id, field, snippet in rows
+        ]
+
+    def close(self):
+        if self.conn:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,290 @@
+"""Time-sharded JSON storage backend with a manifest"""
+
+import json
+import os
+import shutil
+import threading
+from datetime import datetime
+
+from .storage import (
+    DEFAULT_COMPACT_BYTES,
+    JournaledJsonStore,
+    apply_journal_entry,
+    iter_journal,
+)
+from .utils import dump_record, save_messages
+
+MANIFEST_NAME = "manifest.json"
+UNDATED = "undated"
+PERIOD_FORMATS = {"month": "%Y-%m", "year": "%Y"}
+# A shard that only exists as a journal so far still counts as a shard
+SHARD_SUFFIXES = (".json", ".json.journal", ".json.journal.compacting")
+
+
+def read_manifest(shard_dir):
+    """Return the manifest of a sharded archive, or None if there is none"""
+    path = os.path.join(shard_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_shards(shard_dir, names=None, first_id=None, last_id=None):
+    """Load the root records of selected shards, in storage order.
+
+    Shards are selected by name (e.g. ``"2024-03"``) and/or by overlap with
+    the ``first_id``..``last_id`` range using only the manifest, so shards
+    that are not needed are never opened. Changes still in a shard's journal
+    are applied, without modifying any file. Intended for readers such as the
+    translation scripts.
+    """
+    manifest = read_manifest(shard_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_NAME} in {shard_dir}")
+    records = []
+    for shard in manifest["shards"]:
+        if names is not None and shard["name"] not in names:
+            continue
+        if first_id is not None and shard["last_id"] < first_id:
+            continue
+        if last_id is not None and shard["first_id"] > last_id:
+            continue
+        records.extend(_read_shard(os.path.join(shard_dir, shard["file"])))
+    return records
+
+
+def _read_shard(path):
+    """Root records of one shard with its journal applied, read-only"""
+    shard = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            shard = {record["id"]: record for record in json.load(f)}
+    # A compaction in progress has moved the older entries aside
+    for journal_path in (f"{path}.journal.compacting", f"{path}.journal"):
+        for entry in iter_journal(journal_path, repair=False):
+            apply_journal_entry(shard, entry, lambda message_id: None)
+    return list(shard.values())
+
+
+class ShardedJsonStore:
+    """Root messages split into one journaled JSON file per month (or year).
+
+    A record goes to the shard of its ``date``, and stays there. Each shard is
+    a ``JournaledJsonStore`` with its own journal, so an update only appends
+    to, and on compaction only rewrites, the shard it touches. ``manifest.json``
+    lists every shard with its file, message count and ID range; it is
+    rewritten on commit whenever one of them changed.
+    """
+
+    def __init__(
+        self,
+        shard_dir,
+        output_json_path,
+        date_format,
+        period="month",
+        compact_bytes=DEFAULT_COMPACT_BYTES,
+    ):
+        if period not in PERIOD_FORMATS:
+            raise ValueError(f"Unknown shard_period: {period}")
+        self.shard_dir = shard_dir
+        self.output_json_path = output_json_path
+        self.date_format = date_format
+        self.period = period
+        self.compact_bytes = compact_bytes
+        self.manifest_path = os.path.join(shard_dir, MANIFEST_NAME)
+        self.shards = {}  # shard name -> JournaledJsonStore
+        self.shard_of = {}  # root ID -> shard name
+        self.id_ranges = {}  # shard name -> [first ID, last ID]
+        self._last_id = None  # highest root ID stored
+        self._dirty = set()  # shards changed since the last commit
+        self._manifest_stale = False  # a shard gained messages
+        # Guards the shard index against readers on other threads (the API)
+        self._lock = threading.RLock()
+
+    def _shard_name(self, record):
+        try:
+            date = datetime.strptime(record["date"], self.date_format)
+        except (KeyError, TypeError, ValueError):
+            return UNDATED
+        return date.strftime(PERIOD_FORMATS[self.period])
+
+    def _open_shard(self, name):
+        shard = JournaledJsonStore(
+            os.path.join(self.shard_dir, f"{name}.json"), self.compact_bytes
+        )
+        self.shards[name] = shard.load()
+        return shard
+
+    def load(self):
+        """Open every shard, splitting an existing single-file archive first"""
+        if not os.path.isdir(self.shard_dir):
+            if os.path.exists(self.output_json_path):
+                # Split next to the shard directory and move it into place
+                # when complete, so an interrupted split is started over
+                split_dir = f"{self.shard_dir}.tmp"
+                shutil.rmtree(split_dir, ignore_errors=True)
+                os.makedirs(split_dir)
+                self._split(self.output_json_path, split_dir)
+                os.replace(split_dir, self.shard_dir)
+            else:
+                os.makedirs(self.shard_dir)
+
+        names = set()
+        for file_name in os.listdir(self.shard_dir):
+            for suffix in SHARD_SUFFIXES:
+                if file_name.endswith(suffix) and file_name != MANIFEST_NAME:
+                    names.add(file_name[: -len(suffix)])
+        for name in sorted(names):
+            self._open_shard(name)
+        self.rebuild_index()
+        self._write_manifest()
+        return self
+
+    def _split(self, archive_path, split_dir):
+        """Write the records of a single-file archive into shards in ``split_dir``"""
+        print(f"Splitting {archive_path} into {self.period} shards...")
+        source = JournaledJsonStore(archive_path).load()
+        files = {}
+        try:
+            for record in source.iter_messages():
+                name = self._shard_name(record)
+                f = files.get(name)
+                if f is None:
+                    path = os.path.join(split_dir, f"{name}.json.tmp")
+                    f = files[name] = open(path, "w", encoding="utf-8")
+                    f.write("[\n  ")
+                else:
+                    f.write(",\n  ")
+                f.write(dump_record(record))
+        finally:
+            for f in files.values():
+                f.write("\n]")
+                f.close()
+        for name in files:
+            path = os.path.join(split_dir, f"{name}.json")
+            os.replace(f"{path}.tmp", path)
+        print(f"Wrote {len(files)} shards to {self.shard_dir}")
+
+    def rebuild_index(self):
+        self.shard_of = {}
+        self.id_ranges = {}
+        for name in sorted(self.shards):
+            for message_id in self.shards[name].ids:
+                self.shard_of[message_id] = name
+                self._extend_range(name, message_id)
+        self._last_id = max(
+            (last_id for _, last_id in self.id_ranges.values()), default=None
+        )
+
+    def _extend_range(self, name, message_id):
+        id_range = self.id_ranges.get(name)
+        if id_range is None:
+            self.id_ranges[name] = [message_id, message_id]
+        else:
+            id_range[0] = min(id_range[0], message_id)
+            id_range[1] = max(id_range[1], message_id)
+
+    def _write_manifest(self):
+        shards = []
+        for name in sorted(self.id_ranges):
+            first_id, last_id = self.id_ranges[name]
+            shards.append(
+                {
+                    "name": name,
+                    "file": f"{name}.json",
+                    "count": self.shards[name].count(),
+                    "first_id": first_id,
+                    "last_id": last_id,
+                }
+            )
+        manifest = {
+            "period": self.period,
+            "count": sum(shard["count"] for shard in shards),
+            "shards": shards,
+        }
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        self._manifest_stale = False
+
+    def _shard_of(self, message_id):
+        with self._lock:
+            name = self.shard_of.get(message_id)
+            return self.shards[name] if name else None
+
+    def get(self, message_id, with_comments=True):
+        shard = self._shard_of(message_id)
+        return shard.get(message_id, with_comments) if shard else None
+
+    def comment_count(self, message_id):
+        shard = self._shard_of(message_id)
+        return shard.comment_count(message_id) if shard else 0
+
+    def contains(self, message_id):
+        with self._lock:
+            return message_id in self.shard_of
+
+    def last(self, with_comments=True):
+        """Return the root record with the highest ID, or None"""
+        if self._last_id is None:
+            return None
+        return self.get(self._last_id, with_comments)
+
+    def count(self):
+        with self._lock:
+            return len(self.shard_of)
+
+    def message_ids(self):
+        """Root IDs, shard by shard"""
+        with self._lock:
+            return list(self.shard_of)
+
+    def iter_messages(self):
+        """Iterate over root records, shard by shard"""
+        for name in sorted(self.shards):
+            yield from self.shards[name].iter_messages()
+
+    def iter_albums(self):
+        for name in sorted(self.shards):
+            yield from self.shards[name].iter_albums()
+
+    def upsert_message(self, record, comments=None):
+        """Record a new or changed root message in its shard"""
+        message_id = record["id"]
+        with self._lock:
+            name = self.shard_of.get(message_id)
+            if name is None:
+                name = self._shard_name(record)
+                if name not in self.shards:
+                    self._open_shard(name)
+                self.shard_of[message_id] = name
+                self._extend_range(name, message_id)
+                self._manifest_stale = True
+                if self._last_id is None or message_id > self._last_id:
+                    self._last_id = message_id
+        self.shards[name].upsert_message(record, comments=comments)
+        self._dirty.add(name)
+
+    def commit(self):
+        """Commit the shards changed since the last commit"""
+        for name in self._dirty:
+            self.shards[name].commit()
+        self._dirty.clear()
+        if self._manifest_stale:
+            self._write_manifest()
+
+    def compact(self, wait=False):
+        for shard in self.shards.values():
+            shard.compact(wait)
+
+    def export_json(self, output_path=None):
+        """Write every shard, in order, to a single messages.json file"""
+        self.compact(wait=True)
+        save_messages(self.iter_messages(), output_path or self.output_json_path)
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self._write_manifest()
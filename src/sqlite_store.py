@@ -0,0 +1,297 @@
+"""SQLite storage backend for the telegram scraper"""
+
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from .storage import JournaledJsonStore, album_of
+from .utils import save_messages
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    date TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS comments (
+    root_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    sender_id INTEGER,
+    data TEXT NOT NULL,
+    PRIMARY KEY (root_id, id)
+);
+CREATE INDEX IF NOT EXISTS comments_by_position ON comments (root_id, position);
+CREATE INDEX IF NOT EXISTS comments_by_sender ON comments (sender_id);
+CREATE TABLE IF NOT EXISTS reactions (
+    root_id INTEGER NOT NULL,
+    comment_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    reaction TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    is_from_creator INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (root_id, comment_id, position)
+);
+CREATE INDEX IF NOT EXISTS reactions_by_reaction ON reactions (reaction);
+CREATE TABLE IF NOT EXISTS media (
+    root_id INTEGER NOT NULL,
+    comment_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (root_id, comment_id, position)
+);
+CREATE INDEX IF NOT EXISTS media_by_path ON media (path);
+CREATE TABLE IF NOT EXISTS albums (
+    root_id INTEGER PRIMARY KEY,
+    grouped_id INTEGER NOT NULL,
+    album_ids TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# comment_id used in the reactions and media tables for the root message itself
+ROOT = 0
+
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+class SqliteStore:
+    """Indexed SQLite storage for root messages and their comments.
+
+    Every record is kept as JSON in ``data`` so it round-trips losslessly to the
+    messages.json schema; reactions and media paths are additionally kept in
+    their own indexed tables. Nothing is held in memory between calls, so start
+    time and RSS do not depend on the archive size.
+    """
+
+    def __init__(self, db_path, output_json_path):
+        self.db_path = db_path
+        self.output_json_path = output_json_path
+        self.conn = None
+        self._owner = None  # thread that writes through ``conn``
+        self._readers = threading.local()
+
+    def load(self):
+        """Open the database, importing the JSON archive on first use"""
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._owner = threading.get_ident()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        imported = self.conn.execute(
+            "SELECT 1 FROM meta WHERE key = 'import_complete'"
+        ).fetchone()
+        if imported is None:
+            # The import is committed in one transaction with its marker, so
+            # an interrupted import left no messages and is started over.
+            # Databases created before the marker existed are kept as they are.
+            if self.count() == 0 and os.path.exists(self.output_json_path):
+                print(f"Importing {self.output_json_path} into {self.db_path}...")
+                json_store = JournaledJsonStore(self.output_json_path)
+                json_store.load()
+                for record in json_store.iter_messages():
+                    self.upsert_message(record)
+                print(f"Imported {self.count()} messages")
+            self.conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('import_complete', '1')"
+            )
+            self.commit()
+        return self
+
+    def _reader(self):
+        """Connection to read through on the current thread.
+
+        Other threads (the read API) get their own read-only connection, so
+        they see committed data only and never share a cursor or transaction
+        with the writer.
+        """
+        if threading.get_ident() == self._owner:
+            return self.conn
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            uri = Path(os.path.abspath(self.db_path)).as_uri() + "?mode=ro"
+            conn = self._readers.conn = sqlite3.connect(uri, uri=True)
+        return conn
+
+    def comment_count(self, message_id):
+        return (
+            self._reader()
+            .execute("SELECT COUNT(*) FROM comments WHERE root_id = ?", (message_id,))
+            .fetchone()[0]
+        )
+
+    def _fetch_comments(self, root_id):
+        rows = self._reader().execute(
+            "SELECT data FROM comments WHERE root_id = ? ORDER BY position",
+            (root_id,),
+        )
+        return [json.loads(data) for (data,) in rows]
+
+    def _assemble(self, row, with_comments):
+        if row is None:
+            return None
+        record = json.loads(row[1])
+        if with_comments:
+            comments = self._fetch_comments(row[0])
+            if comments:
+                record["comments"] = comments
+        return record
+
+    def get(self, message_id, with_comments=True):
+        """Return a copy of the root record with this ID, or None"""
+        row = self._reader().execute(
+            "SELECT id, data FROM messages WHERE id = ?", (message_id,)
+        ).fetchone()
+        return self._assemble(row, with_comments)
+
+    def contains(self, message_id):
+        return (
+            self._reader().execute(
+                "SELECT 1 FROM messages WHERE id = ?", (message_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def last(self, with_comments=True):
+        """Return the root record with the highest ID, or None"""
+        row = self._reader().execute(
+            "SELECT id, data FROM messages ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        return self._assemble(row, with_comments)
+
+    def count(self):
+        return self._reader().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def message_ids(self):
+        """Root IDs in ID order"""
+        cursor = self._reader().execute("SELECT id FROM messages ORDER BY id")
+        return [row[0] for row in cursor]
+
+    def iter_messages(self):
+        """Iterate over root records (with comments) in ID order"""
+        cursor = self._reader().cursor()
+        for row in cursor.execute("SELECT id, data FROM messages ORDER BY id"):
+            yield self._assemble(row, with_comments=True)
+
+    def iter_albums(self):
+        """Yield ``(id, grouped_id, album_ids, media_count)`` for album root records.
+
+        Records stored before albums were tracked carry no ``grouped_id``;
+        they are reported, with None for both album fields, when they hold
+        several media.
+        """
+        media_count = (
+            "SELECT COUNT(*) FROM media WHERE media.root_id = albums.root_id "
+            "AND comment_id = ?"
+        )
+        rows = self._reader().execute(
+            f"SELECT root_id, grouped_id, album_ids, ({media_count}) FROM albums",
+            (ROOT,),
+        ).fetchall()
+        for root_id, grouped_id, album_ids, count in rows:
+            yield root_id, grouped_id, json.loads(album_ids), count
+        for root_id, count in self._reader().execute(
+            "SELECT root_id, COUNT(*) FROM media WHERE comment_id = ? "
+            "AND root_id NOT IN (SELECT root_id FROM albums) "
+            "GROUP BY root_id HAVING COUNT(*) > 1",
+            (ROOT,),
+        ).fetchall():
+            yield root_id, None, None, count
+
+    def _replace_children(self, root_id, comment_id, record):
+        """Rewrite the reaction and media rows of one message or comment"""
+        self.conn.execute(
+            "DELETE FROM reactions WHERE root_id = ? AND comment_id = ?",
+            (root_id, comment_id),
+        )
+        self.conn.executemany(
+            "INSERT INTO reactions VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    root_id,
+                    comment_id,
+                    position,
+                    r["reaction"],
+                    r["count"],
+                    int(r.get("is_from_creator", False)),
+                )
+                for position, r in enumerate(record.get("reactions", []))
+            ],
+        )
+        self.conn.execute(
+            "DELETE FROM media WHERE root_id = ? AND comment_id = ?",
+            (root_id, comment_id),
+        )
+        self.conn.executemany(
+            "INSERT INTO media VALUES (?, ?, ?, ?)",
+            [
+                (root_id, comment_id, position, path)
+                for position, path in enumerate(record.get("media", []))
+            ],
+        )
+
+    def upsert_message(self, record, comments=None):
+        """Insert or update a root message and the given comments.
+
+        Every root field of ``record`` is written, but only the comments passed
+        in ``comments``; when omitted, every comment of ``record`` is written.
+        """
+        root_id = record["id"]
+        root_fields = {k: v for k, v in record.items() if k != "comments"}
+        self.conn.execute(
+            "INSERT INTO messages (id, date, data) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET date = excluded.date, data = excluded.data",
+            (root_id, record.get("date"), _dumps(root_fields)),
+        )
+        self._replace_children(root_id, ROOT, record)
+        album = album_of(record)
+        if album is not None:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO albums VALUES (?, ?, ?)",
+                (root_id, album[0], json.dumps(album[1])),
+            )
+
+        if comments is None:
+            comments = record.get("comments", [])
+        for comment in comments:
+            self.conn.execute(
+                "INSERT INTO comments (root_id, id, position, sender_id, data) "
+                "VALUES (?, ?, (SELECT COALESCE(MAX(position) + 1, 0) "
+                "FROM comments WHERE root_id = ?), ?, ?) "
+                "ON CONFLICT (root_id, id) DO UPDATE SET "
+                "sender_id = excluded.sender_id, data = excluded.data",
+                (
+                    root_id,
+                    comment["id"],
+                    root_id,
+                    comment.get("sender_id"),
+                    _dumps(comment),
+                ),
+            )
+            self._replace_children(root_id, comment["id"], comment)
+
+    def rebuild_index(self):
+        """Indexes are maintained by SQLite; kept for interface parity"""
+
+    def commit(self):
+        """Commit the current transaction"""
+        self.conn.commit()
+
+    def export_json(self, output_path=None):
+        """Write the whole archive in the messages.json format"""
+        self.commit()
+        save_messages(self.iter_messages(), output_path or self.output_json_path)
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,527 @@
+"""Message storage backends for the telegram scraper"""
+
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+
+from .records import MessageRecord, merge_comments
+from .utils import dump_record, load_messages, save_messages
+
+# Rotate and merge the journal into the snapshot once it grows past this size
+DEFAULT_COMPACT_BYTES = 32 * 1024 * 1024
+
+
+# Layout written by save_messages: top-level records are indented by two
+# spaces and everything nested in them by more, so "\n  }" only ever closes a
+# top-level record
+RECORD_END = b"\n  }"
+RECORD_ID = re.compile(rb'\{\s*"id":\s*(-?\d+)')
+MEDIA_START = b'\n    "media": ['
+MEDIA_END = b"\n    ]"
+MEDIA_ITEM = b'\n      "'
+GROUPED_ID = re.compile(rb'\n    "grouped_id": (-?\d+)')
+ALBUM_IDS_START = b'\n    "album_ids": ['
+COMMENTS_START = b'\n    "comments": ['
+COMMENTS_END = b"\n    ]"
+COMMENT_ITEM = b'\n      {'
+
+# Records read from the snapshot per lock acquisition when iterating
+READ_BATCH = 1000
+
+
+def album_of(record):
+    """``(grouped_id, album_ids)`` of an album's root record, or None"""
+    if record.get("grouped_id") is None:
+        return None
+    return record["grouped_id"], record.get("album_ids") or [record["id"]]
+
+
+def scan_snapshot(path):
+    """Yield ``(id, start, end, media_count, album)`` for every record of a snapshot.
+
+    Only record boundaries, IDs, top-level media counts and album fields (see
+    ``album_of``) are located, so no record is parsed into Python objects.
+    Raises ValueError when the file does not have the layout written by
+    ``save_messages``.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        position = mm.find(b"[")
+        if position < 0:
+            raise ValueError(f"{path} is not a JSON array")
+        position += 1
+        while True:
+            start = mm.find(b"{", position)
+            if start < 0:
+                return
+            end = mm.find(RECORD_END, start)
+            match = RECORD_ID.match(mm, start)
+            if end < 0 or match is None:
+                raise ValueError(f"Unexpected layout at byte {start} of {path}")
+            end += len(RECORD_END)
+
+            media_count = 0
+            media_at = mm.find(MEDIA_START, start, end)
+            if media_at >= 0 and mm[media_at + len(MEDIA_START)] != ord("]"):
+                media_end = mm.find(MEDIA_END, media_at, end)
+                media_count = mm[media_at:media_end].count(MEDIA_ITEM)
+
+            album = None
+            grouped = GROUPED_ID.search(mm, start, end)
+            if grouped is not None:
+                album_ids = [int(match.group(1))]
+                ids_at = mm.find(ALBUM_IDS_START, start, end)
+                if ids_at >= 0:
+                    ids_start = ids_at + len(ALBUM_IDS_START) - 1  # the "["
+                    ids_end = mm.find(b"]", ids_start, end) + 1
+                    album_ids = json.loads(mm[ids_start:ids_end])
+                album = int(grouped.group(1)), album_ids
+
+            yield int(match.group(1)), start, end, media_count, album
+            position = end
+
+
+def apply_journal_entry(records, entry, load_base):
+    """Apply a single journal entry to ``records`` (root ID -> root record).
+
+    ``message`` entries replace every root field except ``comments``.
+    ``comment`` entries insert or replace one comment of a root record.
+    Records missing from ``records`` are fetched with ``load_base(id)``.
+    Returns the ID of the root record the entry applied to, or None.
+    """
+    if entry["op"] == "message":
+        record = dict(entry["record"])
+        existing = records.get(record["id"]) or load_base(record["id"])
+        if existing and "comments" in existing:
+            record["comments"] = existing["comments"]
+        records[record["id"]] = record
+        return record["id"]
+
+    if entry["op"] == "comment":
+        existing = records.get(entry["root"]) or load_base(entry["root"])
+        if existing is None:
+            return None
+        comments = existing.setdefault("comments", [])
+        comment = entry["record"]
+        for i, stored in enumerate(comments):
+            if stored["id"] == comment["id"]:
+                comments[i] = comment
+                break
+        else:
+            comments.append(comment)
+        records[entry["root"]] = existing
+        return entry["root"]
+
+    return None
+
+
+def iter_journal(journal_path, repair=True):
+    """Yield every complete entry of a journal file.
+
+    A torn trailing line left by a crash is cut off so that later appends
+    start on a clean line; readers that do not own the journal pass
+    ``repair=False`` and only skip it.
+    """
+    if not os.path.exists(journal_path):
+        return
+    valid_bytes = 0
+    with open(journal_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            yield json.loads(line)
+            valid_bytes += len(line)
+    if repair and valid_bytes < os.path.getsize(journal_path):
+        print(f"Discarding torn entry at the end of {journal_path}")
+        with open(journal_path, "r+b") as f:
+            f.truncate(valid_bytes)
+
+
+class JournaledJsonStore:
+    """Snapshot + append-only journal storage for root messages.
+
+    The snapshot is the viewer-compatible ``messages.json`` array. It is never
+    loaded as a whole: a streaming scan at startup only records where each
+    record lives, and records are parsed when they are asked for. Changes are
+    kept in memory and appended to ``<snapshot>.journal`` as one JSON line
+    each; once the journal passes ``compact_bytes`` it is merged into the
+    snapshot on a background thread.
+    """
+
+    def __init__(self, snapshot_path, compact_bytes=DEFAULT_COMPACT_BYTES):
+        self.snapshot_path = snapshot_path
+        self.journal_path = f"{snapshot_path}.journal"
+        self.compacting_path = f"{snapshot_path}.journal.compacting"
+        self.compact_bytes = compact_bytes
+        self.ids = []  # root IDs in storage order
+        self.offsets = {}  # root ID -> (start, end) of its bytes in the snapshot
+        self.changed = {}  # root ID -> MessageRecord changed since the snapshot
+        # Root ID -> (grouped_id, album_ids, media_count) of album root records;
+        # records stored before albums were tracked have (None, None, count)
+        self.albums = {}
+        self._touched = set()  # root IDs changed since the journal was rotated
+        self._pending_lines = []
+        self._compactor = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Index the snapshot and replay any journal written since"""
+        self._scan()
+        if os.path.exists(self.compacting_path):
+            # A previous compaction did not finish; complete it before loading
+            print("Finishing interrupted journal compaction...")
+            self._merge_into_snapshot()
+
+        replayed = 0
+        records = {}
+        for entry in iter_journal(self.journal_path):
+            apply_journal_entry(records, entry, self._read)
+            replayed += 1
+        for record in records.values():
+            self._track(record)
+        if replayed:
+            print(f"Replayed {replayed} journal entries from {self.journal_path}")
+        return self
+
+    def _scan(self):
+        try:
+            records = list(scan_snapshot(self.snapshot_path))
+        except ValueError as e:
+            # Written by another tool; rewrite it once in the streaming layout
+            print(f"{e}. Rewriting {self.snapshot_path}...")
+            save_messages(load_messages(self.snapshot_path), self.snapshot_path)
+            records = list(scan_snapshot(self.snapshot_path))
+
+        self.ids = [message_id for message_id, _, _, _, _ in records]
+        self.offsets = {
+            message_id: (start, end) for message_id, start, end, _, _ in records
+        }
+        self.albums = {}
+        for message_id, _, _, media_count, album in records:
+            self._track_album(message_id, album, media_count)
+
+    def _read_bytes(self, message_id):
+        """The bytes of one record in the snapshot, or None"""
+        with self._lock:
+            if message_id not in self.offsets:
+                return None
+            start, end = self.offsets[message_id]
+            with open(self.snapshot_path, "rb") as f:
+                f.seek(start)
+                return f.read(end - start)
+
+    def _read(self, message_id, with_comments=True):
+        """Parse one record from the snapshot, or return None"""
+        data = self._read_bytes(message_id)
+        if data is None:
+            return None
+        if not with_comments:
+            at = data.find(COMMENTS_START)
+            if at >= 0:
+                # Drop the array with the comma before it; "id" always
+                # precedes it, so the object stays valid JSON
+                end = data.find(COMMENTS_END, at) + len(COMMENTS_END)
+                data = data[: at - 1] + data[end:]
+        return json.loads(data)
+
+    def _track(self, record):
+        """Keep a changed root record, in compact form, until it is compacted"""
+        self._remember(MessageRecord.from_dict(record))
+
+    def _patched(self, record, comments):
+        """Compact form of the stored record with new root fields and comments.
+
+        Only ``comments`` are converted; the other comments of a changed
+        record are reused as they are.
+        """
+        root_fields = {k: v for k, v in record.items() if k != "comments"}
+        compact = self.changed.get(record["id"])
+        if compact is not None:
+            held = compact.comments
+        else:
+            stored = self._read(record["id"]) or {}
+            held = merge_comments((), stored.get("comments", []))
+        return MessageRecord.from_dict(root_fields, merge_comments(held, comments))
+
+    def _remember(self, compact):
+        message_id = compact.id
+        if message_id not in self.offsets and message_id not in self.changed:
+            self.ids.append(message_id)
+        self.changed[message_id] = compact
+        self._touched.add(message_id)
+        extra = compact.extra or {}
+        self._track_album(
+            message_id, album_of({"id": message_id, **extra}), compact.media_count()
+        )
+
+    def _track_album(self, message_id, album, media_count):
+        if album is not None:
+            self.albums[message_id] = (*album, media_count)
+        elif media_count > 1:
+            self.albums[message_id] = (None, None, media_count)
+        else:
+            self.albums.pop(message_id, None)
+
+    def rebuild_index(self):
+        """Re-scan the snapshot (changes not yet compacted are kept)"""
+        with self._lock:
+            changed, self.changed = self.changed, {}
+            self._scan()
+            for compact in changed.values():
+                self._remember(compact)
+
+    def get(self, message_id, with_comments=True):
+        """Return a copy of the root record with this ID, or None.
+
+        Without ``with_comments`` the record is returned without its
+        comments, which are neither parsed nor converted back.
+        """
+        with self._lock:
+            compact = self.changed.get(message_id)
+            if compact is not None:
+                return compact.to_dict(with_comments)
+            return self._read(message_id, with_comments)
+
+    def comment_count(self, message_id):
+        """Number of comments of a root record, counted without loading them"""
+        with self._lock:
+            compact = self.changed.get(message_id)
+            if compact is not None:
+                return len(compact.comments or ())
+            data = self._read_bytes(message_id)
+        at = -1 if data is None else data.find(COMMENTS_START)
+        if at < 0:
+            return 0
+        return data.count(COMMENT_ITEM, at, data.find(COMMENTS_END, at))
+
+    def contains(self, message_id):
+        return message_id in self.changed or message_id in self.offsets
+
+    def last(self, with_comments=True):
+        """Return the most recently stored root record, or None"""
+        with self._lock:
+            last_id = self.ids[-1] if self.ids else None
+        return None if last_id is None else self.get(last_id, with_comments)
+
+    def count(self):
+        with self._lock:
+            return len(self.ids)
+
+    def message_ids(self):
+        """Root IDs in storage order"""
+        with self._lock:
+            return list(self.ids)
+
+    def iter_messages(self):
+        """Iterate over root records in storage order"""
+        ids = list(self.ids)
+        for i in range(0, len(ids), READ_BATCH):
+            yield from self._read_batch(ids[i : i + READ_BATCH])
+
+    def _read_batch(self, ids):
+        """Return the records for ``ids``, reading the snapshot only once"""
+        batch = []
+        snapshot = None
+        with self._lock:
+            try:
+                for message_id in ids:
+                    compact = self.changed.get(message_id)
+                    if compact is not None:
+                        record = compact.to_dict()
+                    else:
+                        if snapshot is None:
+                            snapshot = open(self.snapshot_path, "rb")
+                        start, end = self.offsets[message_id]
+                        snapshot.seek(start)
+                        record = json.loads(snapshot.read(end - start))
+                    batch.append(record)
+            finally:
+                if snapshot is not None:
+                    snapshot.close()
+        return batch
+
+    def iter_albums(self):
+        """Yield ``(id, grouped_id, album_ids, media_count)`` for album root records.
+
+        Records stored before albums were tracked carry no ``grouped_id``;
+        they are reported, with None for both album fields, when they hold
+        several media.
+        """
+        with self._lock:
+            albums = list(self.albums.items())
+        for message_id, (grouped_id, album_ids, media_count) in albums:
+            yield message_id, grouped_id, album_ids, media_count
+
+    def upsert_message(self, record, comments=None):
+        """Record a new or changed root message.
+
+        ``record`` is copied into a compact ``MessageRecord`` rather than
+        kept. Every root field is journaled, but only the comments passed in
+        ``comments``, which are added to or replace the stored ones; the
+        comments of ``record`` are then ignored, so it may come from
+        ``get(with_comments=False)``. When omitted, every comment of
+        ``record`` is journaled and ``record`` must be complete.
+        """
+        with self._lock:
+            if comments is None:
+                comments = record.get("comments", [])
+                self._track(record)
+            else:
+                self._remember(self._patched(record, comments))
+
+            root_fields = {k: v for k, v in record.items() if k != "comments"}
+            self._journal({"op": "message", "record": root_fields})
+            for comment in comments:
+                self._journal(
+                    {"op": "comment", "root": record["id"], "record": comment}
+                )
+
+    def _journal(self, entry):
+        self._pending_lines.append(
+            json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        )
+
+    def _flush_journal(self):
+        """Append pending entries to the journal file"""
+        if not self._pending_lines:
+            return False
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.writelines(self._pending_lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending_lines = []
+        return True
+
+    def commit(self):
+        """Persist pending changes, compacting once the journal is large enough"""
+        if self._flush_journal():
+            if os.path.getsize(self.journal_path) >= self.compact_bytes:
+                self.compact()
+
+    def compact(self, wait=False):
+        """Merge the journal into the snapshot, in the background unless ``wait``"""
+        self._flush_journal()
+        if self._compactor and self._compactor.is_alive():
+            if wait:
+                self._compactor.join()
+            else:
+                return
+        if not os.path.exists(self.journal_path):
+            return
+
+        # New entries go to a fresh journal while the rotated one is merged
+        with self._lock:
+            os.replace(self.journal_path, self.compacting_path)
+            self._touched = set()
+        self._compactor = threading.Thread(
+            target=self._merge_into_snapshot, name="journal-compactor", daemon=True
+        )
+        self._compactor.start()
+        if wait:
+            self._compactor.join()
+
+    def _merge_into_snapshot(self):
+        """Rewrite the snapshot with the rotated journal applied.
+
+        Unchanged records are copied byte for byte; only the records named in
+        the rotated journal are parsed and re-serialized.
+        """
+        with self._lock:
+            old_offsets = dict(self.offsets)
+        merged = {}
+        for entry in iter_journal(self.compacting_path):
+            apply_journal_entry(merged, entry, self._read)
+        order = list(old_offsets) + [i for i in merged if i not in old_offsets]
+
+        tmp_path = f"{self.snapshot_path}.tmp"
+        offsets = {}
+        with open(tmp_path, "wb") as out:
+            source = (
+                open(self.snapshot_path, "rb") if old_offsets else None
+            )
+            try:
+                for i, message_id in enumerate(order):
+                    out.write(b"[\n  " if i == 0 else b",\n  ")
+                    if message_id in merged:
+                        data = dump_record(merged[message_id]).encode("utf-8")
+                    else:
+                        start, end = old_offsets[message_id]
+                        source.seek(start)
+                        data = source.read(end - start)
+                    offsets[message_id] = (out.tell(), out.tell() + len(data))
+                    out.write(data)
+            finally:
+                if source:
+                    source.close()
+            out.write(b"\n]" if order else b"[]")
+
+        with self._lock:
+            os.replace(tmp_path, self.snapshot_path)
+            self.offsets = offsets
+            # Changes journaled before the rotation are now in the snapshot
+            for message_id in list(self.changed):
+                if message_id not in self._touched:
+                    del self.changed[message_id]
+        os.remove(self.compacting_path)
+        print(f"Compacted journal into {self.snapshot_path}")
+
+    def export_json(self, output_path=None):
+        """Write the current state in the messages.json format.
+
+        The journal is folded into the snapshot, which is then copied to
+        ``output_path`` if one is given.
+        """
+        self.compact(wait=True)
+        if output_path is None or output_path == self.snapshot_path:
+            return
+        if os.path.exists(self.snapshot_path):
+            shutil.copyfile(self.snapshot_path, output_path)
+        else:
+            save_messages([], output_path)
+
+    def close(self):
+        """Flush pending changes and fold the journal into the snapshot"""
+        self.compact(wait=True)
+
+
+def open_store(config, base_dir):
+    """Create and load the storage backend selected by ``storage_backend``"""
+    output_json_path = os.path.join(base_dir, config["output_json"])
+    backend = config.get("storage_backend", "json")
+
+    if backend == "json":
+        store = JournaledJsonStore(
+            output_json_path,
+            config.get("journal_compact_bytes", DEFAULT_COMPACT_BYTES),
+        )
+    elif backend == "sqlite":
+        from .sqlite_store import SqliteStore
+
+        sqlite_path = config.get("sqlite_path") or (
+            os.path.splitext(config["output_json"])[0] + ".db"
+        )
+        store = SqliteStore(os.path.join(base_dir, sqlite_path), output_json_path)
+    elif backend == "sharded":
+        from .shard_store import ShardedJsonStore
+
+        shard_dir = config.get("shard_dir") or (
+            os.path.splitext(config["output_json"])[0]
+        )
+        store = ShardedJsonStore(
+            os.path.join(base_dir, shard_dir),
+            output_json_path,
+            config["date_format"],
+            config.get("shard_period", "month"),
+            config.get("journal_compact_bytes", DEFAULT_COMPACT_BYTES),
+        )
+    else:
+        raise ValueError(f"Unknown storage_backend: {backend}")
+
+    store.load()
+    return store
@@ -0,0 +1,65 @@
+"""Durable progress marker for historical sync"""
+
+import json
+import os
+
+
+class SyncCheckpoint:
+    """Where historical sync of a channel stopped, saved after every commit.
+
+    ``last_message_id`` is the newest channel message whose record (and album
+    media) has been committed to the store; sync resumes right after it, and
+    the rest of a partially stored album finds its root record through the
+    album index of the store.
+    ``incomplete_threads`` lists root messages whose comment thread could not
+    be fetched completely; pending media downloads resume from the media
+    download queue instead. The file is replaced atomically and only written
+    after the store has committed, so it never points past what is on disk.
+    """
+
+    def __init__(self, path, channel):
+        self.path = path
+        self.channel = channel
+        self.last_message_id = None
+        self.incomplete_threads = []
+
+    def load(self):
+        """Read the checkpoint; returns False if there is none for the channel"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("channel") != self.channel:
+            print(
+                f"Ignoring sync checkpoint {self.path}: it belongs to {state.get('channel')}"
+            )
+            return False
+        self.last_message_id = state["last_message_id"]
+        self.incomplete_threads = state.get("incomplete_threads", [])
+        return True
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "channel": self.channel,
+                    "last_message_id": self.last_message_id,
+                    "incomplete_threads": self.incomplete_threads,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def advance(self, msg, incomplete_threads):
+        """Record that ``msg`` has been committed, then save.
+
+        Messages older than the checkpoint (a re-sync from an explicit offset)
+        only update the thread bookkeeping.
+        """
+        if self.last_message_id is None or msg.id > self.last_message_id:
+            self.last_message_id = msg.id
+        self.incomplete_threads = sorted(incomplete_threads)
+        self.save()
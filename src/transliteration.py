@@ -0,0 +1,89 @@
+"""Fast transliteration on top of iuliia schemas"""
+
+import re
+from functools import lru_cache
+from importlib import metadata
+
+# Applied on top of every schema: Latin "x" reads as "ks" in English text
+X_TO_H = str.maketrans({"X": "H", "x": "h"})
+
+WORD_BOUNDARY = re.compile(r"\b")  # how iuliia splits text into words
+
+DEFAULT_CACHE_WORDS = 1 << 16
+
+# The letter mappings are read from iuliia internals (the rules its file
+# schemas load lazily), so the fused table is only built with the version
+# pinned in requirements.txt; any other version uses the word cache
+IULIIA_VERSION = "0.13.0"
+
+
+def _iuliia_version():
+    try:
+        return metadata.version("iuliia")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+class Transliterator:
+    """``schema.translate(text)`` followed by the X→H substitution.
+
+    Schemas that map each letter on its own (such as ``scientific``) are fused
+    into a single ``str.translate`` table, substitution included, so a text is
+    transliterated in one pass in C; this needs iuliia ``IULIIA_VERSION``.
+    Schemas with context rules (letter pairs or word endings), and every
+    schema under another iuliia version, go word by word through an LRU
+    cache, as the vocabulary of a channel repeats heavily.
+    """
+
+    def __init__(self, schema, cache_words=DEFAULT_CACHE_WORDS):
+        self.schema = schema
+        self.table = None
+        rules = (
+            self._rules(schema) if _iuliia_version() == IULIIA_VERSION else None
+        )
+        if rules is not None and self._is_context_free(rules):
+            self.table = {
+                ord(letter): latin.translate(X_TO_H)
+                for letter, latin in rules.map.items()
+            }
+            self.table.update(X_TO_H)
+        else:
+            self._translate_word = lru_cache(maxsize=cache_words)(
+                self._translate_word
+            )
+
+    @staticmethod
+    def _rules(schema):
+        """The mappings behind a schema iuliia loads from its file on first use.
+
+        Relies on ``FileSchema._schema`` of iuliia ``IULIIA_VERSION``.
+        """
+        if getattr(schema, "_schema", False) is None:
+            schema.translate("")
+        return getattr(schema, "_schema", None) or schema
+
+    @staticmethod
+    def _is_context_free(schema):
+        mappings = ("map", "prev_map", "next_map", "ending_map")
+        if not all(hasattr(schema, name) for name in mappings):
+            return False
+        return (
+            not schema.prev_map
+            and not schema.next_map
+            and not schema.ending_map
+            and all(len(letter) == 1 for letter in schema.map)
+        )
+
+    def _translate_word(self, word):
+        return self.schema.translate(word).translate(X_TO_H)
+
+    def transliterate(self, text):
+        if not text:
+            return ""
+        if self.table is not None:
+            return text.translate(self.table)
+        return "".join(
+            self._translate_word(word) for word in WORD_BOUNDARY.split(text) if word
+        )
+
+    __call__ = transliterate
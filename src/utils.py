@@ -2,6 +2,7 @@ import os
 import json
 from datetime import timedelta
 import iuliia
+from .transliteration import Transliterator
 
 
 def load_config():
@@ -16,15 +17,15 @@ def load_config():
 def setup_transliteration_schema(config):
     """Setup transliteration schema based on config"""
     if config.get("transliterate_key") and config.get("transliterate_schema"):
-        return iuliia.schemas.get(config["transliterate_schema"])
+        return Transliterator(iuliia.schemas.get(config["transliterate_schema"]))
     return None
 
 
 def transliterate_text(text: str, schema) -> str:
-    """Transliterate text using the provided schema"""
+    """Transliterate text using the provided ``Transliterator``"""
     if not schema or not text:
         return ""
-    return schema.translate(text).replace("X", "H").replace("x", "h")
+    return schema.transliterate(text)
 
 
 def load_messages(output_json_path):
@@ -35,10 +36,26 @@ def load_messages(output_json_path):
         return json.load(f)
 
 
+def dump_record(record):
+    """Serialize one top-level record as it appears inside save_messages output"""
+    return json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+
+
 def save_messages(data, output_json_path):
-    """Save messages to JSON file"""
-    with open(output_json_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Save messages to JSON file (atomically, via a temporary file).
+
+    ``data`` may be any iterable of records; it is written one record at a time
+    with the same layout as ``json.dump(data, indent=2)``.
+    """
+    tmp_path = f"{output_json_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        first = True
+        for record in data:
+            f.write("[\n  " if first else ",\n  ")
+            f.write(dump_record(record))
+            first = False
+        f.write("[]" if first else "\n]")
+    os.replace(tmp_path, output_json_path)
 
 
 async def list_channels(client):
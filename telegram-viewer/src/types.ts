@@ -34,8 +34,11 @@ declare global {
     views?: number; // only for non-comment messages
     forwards?: number; // only for non-comment messages
     media?: string[];
+    grouped_id?: number; // root messages of albums
+    album_ids?: number[]; // IDs of the album's messages, in media order
     poll?: Poll;
     comments?: TelegramMessage[]; // only for root messages
+    comment_count?: number; // root messages from the archive API
   }
 }
 